@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+How long finding the object_specific directive for a path takes as the
+number of rules grows, comparing the compiled _DirectiveMatcher with a
+linear scan that compiles each rule per lookup (as _get_object_directives
+used to). The linear scan is slow enough with thousands of rules that it
+is only timed on the first --linear-paths of the paths. Run from the
+repository root with:
+
+    python -m benchmarks.directive_matcher
+"""
+from argparse import ArgumentParser
+from random import Random
+from re import compile
+from timeit import default_timer
+
+from s3sitedeploy import _DirectiveMatcher
+
+
+def generate_rules(count, random):
+    """
+    A mix resembling generated configs: mostly per-section prefixes and per
+    extension suffixes, a few unindexable expressions, and a catch-all last
+    """
+    rules = []
+    for i in range(count - 1):
+        kind = random.random()
+        if kind < 0.6:
+            rules.append({"path": r"^section-{0}/.*".format(i)})
+        elif kind < 0.9:
+            rules.append({"path": r".*\.ext{0}$".format(i)})
+        else:
+            rules.append({"path": r"(page|post)-{0}/.*".format(i)})
+    rules.append({"path": r".*"})
+    return rules
+
+
+def generate_paths(count, rule_count, random):
+    return ["section-{0}/2014/page-{1}.ext{2}".format(
+        random.randrange(rule_count * 2), i, random.randrange(rule_count))
+        for i in range(count)]
+
+
+def linear_scan(path, rules):
+    for rule in rules:
+        if compile(rule["path"]).match(path):
+            return rule
+    return None
+
+
+def time_lookups(lookup, paths):
+    start = default_timer()
+    for path in paths:
+        lookup(path)
+    return (default_timer() - start) / len(paths)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--paths", type=int, default=2000)
+    parser.add_argument("--rules", type=int, nargs="+",
+                        default=[10, 100, 500, 1000, 2000, 5000])
+    parser.add_argument("--linear-paths", type=int, default=50)
+    args = parser.parse_args()
+    random = Random(1)
+    print("{0:>6} {1:>14} {2:>14} {3:>14} {4:>8}".format(
+        "rules", "build (ms)", "matcher (us)", "linear (us)", "speedup"))
+    for rule_count in args.rules:
+        rules = generate_rules(rule_count, random)
+        paths = generate_paths(args.paths, rule_count, random)
+        start = default_timer()
+        matcher = _DirectiveMatcher(rules)
+        build = default_timer() - start
+        compiled = time_lookups(matcher.match, paths)
+        linear = time_lookups(lambda path: linear_scan(path, rules),
+                              paths[:args.linear_paths])
+        print("{0:>6} {1:>14.1f} {2:>14.1f} {3:>14.1f} {4:>7.1f}x".format(
+            rule_count, build * 1e3, compiled * 1e6, linear * 1e6,
+            linear / compiled))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of parallel_upload_dir_to_s3 on a synthetic site, deployed to a
+local S3 stand-in (tests.fake_s3) with optional latency and throttling, so
+that changes to the upload pipeline can be measured without network
+access. Each engine and concurrency is run in a fresh process, reporting
+files/s, MB/s (of the site before compression), p50/p99 latency of the
+PUTs as seen by the stand-in, how many were throttled, and peak RSS of the
+deploying process and of its compression processes. A run whose process
+dies is reported as failed, and the benchmark exits non-zero. Run from the
+repository root with, e.g.:
+
+    python -m benchmarks.upload_pipeline --files 2000 --latency 20
+"""
+import logging
+from argparse import ArgumentParser
+from json import dump
+from multiprocessing import get_context
+from os import makedirs
+from os.path import join, dirname
+from queue import Empty
+from random import Random
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+
+from benchmarks.directive_matcher import generate_rules
+
+DEFAULT_MIX = "html=40,css=5,js=10,png=25,jpg=15,txt=5"
+# Whether files of each extension compress, like text, or not, like images
+COMPRESSIBLE = {"html": True, "css": True, "js": True, "txt": True,
+                "json": True, "svg": True, "png": False, "jpg": False,
+                "woff2": False}
+GZIP_MIMETYPES = ["text/html", "text/css", "application/javascript",
+                  "text/plain", "application/json", "image/svg+xml"]
+WORDS = ("static site deploy bucket object header gzip latency throughput "
+         "<div> </div> <p> </p> class= href= function return var").split()
+BUCKET_NAME = "benchmark-bucket"
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        extension, weight = part.split("=")
+        if extension not in COMPRESSIBLE:
+            raise ValueError("Unknown extension '{0}'".format(extension))
+        weights[extension] = float(weight)
+    return weights
+
+
+def generate_contents(size, compressible, random):
+    if not compressible:
+        return random.randbytes(size)
+    text = " ".join(random.choice(WORDS) for _ in range(size // 4 + 1))
+    return text.encode("ascii")[:size]
+
+
+def generate_site(directory, files, median_size, size_sigma, mix, rules,
+                  duplicates, random):
+    """
+    Write files into directory, with sizes drawn from a log-normal
+    distribution around median_size and extensions weighted by mix, plus an
+    s3sitedeploy.json with rules object_specific directives. A duplicates
+    fraction of the files repeat the content of an earlier one. Returns the
+    total size of the site in bytes
+    """
+    extensions = sorted(mix)
+    weights = [mix[extension] for extension in extensions]
+    written = []
+    total = 0
+    for i in range(files):
+        extension = random.choices(extensions, weights)[0]
+        path = join(directory, "section-{0}".format(i % 50),
+                    "page-{0}.{1}".format(i, extension))
+        makedirs(dirname(path), exist_ok=True)
+        same_kind = [w for w in written if w[0] == extension]
+        if same_kind and random.random() < duplicates:
+            contents = random.choice(same_kind)[1]
+        else:
+            size = max(1, int(random.lognormvariate(0, size_sigma) *
+                              median_size))
+            contents = generate_contents(size, COMPRESSIBLE[extension],
+                                         random)
+            written.append((extension, contents))
+        with open(path, "wb") as f:
+            f.write(contents)
+        total += len(contents)
+    object_specific = []
+    if rules:
+        object_specific = generate_rules(rules, random)
+        for index, rule in enumerate(object_specific):
+            rule["headers"] = {"Cache-Control": "max-age={0}".format(index)}
+    with open(join(directory, "s3sitedeploy.json"), "w") as f:
+        dump({"gzip_mimetypes": GZIP_MIMETYPES,
+              "object_specific": object_specific}, f)
+    return total
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_deploy(site, site_bytes, engine, concurrency, options, results):
+    """Deploy site to a fresh stand-in, putting the measurements on results"""
+    from mock import patch
+    from s3sitedeploy import parallel_upload_dir_to_s3
+    from tests.fake_s3 import FakeS3Server
+    logging.basicConfig(level=options["log_level"].upper())
+    server = FakeS3Server(BUCKET_NAME, options["latency"],
+                          options["throttle_rate"],
+                          options["max_in_flight"]).start()
+    try:
+        with patch("s3sitedeploy.S3Connection", server.connection):
+            start = default_timer()
+            summary = parallel_upload_dir_to_s3(
+                site, BUCKET_NAME, "benchmark-key-id", "benchmark-secret",
+                engine=engine, concurrency=concurrency,
+                max_concurrency=options["max_concurrency"],
+                compression_processes=options["compression_processes"],
+                deduplicate=options["deduplicate"])
+            elapsed = default_timer() - start
+    finally:
+        server.stop()
+    latencies = [seconds for method, _, status, seconds in server.timings
+                 if method == "PUT" and status == 200]
+    results.put({
+        "engine": engine,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "uploaded": summary.uploaded,
+        "failed": len(summary.failed),
+        "files_per_second": summary.uploaded / elapsed,
+        "mb_per_second": site_bytes / elapsed / 1024 / 1024,
+        "p50_ms": percentile(latencies, 0.5) * 1e3,
+        "p99_ms": percentile(latencies, 0.99) * 1e3,
+        "throttled": sum(1 for _, _, status, _ in server.timings
+                         if status == 503),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": getrusage(RUSAGE_SELF).ru_maxrss / 1024.0,
+        "children_peak_rss_mb":
+            getrusage(RUSAGE_CHILDREN).ru_maxrss / 1024.0})
+
+
+def wait_for_result(process, results, poll=1.0):
+    """
+    The result run_deploy puts on results, or None if process exits without
+    one, e.g. killed for running out of memory
+    """
+    while True:
+        try:
+            return results.get(timeout=poll)
+        except Empty:
+            if not process.is_alive():
+                break
+    # It may have put its result just before exiting
+    try:
+        return results.get(timeout=poll)
+    except Empty:
+        return None
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--median-size", type=int, default=8 * 1024,
+                        help="median file size in bytes")
+    parser.add_argument("--size-sigma", type=float, default=1.0,
+                        help="spread of the log-normal file sizes")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="weights of each file extension")
+    parser.add_argument("--rules", type=int, default=50,
+                        help="number of object_specific directives")
+    parser.add_argument("--duplicates", type=float, default=0.0,
+                        help="fraction of files repeating earlier content")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="milliseconds added to every request")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of PUTs answered with SlowDown")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="throttle PUTs beyond this many at once")
+    parser.add_argument("--engines", nargs="+",
+                        default=["threads", "asyncio"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10])
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    parser.add_argument("--compression-processes", type=int, default=None)
+    parser.add_argument("--deduplicate", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="critical",
+                        help="of the deploy, e.g. info to see each upload")
+    parser.add_argument("--json", help="also write the results here")
+    args = parser.parse_args()
+    options = {"latency": args.latency / 1e3,
+               "throttle_rate": args.throttle_rate,
+               "max_in_flight": args.max_in_flight,
+               "max_concurrency": args.max_concurrency,
+               "compression_processes": args.compression_processes,
+               "deduplicate": args.deduplicate,
+               "log_level": args.log_level}
+    site = mkdtemp(prefix="s3sitedeploy-benchmark-")
+    context = get_context("spawn")
+    all_results = []
+    failed = False
+    try:
+        site_bytes = generate_site(
+            site, args.files, args.median_size, args.size_sigma,
+            parse_mix(args.mix), args.rules, args.duplicates,
+            Random(args.seed))
+        print("{0} files, {1:.1f}MB".format(
+            args.files, site_bytes / 1024.0 / 1024))
+        print("{0:>8} {1:>5} {2:>8} {3:>8} {4:>7} {5:>8} {6:>8} {7:>9} "
+              "{8:>8} {9:>9}".format(
+                  "engine", "conc", "seconds", "files/s", "MB/s", "p50 ms",
+                  "p99 ms", "throttled", "rss MB", "child MB"))
+        for engine in args.engines:
+            for concurrency in args.concurrency:
+                results = context.Queue()
+                process = context.Process(target=run_deploy, args=(
+                    site, site_bytes, engine, concurrency, options,
+                    results))
+                process.start()
+                result = wait_for_result(process, results)
+                process.join()
+                if result is None:
+                    failed = True
+                    all_results.append({"engine": engine,
+                                        "concurrency": concurrency,
+                                        "exitcode": process.exitcode})
+                    print("{0:>8} {1:>5} failed, exit code {2}".format(
+                        engine, concurrency, process.exitcode))
+                    continue
+                all_results.append(result)
+                print("{engine:>8} {concurrency:>5} {seconds:>8.2f} "
+                      "{files_per_second:>8.1f} {mb_per_second:>7.2f} "
+                      "{p50_ms:>8.1f} {p99_ms:>8.1f} {throttled:>9} "
+                      "{peak_rss_mb:>8.1f} {children_peak_rss_mb:>9.1f}"
+                      "".format(**result))
+    finally:
+        rmtree(site)
+    if args.json:
+        with open(args.json, "w") as f:
+            dump({"arguments": vars(args), "results": all_results}, f,
+                 indent=2)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
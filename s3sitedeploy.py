@@ -1,32 +1,186 @@
 import logging
-from os import environ, walk
-from os.path import join, isfile, relpath
-from json import load
+from os import (
+    environ, stat, fstat, rename, scandir, makedirs, remove, utime,
+    fsdecode, fsencode, strerror, fsync, stat_result)
+from os.path import join, getsize, isdir, isfile, dirname
+from time import time, sleep, mktime
+from random import uniform
+from json import load, loads, dump, dumps
 from mimetypes import guess_type
+from hashlib import md5
+from collections import deque
+from heapq import heappush, heappop
+from itertools import count, chain
+from functools import partial
+from tempfile import (
+    SpooledTemporaryFile, TemporaryFile, NamedTemporaryFile)
+from contextlib import contextmanager, nullcontext
+from shutil import rmtree
+from uuid import uuid4
+import cProfile
+import pstats
+from io import BytesIO
 import gzip
 from re import compile
-from jsonschema import validate
+from urllib.parse import quote
+from base64 import b64encode
+from binascii import unhexlify
+from mmap import mmap, ACCESS_READ
+from tarfile import is_tarfile, open as open_tarfile
+from zipfile import is_zipfile, ZipFile
+from struct import Struct
+from select import select
+from ctypes import CDLL, get_errno
+from jsonschema import validate, ValidationError
 
 from multiprocessing.dummy import Pool as ThreadPool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context, cpu_count
+import asyncio
+import ssl
+from threading import (
+    Lock, RLock, Condition, Semaphore, Thread, Event, local,
+    current_thread, setprofile)
+from queue import Queue, Full
+from socket import error as SocketError, timeout as SocketTimeout
+from http.client import HTTPException
 
 
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
+from boto.exception import S3ResponseError, BotoServerError
 
 log = logging.getLogger(__name__)
 
 CONFIG_FILENAME = "s3sitedeploy.json"
 
+# Compressed output larger than this spills from memory to a temporary file
+COMPRESSION_SPOOL_SIZE = 8 * 1024 * 1024
+DEFAULT_GZIP_LEVEL = 9
+DEFAULT_COMPRESSION_CACHE_SIZE = 512 * 1024 * 1024
+# Roughly how much file content may be held in memory at once, see
+# _MemoryBudget
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Buckets outside DEFAULT_REGION are reached through their region's endpoint
+DEFAULT_REGION = "us-east-1"
+REGION_HOST = "s3.{0}.amazonaws.com"
+
+THREADS_ENGINE = "threads"
+ASYNCIO_ENGINE = "asyncio"
+ENGINES = (THREADS_ENGINE, ASYNCIO_ENGINE)
+WORKERS = 10
+# How many files per worker may be found but not yet uploaded
+PENDING_PER_WORKER = 4
+# The asyncio engine reads, gzips and hashes files on this many threads
+ASYNCIO_IO_THREADS = 4
+# Seconds the asyncio engine waits to connect, or for each read or write of
+# a request to make progress, when boto's http_socket_timeout isn't set
+ASYNCIO_SOCKET_TIMEOUT = 70
+
+# Uncompressed files of at least this size are uploaded in parts
+DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MAX_MULTIPART_PARTS = 10000
+
+# Files smaller than this are uploaded even if their content was already
+# uploaded under another key, as a copy would save next to nothing
+DEDUPLICATE_MIN_SIZE = 16 * 1024
+
+# The most keys S3 accepts in one DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+# Errors after which a connection can't be trusted to be reused
+TRANSPORT_ERRORS = (SocketError, HTTPException)
+
+# How a failed request should be retried, see _classify_error
+THROTTLED = "throttled"
+RETRYABLE = "retryable"
+FATAL = "fatal"
+THROTTLE_ERROR_CODES = ("SlowDown", "Throttling", "RequestLimitExceeded",
+                        "TooManyRequests")
+RETRYABLE_ERROR_CODES = ("RequestTimeout", "InternalError",
+                         "OperationAborted")
+UPLOAD_ATTEMPTS = 5
+# Retries back off exponentially, with full jitter, between these (seconds)
+RETRY_BASE_DELAY = 0.25
+RETRY_MAX_DELAY = 20.0
+# Retries for a whole deploy are limited to this many, plus a share of the
+# files found, so that a deploy to a broken bucket gives up quickly
+RETRY_BUDGET_MIN = 10
+RETRY_BUDGET_RATIO = 0.1
+
+# Concurrency halves when S3 throttles, and only grows while the smoothed
+# request latency stays within LATENCY_TOLERANCE of the best seen
+CONCURRENCY_DECREASE = 0.5
+LATENCY_TOLERANCE = 2.0
+LATENCY_SMOOTHING = 0.2
+
+UPLOADED = "uploaded"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+# Upper bounds, in milliseconds, of the metrics report's latency histogram
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                   10000, 30000)
+# How many of the slowest uploads the metrics report lists
+SLOWEST_OBJECTS = 10
+# The checkpoint journal is synced to disk once this many entries have been
+# written since the last sync, or this many seconds have passed
+JOURNAL_SYNC_ENTRIES = 100
+JOURNAL_SYNC_INTERVAL = 1.0
+# Where a LocalBucket keeps the headers of its objects and multipart uploads
+LOCAL_METADATA_DIRECTORY = ".s3sitedeploy"
+# How many files a deploy to one of several buckets may get ahead of the
+# slowest, whose prepared payloads are kept for it meanwhile
+FAN_OUT_LEAD = 256
+# Set to a path to write a cProfile capture of the deploy there
+PROFILE_ENV_VAR = "S3SITEDEPLOY_PROFILE"
+
+# In watch mode, changes are deployed once none have arrived for
+# WATCH_DEBOUNCE seconds, or WATCH_MAX_DELAY after the first while they
+# keep arriving. Without inotify the directory is walked every
+# WATCH_POLL_INTERVAL seconds instead
+WATCH_DEBOUNCE = 0.2
+WATCH_MAX_DELAY = 2.0
+WATCH_POLL_INTERVAL = 1.0
+# How often to check whether watching should stop while nothing changes
+WATCH_STOP_CHECK = 0.5
+
 
 def extract_wercker_env_vars():
     extracted = {}
     expected_env_vars = [
         ("source_dir", "WERCKER_SOURCE_DIR", True),
         ("deploy_dir", "WERCKER_S3SITEDEPLOY_DEPLOY_DIR", False),
+        ("archive", "WERCKER_S3SITEDEPLOY_ARCHIVE", False),
         ("bucket_name", "WERCKER_S3SITEDEPLOY_BUCKET_NAME", True),
         ("access_key_id", "WERCKER_S3SITEDEPLOY_ACCESS_KEY_ID", True),
         ("secret_access_key", "WERCKER_S3SITEDEPLOY_SECRET_ACCESS_KEY", True),
-        ("log_level", "WERCKER_S3SITEDEPLOY_LOG_LEVEL", False)]
+        ("region", "WERCKER_S3SITEDEPLOY_REGION", False),
+        ("targets", "WERCKER_S3SITEDEPLOY_TARGETS", False),
+        ("log_level", "WERCKER_S3SITEDEPLOY_LOG_LEVEL", False),
+        ("incremental", "WERCKER_S3SITEDEPLOY_INCREMENTAL", False),
+        ("manifest_path", "WERCKER_S3SITEDEPLOY_MANIFEST", False),
+        ("verify_manifest", "WERCKER_S3SITEDEPLOY_VERIFY_MANIFEST", False),
+        ("engine", "WERCKER_S3SITEDEPLOY_ENGINE", False),
+        ("prune", "WERCKER_S3SITEDEPLOY_PRUNE", False),
+        ("journal_path", "WERCKER_S3SITEDEPLOY_JOURNAL", False),
+        ("metrics_report", "WERCKER_S3SITEDEPLOY_METRICS_REPORT", False),
+        ("shard_index", "WERCKER_S3SITEDEPLOY_SHARD_INDEX", False),
+        ("shard_count", "WERCKER_S3SITEDEPLOY_SHARD_COUNT", False),
+        ("deduplicate", "WERCKER_S3SITEDEPLOY_DEDUPLICATE", False),
+        ("watch", "WERCKER_S3SITEDEPLOY_WATCH", False),
+        ("concurrency", "WERCKER_S3SITEDEPLOY_CONCURRENCY", False),
+        ("max_concurrency", "WERCKER_S3SITEDEPLOY_MAX_CONCURRENCY", False),
+        ("memory_budget", "WERCKER_S3SITEDEPLOY_MEMORY_BUDGET", False),
+        ("compression_processes",
+         "WERCKER_S3SITEDEPLOY_COMPRESSION_PROCESSES", False),
+        ("compression_cache", "WERCKER_S3SITEDEPLOY_COMPRESSION_CACHE",
+         False),
+        ("compression_cache_size",
+         "WERCKER_S3SITEDEPLOY_COMPRESSION_CACHE_SIZE", False)]
     for map_to, key, required in expected_env_vars:
         try:
             extracted[map_to] = environ[key]
@@ -39,34 +193,261 @@ def extract_wercker_env_vars():
     return extracted
 
 
+def _is_true(value):
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _optional_int(value):
+    return None if value in (None, "") else int(value)
+
+
 def _validate_s3sitedeploy_json(json):
     with open("s3sitedeploy.schema.json") as schema_file:
         return validate(json, load(schema_file)) is None
 
 
-def _list_all_files_in_dir(dir):
-    return {relpath(join(dp, f), dir)
-            for dp, _, fn in walk(dir)
-            for f in fn
-            if isfile(join(dp, f))} - {CONFIG_FILENAME}
+def _iter_files_in_dir(dir, subdirectory="", unreadable=None):
+    """
+    Yield the path of every file under dir relative to it, as the walk goes,
+    so that uploads can start before it has finished. Uses the file types
+    scandir already knows about, so entries aren't stat'd again. Like
+    os.walk, symlinks to directories aren't followed and unreadable
+    directories are skipped, though they are added to unreadable (a list)
+    if given, as their files can't be told apart from deleted ones. Only
+    files under subdirectory (ending in a slash) are walked, if given
+    """
+    pending = [subdirectory]
+    while pending:
+        relative_dir = pending.pop()
+        try:
+            entries = scandir(join(dir, relative_dir))
+        except OSError as error:
+            log.warning("Could not list directory %s: %s",
+                        join(dir, relative_dir), error)
+            if unreadable is not None:
+                unreadable.append(relative_dir)
+            continue
+        with entries:
+            for entry in entries:
+                relative_path = relative_dir + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(relative_path + "/")
+                elif entry.is_file() and relative_path != CONFIG_FILENAME:
+                    yield relative_path
 
 
 def _get_s3site_config(dir):
     config_filepath = join(dir, CONFIG_FILENAME)
     try:
         with open(config_filepath) as config:
-            try:
-                decoded = load(config)
-            except ValueError:
-                log.exception("%s possibly not valid JSON", CONFIG_FILENAME)
-                raise
-            if _validate_s3sitedeploy_json(decoded):
-                return decoded
+            return _load_s3site_config(config)
     except IOError:
         log.exception("Could not find configuration file %s", config_filepath)
         return {}
 
 
+def _load_s3site_config(config):
+    try:
+        decoded = load(config)
+    except ValueError:
+        log.exception("%s possibly not valid JSON", CONFIG_FILENAME)
+        raise
+    if _validate_s3sitedeploy_json(decoded):
+        if "object_specific" in decoded:
+            decoded["object_specific"] = _DirectiveMatcher(
+                decoded["object_specific"])
+        return decoded
+
+
+class _Archive(object):
+    """
+    A tar (which may be compressed) or zip of the site, deployed in place of
+    a directory without being extracted to disk. Only files under
+    subdirectory are deployed, and s3sitedeploy.json is read from there.
+    files() reads members in the order they are stored, hashing each on
+    the way and keeping its contents until each of consumers deploys has
+    finished() with it, or retire()d. Contents are kept in memory up to
+    COMPRESSION_SPOOL_SIZE, as long as memory (a _MemoryBudget) has room
+    for them, and in a temporary file otherwise. open() gives a handle on
+    a member's contents, to be used in place of a filepath. Each deploy
+    uses its own view, see consumer()
+    """
+
+    def __init__(self, path, subdirectory="", consumers=1, memory=None):
+        self.path = path
+        self.subdirectory = subdirectory.strip("/")
+        if self.subdirectory:
+            self.subdirectory += "/"
+        self.memory = memory or _MemoryBudget(None)
+        self._consumers = set(range(consumers))
+        self._members = {}
+        self._lock = Lock()
+        self._zip = self._tar = None
+        if is_zipfile(path):
+            self._zip = ZipFile(path)
+        elif is_tarfile(path):
+            self._tar = open_tarfile(path, "r:*")
+        else:
+            raise ValueError("'{0}' is not a tar or zip archive".format(path))
+
+    def consumer(self, index):
+        return _ArchiveConsumer(self, index)
+
+    def _entries(self):
+        """Yield (relative path, size, mtime, opener) of each file"""
+        if self._zip is not None:
+            entries = ((info.filename, info.file_size,
+                        mktime(info.date_time + (0, 0, -1)),
+                        partial(self._zip.open, info))
+                       for info in self._zip.infolist() if not info.is_dir())
+        else:
+            entries = ((info.name, info.size, info.mtime,
+                        partial(self._tar.extractfile, info))
+                       for info in self._tar if info.isfile())
+        for name, size, mtime, opener in entries:
+            while name.startswith("./"):
+                name = name[2:]
+            name = name.lstrip("/")
+            if name.startswith(self.subdirectory):
+                yield name[len(self.subdirectory):], size, mtime, opener
+
+    def config(self):
+        for relative_path, _, _, opener in self._entries():
+            if relative_path == CONFIG_FILENAME:
+                with opener() as config:
+                    return _load_s3site_config(config)
+        log.error("Could not find configuration file %s in %s",
+                  CONFIG_FILENAME, self.path)
+        return {}
+
+    def files(self, wanted=None):
+        """
+        Yield the path of every file relative to subdirectory, once its
+        contents have been read, other than those wanted(path) is false for
+        """
+        for relative_path, size, mtime, opener in self._entries():
+            if relative_path in ("", CONFIG_FILENAME) or \
+                    (wanted is not None and not wanted(relative_path)):
+                continue
+            with opener() as member_file:
+                self._keep(relative_path, member_file, size, mtime)
+            yield relative_path
+
+    def _keep(self, relative_path, member_file, size, mtime):
+        contents = path = None
+        reserved = 0
+        if size <= COMPRESSION_SPOOL_SIZE and self.memory.try_reserve(size):
+            reserved = size
+            contents = member_file.read()
+            digest = md5(contents)
+        else:
+            digest = md5()
+            with NamedTemporaryFile(delete=False) as spilled:
+                for chunk in iter(lambda: member_file.read(65536), b""):
+                    digest.update(chunk)
+                    spilled.write(chunk)
+            path = spilled.name
+        with self._lock:
+            self._members[relative_path] = {
+                "contents": contents, "path": path, "reserved": reserved,
+                "md5": digest.hexdigest(), "waiting": set(self._consumers),
+                "stat": stat_result((0o100644, 0, 0, 1, 0, 0, size, mtime,
+                                     mtime, mtime))}
+            if self._members[relative_path]["waiting"]:
+                return
+            # Every deploy has retired, so nobody will finish with it
+            member = self._members.pop(relative_path)
+        self._discard(member)
+
+    def size(self, relative_path):
+        return self._members[relative_path]["stat"].st_size
+
+    def open(self, relative_path):
+        """
+        A handle on a file's contents. Its .path is relative_path, .md5 its
+        MD5 and .stat its size and mtime from the archive
+        """
+        member = self._members[relative_path]
+        if member["path"] is None:
+            handle = BytesIO(member["contents"])
+        else:
+            handle = open(member["path"], "rb")
+        handle.path = relative_path
+        handle.md5 = member["md5"]
+        handle.stat = member["stat"]
+        return handle
+
+    def finished(self, index, relative_path):
+        with self._lock:
+            member = self._members.get(relative_path)
+            if member is None:
+                return
+            member["waiting"].discard(index)
+            if member["waiting"]:
+                return
+            del self._members[relative_path]
+        self._discard(member)
+
+    def retire(self, index):
+        """Stop keeping anything for a deploy which has finished or failed"""
+        finished = []
+        with self._lock:
+            self._consumers.discard(index)
+            for relative_path, member in list(self._members.items()):
+                member["waiting"].discard(index)
+                if not member["waiting"]:
+                    finished.append(self._members.pop(relative_path))
+        for member in finished:
+            self._discard(member)
+
+    def _discard(self, member):
+        if member["reserved"]:
+            self.memory.release(member["reserved"])
+        if member["path"] is not None:
+            try:
+                remove(member["path"])
+            except OSError:
+                pass
+
+    def close(self):
+        with self._lock:
+            members, self._members = self._members, {}
+        for member in members.values():
+            self._discard(member)
+        (self._zip or self._tar).close()
+
+
+class _ArchiveConsumer(object):
+    """One deploy's view of an _Archive"""
+
+    def __init__(self, archive, index):
+        self.archive = archive
+        self.index = index
+
+    def size(self, relative_path):
+        return self.archive.size(relative_path)
+
+    def open(self, relative_path):
+        return self.archive.open(relative_path)
+
+    def finished(self, relative_path):
+        self.archive.finished(self.index, relative_path)
+
+    def retire(self):
+        self.archive.retire(self.index)
+
+
+def _path_of(source):
+    """The path of a file, or of the archive member source is a handle on"""
+    return getattr(source, "path", source)
+
+
+def _stat_of(source):
+    if _is_file_object(source):
+        return source.stat
+    return stat(source)
+
+
 def _append_charset(content_type):
     """
     Files stored in S3 really should be in UTF-8. For this reason, I've not
@@ -78,36 +459,502 @@ def _append_charset(content_type):
         return content_type
 
 
-def _compress_the_file(filepath):
+class _HashingWriter(object):
+    """Passes writes through to fileobj, keeping the MD5 of what's written"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = md5()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def _gzip_file_into(filepath, level, fileobj):
+    """
+    Gzip a file (a filepath or an open binary file, read from the start)
+    into fileobj, returning the MD5 hex digests of the file and of the
+    gzipped output, which are worked out on the way through
+    """
+    if not _is_file_object(filepath):
+        with open(filepath, "rb") as f_in:
+            return _gzip_file_into(f_in, level, fileobj)
+    source = md5()
+    compressed = _HashingWriter(fileobj)
+    filepath.seek(0)
+    with gzip.GzipFile(filename="", mode="wb", compresslevel=level,
+                       fileobj=compressed, mtime=0) as gz_out:
+        for chunk in iter(lambda: filepath.read(65536), b""):
+            source.update(chunk)
+            gz_out.write(chunk)
+    return source.hexdigest(), compressed.digest.hexdigest()
+
+
+def _gzip_file_to_bytes(filepath, level):
+    """Run in a compression process, so must be a module level function"""
+    compressed = BytesIO()
+    source_md5, compressed_md5 = _gzip_file_into(filepath, level, compressed)
+    return compressed.getvalue(), source_md5, compressed_md5
+
+
+def _compress_the_file(filepath, level=DEFAULT_GZIP_LEVEL,
+                       spool_size=COMPRESSION_SPOOL_SIZE):
+    """
+    Gzip a file into a spooled buffer, which is only written to disk (outside
+    of the site being deployed) if it grows beyond spool_size, or straight
+    to disk if spool_size is None. The gzip header has a fixed mtime and no
+    filename, so identical input always gives byte-identical output and
+    therefore the same ETag. The returned buffer is rewound ready for
+    reading, and should be closed by the caller. Its .md5 and .source_md5
+    are the MD5s of its contents and of the file
+    """
+    log.debug("Compressing %s at level %d", _path_of(filepath), level)
+    if spool_size is None:
+        compressed = TemporaryFile()
+    else:
+        compressed = SpooledTemporaryFile(max_size=spool_size)
+    compressed.source_md5, compressed.md5 = _gzip_file_into(
+        filepath, level, compressed)
+    compressed.seek(0)
+    return compressed
+
+
+class _ProcessPoolCompressor(object):
+    """
+    Used in place of _compress_the_file to gzip on a pool of processes, one
+    per core by default, so that compression isn't held to a single core by
+    the GIL. The calling upload worker waits for the compressed buffer, so
+    both engines run at least one worker per process (see _worker_count).
+    Files too large to sensibly pass between processes in memory are
+    compressed by the caller as before
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or cpu_count()
+        self._executor = ProcessPoolExecutor(
+            self.processes, mp_context=get_context("spawn"))
+
+    def __call__(self, filepath, level=DEFAULT_GZIP_LEVEL):
+        if _size_of_file(filepath) > COMPRESSION_SPOOL_SIZE:
+            return _compress_the_file(filepath, level)
+        log.debug("Compressing %s at level %d in a separate process",
+                  _path_of(filepath), level)
+        source = filepath
+        if _is_file_object(filepath):
+            # Open files can't be passed to another process, but contents can
+            source = BytesIO(filepath.read())
+        compressed = SpooledTemporaryFile(max_size=COMPRESSION_SPOOL_SIZE)
+        contents, compressed.source_md5, compressed.md5 = \
+            self._executor.submit(_gzip_file_to_bytes, source,
+                                  level).result()
+        compressed.write(contents)
+        compressed.seek(0)
+        return compressed
+
+    def close(self):
+        self._executor.shutdown()
+
+
+class _CachingCompressor(object):
+    """
+    Wraps a compressor (_compress_the_file or a _ProcessPoolCompressor) with
+    an on-disk cache of compressed output, so that files which haven't
+    changed since an earlier deploy aren't compressed again. Entries are
+    keyed by the MD5 of the source content and the compression level, and
+    record the MD5 of the compressed output in their filename, which is
+    attached to the returned file as .md5 so it needn't be hashed again.
+    Source files are hashed through digests (see _Digests), if given.
+
+    The cache is kept under max_bytes by evicting the least recently used
+    entries, going by file modification times, which are bumped on each hit
+    """
+    VERSION = "v1"
+
+    def __init__(self, directory, max_bytes, compressor=_compress_the_file,
+                 digests=None):
+        self.directory = join(directory, self.VERSION)
+        self.max_bytes = max_bytes
+        self.compressor = compressor
+        self.digests = digests or _Digests()
+        self.processes = getattr(compressor, "processes", 0)
+        self._entries = {}
+        self._size = 0
+        self._lock = Lock()
+        self._load()
+
+    def _load(self):
+        if not isdir(self.directory):
+            makedirs(self.directory)
+        for entry in scandir(self.directory):
+            if not entry.name.endswith(".gz"):
+                continue
+            key, _, compressed_md5 = entry.name[:-3].rpartition("-")
+            entry_stat = entry.stat()
+            self._entries[key] = [compressed_md5, entry_stat.st_size,
+                                  entry_stat.st_mtime]
+            self._size += entry_stat.st_size
+        log.info("Compression cache %s holds %d entries (%d bytes)",
+                 self.directory, len(self._entries), self._size)
+
+    def _path(self, key, compressed_md5):
+        return join(self.directory, "{0}-{1}.gz".format(key, compressed_md5))
+
+    def __call__(self, filepath, level=DEFAULT_GZIP_LEVEL):
+        key = "{0}-{1}".format(self.digests.md5(filepath), level)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[2] = time()
+        if entry is not None:
+            try:
+                cached = open(self._path(key, entry[0]), "rb")
+                utime(cached.name)
+                cached.md5 = entry[0]
+                log.debug("Compression cache hit for %s",
+                          _path_of(filepath))
+                return cached
+            except (IOError, OSError):
+                log.warning("Compression cache entry for %s has gone",
+                            _path_of(filepath))
+        compressed = self.compressor(filepath, level)
+        compressed.md5 = _md5_of_file(compressed)
+        self._store(key, compressed)
+        return compressed
+
+    def _store(self, key, compressed):
+        path = self._path(key, compressed.md5)
+        temp_path = "{0}.{1}.tmp".format(path, current_thread().ident)
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in iter(lambda: compressed.read(65536), b""):
+                    f.write(chunk)
+            rename(temp_path, path)
+        except (IOError, OSError):
+            log.exception("Could not add %s to the compression cache", path)
+            return
+        finally:
+            compressed.seek(0)
+        size = getsize(path)
+        with self._lock:
+            if key not in self._entries:
+                self._size += size
+            self._entries[key] = [compressed.md5, size, time()]
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the cap, so that eviction isn't run per store
+        by_last_use = sorted(self._entries.items(), key=lambda kv: kv[1][2])
+        for key, (compressed_md5, size, _) in by_last_use:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                remove(self._path(key, compressed_md5))
+            except OSError:
+                pass
+            del self._entries[key]
+            self._size -= size
+        log.debug("Compression cache evicted down to %d bytes", self._size)
+
+    def close(self):
+        if hasattr(self.compressor, "close"):
+            self.compressor.close()
+
+
+class _SharedPreparation(object):
+    """
+    Shares the work of preparing files between the deploys of the same
+    files to several buckets (see consumer()). Each file's headers are
+    matched, and it is gzipped, once, by whichever deploy gets to it first.
+    The result is kept until every deploy has prepared that file, each
+    getting a copy of the headers and its own handle on the compressed
+    output. Output is kept in memory up to COMPRESSION_SPOOL_SIZE, as long
+    as memory (a _MemoryBudget) has room for it, and in a temporary file
+    otherwise. A deploy preparing a file again, e.g. to retry it, does the
+    work afresh, and nothing is kept for it
+    """
+
+    def __init__(self, consumers, compressor=None, memory=None):
+        self.consumers = consumers
+        self.compressor = compressor or _compress_the_file
+        self.processes = getattr(compressor, "processes", 0)
+        self.memory = memory or _MemoryBudget(None)
+        self._entries = {}
+        self._finished = set()
+        self._retired = set()
+        self._lock = Lock()
+
+    def consumer(self, index):
+        return _PreparationConsumer(self, index)
+
+    def _claim(self, index, filepath):
+        """The entry for filepath if index hasn't prepared it yet, or None"""
+        filepath = _path_of(filepath)
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is None:
+                if filepath in self._finished:
+                    # Every deploy has prepared it, so this one is retrying
+                    return None
+                waiting = set(range(self.consumers)) - self._retired
+                entry = self._entries[filepath] = {
+                    "waiting": waiting, "lock": Lock()}
+            if index not in entry["waiting"]:
+                return None
+            return entry
+
+    def headers(self, index, filepath, destination_key, site_config):
+        entry = self._claim(index, filepath)
+        if entry is None:
+            return _get_object_headers(filepath, destination_key,
+                                       site_config)
+        with entry["lock"]:
+            if "headers" not in entry:
+                entry["headers"] = _get_object_headers(
+                    filepath, destination_key, site_config)
+        headers, should_gzip = entry["headers"]
+        return dict(headers), should_gzip
+
+    def compress(self, index, filepath, level):
+        entry = self._claim(index, filepath)
+        if entry is None:
+            return self.compressor(filepath, level)
+        with entry["lock"]:
+            if "compressed" not in entry:
+                entry["compressed"] = self._keep(
+                    self.compressor(filepath, level))
+        contents, path, compressed_md5, source_md5, _ = entry["compressed"]
+        compressed = BytesIO(contents) if path is None else open(path, "rb")
+        compressed.md5 = compressed_md5
+        compressed.source_md5 = source_md5
+        return compressed
+
+    def _keep(self, compressed):
+        with compressed:
+            compressed_md5 = _md5_of_file(compressed)
+            source_md5 = getattr(compressed, "source_md5", None)
+            size = _size_of_file(compressed)
+            if size <= COMPRESSION_SPOOL_SIZE and \
+                    self.memory.try_reserve(size):
+                return (compressed.read(), None, compressed_md5, source_md5,
+                        size)
+            with NamedTemporaryFile(delete=False) as kept:
+                for chunk in iter(lambda: compressed.read(65536), b""):
+                    kept.write(chunk)
+            return None, kept.name, compressed_md5, source_md5, 0
+
+    def done(self, index, filepath):
+        filepath = _path_of(filepath)
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is None:
+                return
+            entry["waiting"].discard(index)
+            if entry["waiting"]:
+                return
+            del self._entries[filepath]
+            self._finished.add(filepath)
+        self._discard(entry)
+
+    def retire(self, index):
+        """Stop keeping anything for a deploy which has finished or failed"""
+        finished = []
+        with self._lock:
+            self._retired.add(index)
+            for filepath, entry in list(self._entries.items()):
+                entry["waiting"].discard(index)
+                if not entry["waiting"]:
+                    finished.append(self._entries.pop(filepath))
+                    self._finished.add(filepath)
+        for entry in finished:
+            self._discard(entry)
+
+    def _discard(self, entry):
+        _, path, _, _, reserved = entry.get("compressed", (None,) * 5)
+        if reserved:
+            self.memory.release(reserved)
+        if path is not None:
+            try:
+                remove(path)
+            except OSError:
+                pass
+
+    def close(self):
+        with self._lock:
+            entries, self._entries = self._entries, {}
+        for entry in entries.values():
+            self._discard(entry)
+        if hasattr(self.compressor, "close"):
+            self.compressor.close()
+
+
+class _PreparationConsumer(object):
+    """
+    One deploy's view of a _SharedPreparation, used in place of a compressor
+    """
+
+    def __init__(self, shared, index):
+        self.shared = shared
+        self.index = index
+        self.processes = shared.processes
+
+    def __call__(self, filepath, level=DEFAULT_GZIP_LEVEL):
+        return self.shared.compress(self.index, filepath, level)
+
+    def headers(self, filepath, destination_key, site_config):
+        return self.shared.headers(self.index, filepath, destination_key,
+                                   site_config)
+
+    def done(self, filepath):
+        self.shared.done(self.index, filepath)
+
+    def retire(self):
+        self.shared.retire(self.index)
+
+
+def _gzip_level(site_config, filepath):
+    """
+    The compression level for a file: from gzip_levels for its mimetype,
+    otherwise gzip_level, otherwise the default
+    """
+    level = site_config.get("gzip_level", DEFAULT_GZIP_LEVEL)
+    content_type = guess_type(_path_of(filepath))[0]
+    return site_config.get("gzip_levels", {}).get(content_type, level)
+
+
+_REGEX_SPECIAL = set(".^$*+?{}[]|()")
+
+
+def _regex_tokens(pattern):
+    """
+    Split a regular expression into (is_literal, character) tokens. Escaped
+    punctuation is literal, while escapes such as \\d are not
+    """
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            escaped = pattern[i + 1]
+            yield not escaped.isalnum(), escaped
+            i += 2
+        else:
+            yield char not in _REGEX_SPECIAL, char
+            i += 1
+
+
+def _is_indexable(pattern):
+    # Alternation or inline flags such as (?i) could defeat any literal
+    return "|" not in pattern and "(?" not in pattern
+
+
+def _literal_prefix(pattern):
+    """
+    A string that every path matched by pattern (using re.match) starts
+    with, e.g. r"^assets/.*" gives "assets/"
+    """
+    if not _is_indexable(pattern):
+        return ""
+    prefix = []
+    tokens = list(_regex_tokens(pattern))
+    if tokens and tokens[0] == (False, "^"):
+        tokens = tokens[1:]
+    for is_literal, char in tokens:
+        if not is_literal:
+            if char in "*?{" and prefix:
+                # The previous character is optional
+                prefix.pop()
+            break
+        prefix.append(char)
+    return "".join(prefix)
+
+
+def _literal_suffix(pattern):
+    """
+    A string that every path matched by pattern ends with, for patterns
+    anchored with a trailing $, e.g. r".*\\.css$" gives ".css"
+    """
+    if not _is_indexable(pattern):
+        return ""
+    tokens = list(_regex_tokens(pattern))
+    if not tokens or tokens[-1] != (False, "$"):
+        return ""
+    suffix = []
+    for is_literal, char in reversed(tokens[:-1]):
+        if not is_literal:
+            break
+        suffix.append(char)
+    return "".join(reversed(suffix))
+
+
+class _DirectiveMatcher(list):
     """
-    TODO: Make this function usable with a 'with' statement, which deletes it
-    after the yield
+    The object_specific directives, with their paths compiled once. Finding
+    the directive for a path keeps first match wins semantics, but only
+    tries the rules which could possibly match: rules are indexed by the
+    literal prefix or literal (anchored) suffix of their path expression,
+    and only those sharing a prefix or suffix with the path, plus rules
+    with neither, are tested. Still compares equal to the plain list of
+    directives it was built from
     """
-    compressed_filepath = "{0}.s3sitedeploy.tmp.gz".format(filepath)
-    log.debug("Compressing %s to %s", filepath, compressed_filepath)
-    with open(filepath) as f_in:
-        with gzip.open(compressed_filepath, "wb") as gz_out:
-            gz_out.writelines(f_in)
-    return compressed_filepath
+
+    def __init__(self, directives):
+        list.__init__(self, directives)
+        self._compiled = [compile(directive["path"]) for directive in self]
+        self._by_prefix = {}
+        self._by_suffix = {}
+        self._unindexed = []
+        for index, directive in enumerate(self):
+            prefix = _literal_prefix(directive["path"])
+            suffix = _literal_suffix(directive["path"])
+            if prefix:
+                self._by_prefix.setdefault(prefix, []).append(index)
+            elif suffix:
+                self._by_suffix.setdefault(suffix, []).append(index)
+            else:
+                self._unindexed.append(index)
+        self._prefix_lengths = sorted(set(len(p) for p in self._by_prefix))
+        self._suffix_lengths = sorted(set(len(s) for s in self._by_suffix))
+
+    def _candidates(self, object_path):
+        candidates = list(self._unindexed)
+        for length in self._prefix_lengths:
+            candidates.extend(self._by_prefix.get(object_path[:length], ()))
+        if self._suffix_lengths:
+            # $ also matches just before a trailing newline
+            ending = object_path[:-1] if object_path.endswith("\n") \
+                else object_path
+            for length in self._suffix_lengths:
+                candidates.extend(self._by_suffix.get(ending[-length:], ()))
+        return sorted(candidates)
+
+    def match(self, object_path):
+        for index in self._candidates(object_path):
+            if self._compiled[index].match(object_path):
+                log.debug("Object path %s matched expression %s, "
+                          "directives: %s", object_path, self[index]["path"],
+                          self[index])
+                return self[index]
+        return None
 
 
 def _get_object_directives(object_path, object_specific_config):
-    for directive in object_specific_config:
-        path = compile(directive["path"])
-        if path.match(object_path):
-            log.debug(
-                "Object path %s matched expression %s, directives: %s",
-                object_path, str(directive["path"]), str(directive))
-            return directive
-    return None
-
-
-def _upload_file_to_s3(filepath, bucket, destination_key, site_config):
-    key = Key(bucket)
-    key.key = destination_key
-    content_type, content_encoding = guess_type(filepath)
+    if not isinstance(object_specific_config, _DirectiveMatcher):
+        object_specific_config = _DirectiveMatcher(object_specific_config)
+    return object_specific_config.match(object_path)
+
+
+def _get_object_headers(filepath, destination_key, site_config):
+    """
+    Work out the headers an object will be PUT with, and whether its contents
+    should be gzipped first. Returned as a (headers, should_gzip) tuple
+    """
+    content_type, content_encoding = guess_type(_path_of(filepath))
     log.debug("Guessed content type '%s' and encoding '%s' for '%s'",
-              content_type, content_encoding, filepath)
+              content_type, content_encoding, _path_of(filepath))
     # TODO: Add test around this
     directives = _get_object_directives(destination_key,
                                         site_config.get("object_specific", []))
@@ -115,6 +962,7 @@ def _upload_file_to_s3(filepath, bucket, destination_key, site_config):
         "x-amz-acl": "public-read",
         "Content-Type": _append_charset(content_type),
         "Cache-Control": "no-cache"}
+    should_gzip = False
     if content_encoding:
         headers["Content-Encoding"] = content_encoding
     else:
@@ -127,50 +975,2961 @@ def _upload_file_to_s3(filepath, bucket, destination_key, site_config):
             pass
         if should_gzip:
             headers["Content-Encoding"] = "gzip"
-            filepath = _compress_the_file(filepath)
     try:
         headers.update(directives["headers"])
     except (KeyError, TypeError):
         pass
-    bytes_written = key.set_contents_from_filename(filepath, headers=headers)
-    log.info("Uploaded '%s' (transmitted %d bytes)", destination_key,
+    return headers, should_gzip
+
+
+def _is_file_object(payload):
+    return hasattr(payload, "read")
+
+
+def _md5_of_file(payload):
+    """
+    MD5 hex digest of a payload, which is either a filepath or an open binary
+    file. File objects are read from the start and left rewound
+    """
+    return _etag_of_file(payload)[0]
+
+
+def _boto_md5(hexdigest):
+    """An MD5 hex digest as the (hex, base64) tuple boto takes"""
+    return hexdigest, b64encode(unhexlify(hexdigest)).decode("ascii")
+
+
+def _size_of_file(payload):
+    if not _is_file_object(payload):
+        return getsize(payload)
+    payload.seek(0, 2)
+    size = payload.tell()
+    payload.seek(0)
+    return size
+
+
+def _list_remote_objects(buckets):
+    """
+    List the bucket once, returning a map of key name to (ETag, size). The
+    listing is started again with backoff if any page of it fails, see
+    _retried
+    """
+    remote = _retried(buckets, lambda bucket: bucket.list(), "list bucket")
+    log.info("Found %d existing objects in bucket '%s'", len(remote),
+             buckets.bucket_name)
+    return remote
+
+
+def _etag_of_file(payload, part_size=None):
+    """
+    Work out the ETag S3 gives a payload: the MD5 of its contents, or if it
+    is uploaded in parts of part_size, the MD5 of the parts' binary MD5s
+    followed by the number of parts. Both are found in a single read, and
+    returned as an (md5, etag) tuple. Files are memory mapped rather than
+    read, so their contents aren't copied
+    """
+    if not _is_file_object(payload):
+        with open(payload, "rb") as f:
+            if not fstat(f.fileno()).st_size:
+                return _etag_of_file(f, part_size)
+            with mmap(f.fileno(), 0, access=ACCESS_READ) as mapped:
+                with memoryview(mapped) as contents:
+                    return _etag_of_buffer(contents, part_size)
+    if getattr(payload, "md5", None) and not part_size:
+        return payload.md5, payload.md5
+    whole = md5()
+    part = md5()
+    part_digests = []
+    filled = 0
+    payload.seek(0)
+    while True:
+        chunk = payload.read(min(65536, part_size - filled)
+                             if part_size else 65536)
+        if not chunk:
+            break
+        whole.update(chunk)
+        part.update(chunk)
+        filled += len(chunk)
+        if filled == part_size:
+            part_digests.append(part.digest())
+            part = md5()
+            filled = 0
+    if filled:
+        part_digests.append(part.digest())
+    payload.seek(0)
+    if not part_size:
+        return whole.hexdigest(), whole.hexdigest()
+    etag = "{0}-{1}".format(md5(b"".join(part_digests)).hexdigest(),
+                            len(part_digests))
+    return whole.hexdigest(), etag
+
+
+def _etag_of_buffer(contents, part_size=None):
+    """_etag_of_file for contents already in memory, e.g. a memoryview"""
+    whole = md5(contents)
+    if not part_size:
+        return whole.hexdigest(), whole.hexdigest()
+    part_digests = [md5(contents[offset:offset + part_size]).digest()
+                    for offset in range(0, len(contents), part_size)]
+    etag = "{0}-{1}".format(md5(b"".join(part_digests)).hexdigest(),
+                            len(part_digests))
+    return whole.hexdigest(), etag
+
+
+class _Digests(object):
+    """
+    The (md5, etag) pairs of files hashed so far (see _etag_of_file), kept
+    for as long as each file's size and modification time are unchanged,
+    so that no file is hashed more than once in a deploy however many
+    things need its MD5. Gzipping works out the MD5 of a file as it goes,
+    which is added here too. Buffers aren't kept, but use their .md5
+    """
+
+    def __init__(self):
+        self._digests = {}
+        self._lock = Lock()
+
+    def _cached(self, filepath, part_size):
+        file_stat = stat(filepath)
+        stamp = (file_stat.st_mtime_ns, file_stat.st_size)
+        with self._lock:
+            cached_stamp, digests = self._digests.get(filepath, (None, {}))
+            if cached_stamp != stamp:
+                digests = {}
+                self._digests[filepath] = (stamp, digests)
+            return digests, digests.get(part_size)
+
+    def etag(self, payload, part_size=None):
+        if _is_file_object(payload):
+            return _etag_of_file(payload, part_size)
+        digests, cached = self._cached(payload, part_size)
+        if cached is None:
+            cached = _etag_of_file(payload, part_size)
+            with self._lock:
+                digests[part_size] = cached
+                digests.setdefault(None, (cached[0], cached[0]))
+        return cached
+
+    def md5(self, payload):
+        return self.etag(payload)[0]
+
+    def read(self, filepath):
+        """
+        A file's contents in a buffer, with its .md5, so that a payload sent
+        from memory is read once to be both hashed and sent
+        """
+        with open(filepath, "rb") as f:
+            contents = f.read()
+        digests, cached = self._cached(filepath, None)
+        if cached is None:
+            cached = _etag_of_buffer(contents)
+            with self._lock:
+                digests[None] = cached
+        buffer = BytesIO(contents)
+        buffer.md5 = cached[0]
+        return buffer
+
+    def add(self, filepath, file_md5):
+        if _is_file_object(filepath):
+            return
+        digests, _ = self._cached(filepath, None)
+        with self._lock:
+            digests[None] = (file_md5, file_md5)
+
+
+def _multipart_part_size(site_config, payload_size):
+    """
+    The part size to upload a payload with, or None if it should be PUT in
+    one request. Part sizes are raised if need be to stay within S3's limit
+    on the number of parts
+    """
+    threshold = site_config.get("multipart_threshold",
+                                DEFAULT_MULTIPART_THRESHOLD)
+    if payload_size < threshold:
+        return None
+    part_size = site_config.get("multipart_part_size",
+                                DEFAULT_MULTIPART_PART_SIZE)
+    return max(part_size, -(-payload_size // MAX_MULTIPART_PARTS))
+
+
+def _payload_matches_remote(payload, remote, part_size=None):
+    """
+    Compare the exact bytes that would be PUT against an object listed in the
+    bucket. Multipart ETags can only match if the payload would be uploaded
+    with the same part size
+    """
+    etag, size = remote
+    if _size_of_file(payload) != size:
+        return False
+    if "-" in etag and not part_size:
+        return False
+    return _etag_of_file(payload, part_size)[1] == etag
+
+
+class _Manifest(object):
+    """
+    Record of what the last deploy left in the bucket, kept between builds
+    (e.g. in $WERCKER_CACHE_DIR). Maps each destination key to the local
+    file's size and mtime, the MD5 of its contents and of the bytes actually
+    PUT (which differ when gzipped), the headers it was PUT with and the ETag
+    of the remote object. Files whose stat and headers are unchanged can then
+    be skipped without being read at all.
+
+    Only entries confirmed during the current deploy are written by save(),
+    so files which were removed or failed to upload drop out.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.loaded = False
+        self._previous = {}
+        self._current = {}
+        self._lock = Lock()
+        try:
+            with open(path) as manifest_file:
+                self._previous = load(manifest_file)
+            self.loaded = True
+            log.info("Loaded %d entries from manifest %s",
+                     len(self._previous), path)
+        except IOError:
+            log.info("No manifest found at %s, starting a new one", path)
+        except ValueError:
+            log.warning("Manifest %s is corrupt, starting a new one", path)
+
+    def remote_objects(self):
+        """The bucket contents as the manifest believes them to be"""
+        return {destination_key: (entry["etag"], entry["payload_size"])
+                for destination_key, entry in self._previous.items()}
+
+    def verify(self, remote_objects):
+        """Drop any entries which no longer agree with a bucket listing"""
+        stale = [destination_key
+                 for destination_key, entry in self._previous.items()
+                 if remote_objects.get(destination_key) !=
+                 (entry["etag"], entry["payload_size"])]
+        for destination_key in stale:
+            del self._previous[destination_key]
+        log.info("Manifest verified against bucket, %d stale entries "
+                 "dropped", len(stale))
+
+    def headers_match(self, destination_key, headers):
+        """
+        True if the object was last PUT with these headers. Objects with no
+        entry (a first deploy, or one dropped by verify) may have been PUT
+        with any headers, so they never match
+        """
+        entry = self._previous.get(destination_key)
+        return entry is not None and entry["headers"] == headers
+
+    def is_unchanged(self, destination_key, file_stat, headers, remote):
+        """
+        True if the file has the same size and mtime as last time, would be
+        PUT with the same headers, and the remote object is what was PUT.
+        Carries the entry forward into the new manifest if so
+        """
+        entry = self._previous.get(destination_key)
+        if (entry is None or remote is None or
+                entry["size"] != file_stat.st_size or
+                entry["mtime"] != file_stat.st_mtime or
+                entry["headers"] != headers or
+                (entry["etag"], entry["payload_size"]) != tuple(remote)):
+            return False
+        with self._lock:
+            self._current[destination_key] = entry
+        return True
+
+    def record(self, destination_key, file_stat, headers, content_md5,
+               payload_md5, payload_size, etag):
+        with self._lock:
+            self._current[destination_key] = {
+                "size": file_stat.st_size,
+                "mtime": file_stat.st_mtime,
+                "md5": content_md5,
+                "payload_md5": payload_md5,
+                "payload_size": payload_size,
+                "headers": headers,
+                "etag": etag}
+
+    def save(self):
+        temp_path = "{0}.tmp".format(self.path)
+        with self._lock:
+            with open(temp_path, "w") as manifest_file:
+                dump(self._current, manifest_file, sort_keys=True)
+            rename(temp_path, self.path)
+        log.info("Saved %d entries to manifest %s", len(self._current),
+                 self.path)
+
+
+def _headers_fingerprint(headers):
+    return md5(dumps(headers, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class _Journal(object):
+    """
+    Checkpoint of a deploy in progress, so that one which is interrupted can
+    be resumed without uploading again what it already had. Each object
+    confirmed in a bucket is appended as a line of JSON, with the MD5 of the
+    local file and a fingerprint of its headers. Lines are written as each
+    upload finishes, and synced to disk in batches (see
+    JOURNAL_SYNC_ENTRIES), by whichever thread completes one. A line torn
+    by the process being killed part way through writing it is dropped.
+
+    Files journaled by the last run are skipped while their content and
+    headers are unchanged, without the bucket being listed. discard() once
+    a deploy has fully succeeded, as the journal is then no longer needed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._previous = {}
+        self._lock = Lock()
+        self._unsynced = 0
+        self._synced = time()
+        try:
+            with open(path, "rb") as journal_file:
+                contents = journal_file.read()
+        except IOError:
+            contents = b""
+        complete = contents[:contents.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            try:
+                entry = loads(line.decode("utf-8"))
+                self._previous[entry["bucket"], entry["key"]] = (
+                    entry["md5"], entry["headers"])
+            except (ValueError, KeyError):
+                log.warning("Ignoring corrupt entry in journal %s", path)
+        if self._previous:
+            log.info("Resuming from %d entries in journal %s",
+                     len(self._previous), path)
+        self._file = open(path, "ab")
+        if len(complete) != len(contents):
+            self._file.truncate(len(complete))
+
+    def bucket(self, bucket_name):
+        return _BucketJournal(self, bucket_name)
+
+    def is_done(self, bucket_name, destination_key, content_md5, headers):
+        return self._previous.get((bucket_name, destination_key)) == \
+            (content_md5, _headers_fingerprint(headers))
+
+    def was_journaled(self, bucket_name, destination_key):
+        return (bucket_name, destination_key) in self._previous
+
+    def record(self, bucket_name, destination_key, content_md5, headers):
+        line = dumps({"bucket": bucket_name, "key": destination_key,
+                      "md5": content_md5,
+                      "headers": _headers_fingerprint(headers)},
+                     sort_keys=True)
+        with self._lock:
+            self._file.write(line.encode("utf-8") + b"\n")
+            self._unsynced += 1
+            if self._unsynced >= JOURNAL_SYNC_ENTRIES or \
+                    time() - self._synced >= JOURNAL_SYNC_INTERVAL:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced = time()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def discard(self):
+        self.close()
+        try:
+            remove(self.path)
+        except OSError:
+            pass
+        log.info("Deploy complete, discarded journal %s", self.path)
+
+
+class _BucketJournal(object):
+    """The entries of a _Journal for one bucket"""
+
+    def __init__(self, journal, bucket_name):
+        self.journal = journal
+        self.bucket_name = bucket_name
+
+    def is_done(self, destination_key, filepath, headers, digests):
+        if not self.journal.was_journaled(self.bucket_name, destination_key):
+            return False
+        return self.journal.is_done(self.bucket_name, destination_key,
+                                    digests.md5(filepath), headers)
+
+    def record(self, destination_key, content_md5, headers):
+        self.journal.record(self.bucket_name, destination_key, content_md5,
+                            headers)
+
+
+class _PreparedUpload(object):
+    """
+    Everything needed to send one object: its headers and payload (a filepath,
+    or a buffer of gzipped content), plus what the manifest should record
+    once it is in the bucket. Closing releases any buffer
+    """
+
+    def __init__(self, filepath, destination_key, headers, payload,
+                 payload_size, part_size, size=None):
+        self.filepath = filepath
+        self.destination_key = destination_key
+        self.headers = headers
+        self.payload = payload
+        self.payload_size = payload_size
+        self.part_size = part_size
+        # Before any gzipping
+        self.size = payload_size if size is None else size
+        self.manifest_entry = None
+        # The MD5 of the file, for the journal
+        self.content_md5 = None
+        self.metadata_only = False
+        # Sent from disk without being read into memory
+        self.streaming = False
+        # MD5 hex digest of the payload, if it is sent in one request
+        self.md5 = None
+
+    def read(self):
+        if not _is_file_object(self.payload):
+            with open(self.payload, "rb") as f:
+                return f.read()
+        self.payload.seek(0)
+        contents = self.payload.read()
+        self.payload.seek(0)
+        return contents
+
+    def record(self, manifest, journal=None):
+        if manifest is not None and self.manifest_entry is not None:
+            manifest.record(self.destination_key, *self.manifest_entry)
+        if journal is not None and self.content_md5 is not None:
+            journal.record(self.destination_key, self.content_md5,
+                           self.headers)
+
+    def close(self):
+        if _is_file_object(self.payload):
+            self.payload.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _prepare_upload(filepath, destination_key, site_config,
+                    remote_objects=None, manifest=None, compressor=None,
+                    metrics=None, streaming=False, digests=None,
+                    object_headers=_get_object_headers, journal=None):
+    """
+    Work out the headers and payload for a file, gzipping it if need be.
+    Returns a _PreparedUpload, or None if the file can be skipped. If
+    remote_objects (as returned by _list_remote_objects) is given, files are
+    skipped when the bucket already holds identical content. A _Manifest
+    allows files to be skipped on their stat alone, and if only the headers
+    have changed since the last deploy (or are unknown, as the file has no
+    entry) the upload is metadata_only, as the object can be copied onto
+    itself with new headers. compressor is used
+    in place of _compress_the_file if given, unless streaming, when the file
+    is gzipped straight to disk so that the upload is never held in memory.
+    Files are hashed at most once through digests (see _Digests), and the
+    MD5 of payloads sent in one request is kept as the upload's .md5. Those
+    not gzipped are read into memory unless streaming, to be hashed and
+    sent in a single read.
+    Headers are worked out by object_headers, which takes the same
+    arguments as _get_object_headers. Files a _BucketJournal shows were
+    already deployed unchanged are skipped, and otherwise the upload keeps
+    the file's .content_md5 to be journaled. Time spent is added to metrics
+    """
+    metrics = metrics or _NO_METRICS
+    digests = digests or _Digests()
+    with metrics.phase("headers"):
+        headers, should_gzip = object_headers(
+            filepath, destination_key, site_config)
+    if journal is not None:
+        with metrics.phase("hash"):
+            journaled = journal.is_done(destination_key, filepath, headers,
+                                        digests)
+        if journaled:
+            log.info("Skipped '%s' (journaled before the deploy was "
+                     "interrupted)", destination_key)
+            return None
+    remote = None
+    if remote_objects is not None:
+        remote = remote_objects.get(destination_key)
+    headers_changed = False
+    if manifest is not None:
+        file_stat = _stat_of(filepath)
+        if manifest.is_unchanged(destination_key, file_stat, headers,
+                                 remote):
+            log.info("Skipped '%s' (unchanged since last deploy)",
+                     destination_key)
+            return None
+        headers_changed = not manifest.headers_match(destination_key,
+                                                     headers)
+    payload = filepath
+    size = None
+    if should_gzip:
+        size = _size_of_file(filepath)
+        level = _gzip_level(site_config, filepath)
+        with metrics.phase("compress"):
+            if streaming:
+                payload = _compress_the_file(filepath, level, None)
+            else:
+                payload = (compressor or _compress_the_file)(filepath, level)
+    payload_size = _size_of_file(payload)
+    part_size = None
+    if not _is_file_object(payload):
+        part_size = _multipart_part_size(site_config, payload_size)
+        if not (part_size or streaming):
+            # Sent from the buffer it's hashed in, rather than read again
+            payload = digests.read(payload)
+    upload = _PreparedUpload(filepath, destination_key, headers, payload,
+                             payload_size, part_size, size)
+    upload.streaming = streaming
+    try:
+        with metrics.phase("hash"):
+            if getattr(payload, "source_md5", None):
+                digests.add(filepath, payload.source_md5)
+            if manifest is not None or not part_size:
+                payload_md5, etag = digests.etag(payload, part_size)
+                if not part_size:
+                    upload.md5 = payload_md5
+                unchanged = remote is not None and \
+                    tuple(remote) == (etag, payload_size)
+            else:
+                unchanged = remote is not None and \
+                    _payload_matches_remote(payload, remote, part_size)
+            if manifest is not None:
+                content_md5 = payload_md5
+                if should_gzip:
+                    content_md5 = digests.md5(filepath)
+                upload.manifest_entry = (file_stat, headers, content_md5,
+                                         payload_md5, payload_size, etag)
+            if journal is not None:
+                upload.content_md5 = digests.md5(filepath)
+    except Exception:
+        upload.close()
+        raise
+    if unchanged and headers_changed:
+        if part_size:
+            # Copying would replace the multipart ETag, so PUT it again
+            return upload
+        log.debug("Only the headers of '%s' have changed", destination_key)
+        upload.metadata_only = True
+        return upload
+    if unchanged:
+        log.info("Skipped '%s' (unchanged)", destination_key)
+        upload.record(manifest, journal)
+        upload.close()
+        return None
+    return upload
+
+
+def _send_upload(upload, buckets, limiter, helpers=None, memory=None):
+    """
+    PUT a _PreparedUpload to the bucket, returning the number of bytes sent.
+    Large files are uploaded in parts, each taking its own turn from limiter
+    (an _AdaptiveConcurrency), and those beyond the one the caller reserved
+    room for taking their own from memory (a _MemoryBudget), see
+    _multipart_upload_to_s3 for helpers. Otherwise the caller should
+    already have taken a turn
+    """
+    if upload.metadata_only:
+        _copy_upload(upload, buckets.get(), upload.destination_key)
+        return 0
+    if upload.part_size:
+        bytes_written = _multipart_upload_to_s3(
+            upload.payload, buckets, upload.destination_key, upload.headers,
+            upload.part_size, limiter, helpers, memory)
+        log.info("Uploaded '%s' in parts (transmitted %d bytes)",
+                 upload.destination_key, bytes_written)
+        return bytes_written
+    bytes_written = buckets.get().put(upload.destination_key, upload.payload,
+                                      upload.headers, upload.md5)
+    log.info("Uploaded '%s' (transmitted %d bytes)", upload.destination_key,
              bytes_written)
     return bytes_written
 
 
-def parallel_upload_dir_to_s3(local_directory, bucket_name, access_key_id,
-                              secret_access_key):
-    config = _get_s3site_config(local_directory)
-    files = _list_all_files_in_dir(local_directory)
-
-    def _threadsafe_upload_file_to_s3(filepath):
-        def _attempt_upload():
-            conn = S3Connection(access_key_id, secret_access_key)
-            s3_bucket = conn.get_bucket(bucket_name)
-            _upload_file_to_s3(join(local_directory, filepath), s3_bucket,
-                               filepath, config)
-            return True
-        for attempt in range(1, 5):
-            log.debug("Uploading %s (attempt %s)", filepath, attempt)
+def _copy_upload(upload, bucket, source_key):
+    """
+    Create a _PreparedUpload's object by copying source_key, which holds
+    identical content, within the bucket rather than sending its payload.
+    The source may be the object itself, to change only its headers
+    """
+    bucket.copy(upload.destination_key, source_key, upload.headers)
+    _log_copied(upload.destination_key, source_key)
+
+
+def _log_copied(destination_key, source_key):
+    if destination_key == source_key:
+        log.info("Updated headers of '%s' (copied in place)",
+                 destination_key)
+    else:
+        log.info("Uploaded '%s' (copied from '%s')", destination_key,
+                 source_key)
+
+
+class _MultipartUpload(object):
+    """
+    A multipart upload of a large file, whose parts any number of worker
+    threads can upload at once. The thread which starts the upload calls
+    help() and then finish(). Idle workers may also call help() to take
+    parts alongside it, so that a large file spreads across the pool as
+    workers free up. Each part is a request of its own within limiter's
+    concurrency (see _AdaptiveConcurrency), and is retried on its own with
+    backoff, so a failure never restarts the whole transfer. The caller is
+    expected to have reserved one part's size from memory (a _MemoryBudget)
+    already. Any parts sent alongside that one reserve their own, and idle
+    workers stop helping when there isn't room. Each thread uses its own
+    handle from buckets, reset after a transport error
+    """
+
+    def __init__(self, buckets, destination_key, filepath, part_size,
+                 headers, limiter, memory=None):
+        self.buckets = buckets
+        self.destination_key = destination_key
+        self.filepath = filepath
+        self.limiter = limiter
+        self.memory = memory or _MemoryBudget(None)
+        size = getsize(filepath)
+        self._parts = deque(
+            (part_number, offset, min(part_size, size - offset))
+            for part_number, offset in enumerate(range(0, size, part_size),
+                                                 1))
+        self._etags = {}
+        self._in_flight = 0
+        self._covered_part_in_flight = False
+        self._error = None
+        self._condition = Condition()
+        self.upload_id = buckets.get().start_multipart(destination_key,
+                                                       headers)
+        log.debug("Started multipart upload of '%s' in %d parts",
+                  destination_key, len(self._parts))
+
+    def help(self, wait=False):
+        """
+        Upload parts until there are none left, or one has failed. Unless
+        wait is true, returns early rather than wait for room in memory
+        """
+        while True:
+            with self._condition:
+                while True:
+                    if self._error is not None or not self._parts:
+                        return
+                    covered, reserved = self._room_for(self._parts[0][2])
+                    if covered or reserved is not None:
+                        break
+                    if not wait:
+                        return
+                    # Until the part using the caller's reservation is sent
+                    self._condition.wait()
+                part = self._parts.popleft()
+                self._in_flight += 1
             try:
-                return _attempt_upload()
-            except:
-                log.exception("Could not upload file %s after %s attempts",
-                              filepath, attempt)
-        return False
-    pool = ThreadPool(10)
-    results = pool.map(_threadsafe_upload_file_to_s3, files)
-    pool.close()
-    pool.join()
-    return all(results)
+                etag, error = self._upload_part(*part), None
+            except Exception as failure:
+                etag, error = None, failure
+            if reserved:
+                self.memory.release(reserved)
+            with self._condition:
+                self._in_flight -= 1
+                if covered:
+                    self._covered_part_in_flight = False
+                if error is not None:
+                    self._error = self._error or error
+                else:
+                    self._etags[part[0]] = etag
+                self._condition.notify_all()
+
+    def _room_for(self, size):
+        """
+        Find room in memory for a part of size, returning whether it uses the
+        caller's reservation, and otherwise how much it reserved, or None if
+        there isn't room yet. Parts too large for the budget reserve nothing
+        """
+        if not self._covered_part_in_flight:
+            self._covered_part_in_flight = True
+            return True, 0
+        if not self.memory.fits(size):
+            return False, 0
+        if self.memory.try_reserve(size):
+            return False, size
+        return False, None
+
+    def _upload_part(self, part_number, offset, size):
+        """
+        Upload a part, returning its ETag, or raising the error it last
+        failed with once retrying can't help or it has had UPLOAD_ATTEMPTS
+        """
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            token = self.limiter.acquire()
+            try:
+                with open(self.filepath, "rb") as f:
+                    f.seek(offset)
+                    etag = self.buckets.get().put_part(
+                        self.destination_key, self.upload_id, part_number, f,
+                        size)
+            except Exception as error:
+                self.limiter.release(token, error=error)
+                log.exception("Could not upload part %d of %s after %s "
+                              "attempts", part_number, self.destination_key,
+                              attempt)
+                if isinstance(error, TRANSPORT_ERRORS):
+                    self.buckets.reset()
+                if _classify_error(error) == FATAL or \
+                        attempt == UPLOAD_ATTEMPTS:
+                    raise
+                sleep(_backoff_delay(attempt))
+            else:
+                # Parts take far longer than requests for other files
+                self.limiter.release(token)
+                return etag
+
+    def finish(self):
+        """
+        Wait for any parts other threads are still uploading, then complete
+        the upload, or abort it and raise the error a part failed with
+        """
+        with self._condition:
+            while self._in_flight:
+                self._condition.wait()
+        bucket = self.buckets.get()
+        if self._error is not None:
+            bucket.cancel_multipart(self.destination_key, self.upload_id)
+            raise self._error
+        bucket.complete_multipart(self.destination_key, self.upload_id,
+                                  self._etags)
+
+
+def _multipart_upload_to_s3(filepath, buckets, destination_key, headers,
+                            part_size, limiter, helpers=None, memory=None):
+    """
+    Upload a file in parts. helpers, if given, is called with the upload's
+    help function so that it can be offered to idle workers
+    """
+    upload = _MultipartUpload(buckets, destination_key, filepath, part_size,
+                              headers, limiter, memory)
+    if helpers is not None:
+        helpers(upload.help)
+    upload.help(wait=True)
+    upload.finish()
+    return getsize(filepath)
+
+
+def _fail_fast(connection):
+    """
+    Stop boto retrying failed requests made on an S3Connection, as the
+    engines retry them, backing off and adapting their concurrency. Even
+    with retries off boto sleeps for up to a second after a server error
+    before giving up, so those are raised as soon as they are received
+    """
+    connection.num_retries = 0
+    new_http_connection = connection.new_http_connection
+
+    def _new_http_connection(*args, **kwargs):
+        http_connection = new_http_connection(*args, **kwargs)
+        getresponse = http_connection.getresponse
+
+        def _getresponse(*args, **kwargs):
+            response = getresponse(*args, **kwargs)
+            if response.status >= 500:
+                raise S3ResponseError(response.status, response.reason,
+                                      response.read())
+            return response
+        http_connection.getresponse = _getresponse
+        return http_connection
+    connection.new_http_connection = _new_http_connection
+    return connection
+
+
+class _S3Bucket(object):
+    """
+    Storage backend for a bucket in S3, through boto. The upload code only
+    stores objects through a backend, never with boto directly. Backends
+    offer put, the multipart operations (start_multipart, put_part,
+    complete_multipart and cancel_multipart), list, copy and delete, as
+    here, so that something other than S3 (e.g. a LocalBucket) can be
+    deployed to. Those that can be used from several threads at once give
+    a handle to each through get(), as _ThreadLocalBucket does
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.name = bucket.name
+        self.connection = bucket.connection
+
+    def put(self, key_name, payload, headers, md5=None):
+        """
+        Store payload, a filepath or an open binary file, returning the
+        number of bytes sent. Given the MD5 hex digest of payload, it isn't
+        read to hash it before being sent, and S3 checks it arrived intact
+        """
+        key = Key(self.bucket)
+        key.key = key_name
+        md5_digests = md5 and _boto_md5(md5)
+        if _is_file_object(payload):
+            return key.set_contents_from_file(
+                payload, headers=headers, rewind=True, md5=md5_digests)
+        return key.set_contents_from_filename(payload, headers=headers,
+                                              md5=md5_digests)
+
+    def start_multipart(self, key_name, headers):
+        """Start a multipart upload, returning its ID"""
+        return self.bucket.initiate_multipart_upload(key_name,
+                                                     headers=headers).id
+
+    def put_part(self, key_name, upload_id, part_number, fileobj, size):
+        """Upload size bytes from fileobj as a part, returning its ETag"""
+        multipart = MultiPartUpload(self.bucket)
+        multipart.key_name = key_name
+        multipart.id = upload_id
+        return multipart.upload_part_from_file(fileobj, part_number,
+                                               size=size).etag
+
+    def complete_multipart(self, key_name, upload_id, etags):
+        """Put together the parts, given a map of part number to ETag"""
+        parts = "".join(
+            "<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>".format(
+                part_number, etag)
+            for part_number, etag in sorted(etags.items()))
+        self.bucket.complete_multipart_upload(
+            key_name, upload_id,
+            "<CompleteMultipartUpload>{0}</CompleteMultipartUpload>".format(
+                parts))
+
+    def cancel_multipart(self, key_name, upload_id):
+        self.bucket.cancel_multipart_upload(key_name, upload_id)
+
+    def list(self):
+        """
+        A map of every key name to its (ETag, size). S3 returns the ETag
+        quoted, so the quotes are stripped here
+        """
+        return {key.name: (key.etag.strip('"'), key.size)
+                for key in self.bucket.list()}
+
+    def copy(self, key_name, source_key_name, headers):
+        """Create key_name from source_key_name, with headers in place"""
+        self.bucket.copy_key(key_name, self.name, source_key_name,
+                             metadata={}, headers=dict(headers))
+
+    def delete(self, key_names):
+        """
+        Delete up to DELETE_BATCH_SIZE keys, returning a (key, code,
+        message) for each that couldn't be deleted
+        """
+        result = self.bucket.delete_keys(key_names, quiet=True)
+        return [(error.key, error.code, error.message)
+                for error in result.errors]
+
+
+class _ThreadLocalBucket(object):
+    """
+    Gives each worker thread its own long lived S3Connection and bucket
+    handle, so the HTTP connection is kept alive across many uploads rather
+    than a new TCP and TLS handshake being made per file. The bucket isn't
+    validated, which saves a HEAD request. Call reset() after a transport
+    error so that the thread reconnects on its next get(). Connects to the
+    endpoint of region if given
+    """
+
+    def __init__(self, bucket_name, access_key_id, secret_access_key,
+                 region=None):
+        self.bucket_name = bucket_name
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        self.region = region
+        self._local = local()
+
+    def get(self):
+        bucket = getattr(self._local, "bucket", None)
+        if bucket is None:
+            log.debug("Opening new connection to bucket '%s'",
+                      self.bucket_name)
+            kwargs = {}
+            if self.region and self.region != DEFAULT_REGION:
+                kwargs["host"] = REGION_HOST.format(self.region)
+            conn = _fail_fast(S3Connection(self.access_key_id,
+                                           self.secret_access_key, **kwargs))
+            bucket = _S3Bucket(conn.get_bucket(self.bucket_name,
+                                               validate=False))
+            self._local.bucket = bucket
+        return bucket
+
+    def reset(self):
+        bucket = getattr(self._local, "bucket", None)
+        if bucket is not None:
+            bucket.connection.close()
+        self._local.bucket = None
+
+
+class LocalBucket(object):
+    """
+    Storage backend (see _S3Bucket) which keeps objects as files in a local
+    directory, each with a sidecar of its headers, ETag and size under
+    LOCAL_METADATA_DIRECTORY. Deploying to one is quick and needs no network
+    or credentials, for trying out and measuring the rest of the upload
+    pipeline on its own. latency seconds are slept before each request, to
+    see how the engines behave against a bucket some distance away.
+    Contents are checked against a given MD5 as S3 does, and ETags are
+    worked out the same way, including those of multipart uploads.
+
+    Pass one to parallel_upload_dir_to_s3 as its storage. As nothing is
+    kept per thread, get() gives the LocalBucket itself
+    """
+
+    def __init__(self, directory, latency=0.0):
+        self.directory = directory
+        self.bucket_name = self.name = directory
+        self.latency = latency
+
+    def get(self):
+        return self
+
+    def reset(self):
+        pass
+
+    def _request(self):
+        if self.latency:
+            sleep(self.latency)
+
+    def _path(self, key_name, *metadata):
+        if metadata:
+            return join(self.directory, LOCAL_METADATA_DIRECTORY,
+                        *metadata + (key_name,))
+        return join(self.directory, key_name)
+
+    def _write(self, path, chunks, expected_md5=None):
+        """
+        Write chunks to path atomically, returning their MD5 and size. If
+        their MD5 isn't expected_md5, path is left as it was
+        """
+        makedirs(dirname(path), exist_ok=True)
+        digest = md5()
+        size = 0
+        temp_path = "{0}.{1}.tmp".format(path, current_thread().ident)
+        with open(temp_path, "wb") as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        if expected_md5 and expected_md5 != digest.hexdigest():
+            remove(temp_path)
+            raise S3ResponseError(400, "Bad Request",
+                                  "<Error><Code>BadDigest</Code></Error>")
+        rename(temp_path, path)
+        return digest, size
+
+    def _write_metadata(self, key_name, headers, etag, size):
+        path = self._path(key_name, "objects") + ".json"
+        makedirs(dirname(path), exist_ok=True)
+        temp_path = "{0}.{1}.tmp".format(path, current_thread().ident)
+        with open(temp_path, "w") as f:
+            dump({"headers": headers, "etag": etag, "size": size}, f,
+                 sort_keys=True)
+        rename(temp_path, path)
+
+    def metadata(self, key_name):
+        """The headers, ETag and size an object was stored with"""
+        with open(self._path(key_name, "objects") + ".json") as f:
+            return load(f)
+
+    def put(self, key_name, payload, headers, md5=None):
+        self._request()
+        opened = payload if _is_file_object(payload) else \
+            open(payload, "rb")
+        try:
+            opened.seek(0)
+            digest, size = self._write(
+                self._path(key_name),
+                iter(lambda: opened.read(65536), b""), md5)
+        finally:
+            if opened is not payload:
+                opened.close()
+        self._write_metadata(key_name, dict(headers), digest.hexdigest(),
+                             size)
+        return size
+
+    def start_multipart(self, key_name, headers):
+        self._request()
+        upload_id = uuid4().hex
+        makedirs(self._path("", "uploads", upload_id), exist_ok=True)
+        with open(self._path("headers.json", "uploads", upload_id),
+                  "w") as f:
+            dump(headers, f)
+        return upload_id
+
+    def put_part(self, key_name, upload_id, part_number, fileobj, size):
+        self._request()
+        remaining = [size]
+
+        def _chunks():
+            while remaining[0]:
+                chunk = fileobj.read(min(65536, remaining[0]))
+                if not chunk:
+                    return
+                remaining[0] -= len(chunk)
+                yield chunk
+        digest, _ = self._write(
+            self._path(str(part_number), "uploads", upload_id), _chunks())
+        return '"{0}"'.format(digest.hexdigest())
+
+    def complete_multipart(self, key_name, upload_id, etags):
+        self._request()
+        part_paths = [self._path(str(part_number), "uploads", upload_id)
+                      for part_number in sorted(etags)]
+
+        def _chunks():
+            for part_path in part_paths:
+                with open(part_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(65536), b""):
+                        yield chunk
+        _, size = self._write(self._path(key_name), _chunks())
+        with open(self._path("headers.json", "uploads", upload_id)) as f:
+            headers = load(f)
+        part_md5s = b"".join(unhexlify(etags[part_number].strip('"'))
+                             for part_number in sorted(etags))
+        etag = "{0}-{1}".format(md5(part_md5s).hexdigest(), len(etags))
+        self._write_metadata(key_name, headers, etag, size)
+        self.cancel_multipart(key_name, upload_id)
+
+    def cancel_multipart(self, key_name, upload_id):
+        rmtree(self._path("", "uploads", upload_id), ignore_errors=True)
+
+    def list(self):
+        self._request()
+        listed = {}
+        for key_name in _iter_files_in_dir(self.directory):
+            if key_name.startswith(LOCAL_METADATA_DIRECTORY + "/"):
+                continue
+            try:
+                metadata = self.metadata(key_name)
+            except (IOError, ValueError):
+                # Put there by something else, so work out its ETag here
+                listed[key_name] = (_md5_of_file(self._path(key_name)),
+                                    getsize(self._path(key_name)))
+            else:
+                listed[key_name] = (metadata["etag"], metadata["size"])
+        return listed
+
+    def copy(self, key_name, source_key_name, headers):
+        self._request()
+        try:
+            source = self.metadata(source_key_name)
+            with open(self._path(source_key_name), "rb") as f:
+                self._write(self._path(key_name),
+                            iter(lambda: f.read(65536), b""))
+        except IOError:
+            raise S3ResponseError(404, "Not Found",
+                                  "<Error><Code>NoSuchKey</Code></Error>")
+        self._write_metadata(key_name, dict(headers), source["etag"],
+                             source["size"])
+
+    def delete(self, key_names):
+        self._request()
+        for key_name in key_names:
+            for path in (self._path(key_name),
+                         self._path(key_name, "objects") + ".json"):
+                try:
+                    remove(path)
+                except OSError:
+                    pass
+        return []
+
+
+def _classify_error(error):
+    """
+    Whether a failed request was THROTTLED (S3 is asking for fewer requests),
+    is worth retrying (RETRYABLE) or will only fail again (FATAL), such as
+    when access is denied
+    """
+    if not isinstance(error, BotoServerError):
+        # Transport errors, or a multipart upload which had to be abandoned
+        return RETRYABLE
+    if error.error_code in THROTTLE_ERROR_CODES or \
+            error.status in (429, 503):
+        return THROTTLED
+    if error.error_code in RETRYABLE_ERROR_CODES or error.status >= 500:
+        return RETRYABLE
+    return FATAL
+
+
+def _backoff_delay(attempt):
+    """
+    Seconds to wait before retrying after attempt failed, chosen at random
+    up to an exponentially growing ceiling, so that workers throttled at
+    the same time don't all retry together
+    """
+    return uniform(0, min(RETRY_MAX_DELAY,
+                          RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+class _AdaptiveConcurrency(object):
+    """
+    Limits how many requests are in flight, between minimum and maximum.
+    The limit grows by one each time a full limit's worth of requests
+    succeeds, as long as the smoothed latency stays near the best seen,
+    and is cut by CONCURRENCY_DECREASE when S3 throttles. Throttles from
+    requests which began before the last cut don't cut it again.
+
+    try_acquire() returns a token, or None if the limit has been reached,
+    which must be handed back to release() along with the request's latency
+    in seconds (if it is comparable with others) or the error it failed with
+    """
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = float(max(self.minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.changed = Condition(RLock())
+        # Called after each release, e.g. to wake an event loop which waits
+        # with try_acquire()
+        self.on_release = None
+        self._cuts = 0
+        self._latency = None
+        self._best_latency = None
+
+    def try_acquire(self):
+        with self.changed:
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+            return self._cuts
+
+    def acquire(self):
+        """Block until a request may be made, returning its token"""
+        with self.changed:
+            while True:
+                token = self.try_acquire()
+                if token is not None:
+                    return token
+                self.changed.wait()
+
+    def release(self, token, latency=None, error=None):
+        with self.changed:
+            self.in_flight -= 1
+            if error is not None:
+                if _classify_error(error) == THROTTLED and \
+                        token == self._cuts:
+                    self._cuts += 1
+                    self.limit = max(self.minimum,
+                                     self.limit * CONCURRENCY_DECREASE)
+                    log.info("Throttled by S3, reduced concurrency to %d",
+                             self.limit)
+            elif latency is not None:
+                self._grow(latency)
+            self.changed.notify_all()
+        if self.on_release is not None:
+            self.on_release()
+
+    def _grow(self, latency):
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += LATENCY_SMOOTHING * (latency - self._latency)
+        if self._best_latency is None or self._latency < self._best_latency:
+            self._best_latency = self._latency
+        if self._latency > self._best_latency * LATENCY_TOLERANCE:
+            return
+        previous = int(self.limit)
+        self.limit = min(self.maximum, self.limit + 1.0 / int(self.limit))
+        if int(self.limit) > previous:
+            log.debug("Increased concurrency to %d", self.limit)
+
+
+class _MemoryBudget(object):
+    """
+    Bounds how many bytes of file content uploads may hold in memory at
+    once, as compressed buffers or request bodies. Each file reserves its
+    size before it is read or gzipped, blocking until enough is free, and
+    releases it once uploaded. A file too large to ever fit (see fits())
+    doesn't reserve anything, and must be streamed from disk instead. Files
+    sent in parts reserve a part's size, as they are read a part at a time
+    (see _MultipartUpload). With
+    max_bytes of None there is no limit. Event loops which wait with
+    try_reserve() are woken through watch()
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.changed = Condition(RLock())
+        self._watchers = []
+
+    def fits(self, size):
+        return self.max_bytes is None or size <= self.max_bytes
+
+    def try_reserve(self, size):
+        with self.changed:
+            if self.max_bytes is not None and \
+                    self.used + size > self.max_bytes:
+                return False
+            self.used += size
+            return True
+
+    def reserve(self, size):
+        with self.changed:
+            while not self.try_reserve(size):
+                self.changed.wait()
+
+    def release(self, size):
+        with self.changed:
+            self.used -= size
+            self.changed.notify_all()
+            for watcher in self._watchers:
+                watcher()
+
+    def watch(self, watcher):
+        """
+        Call watcher after each release, from whichever thread released,
+        until unwatch()ed. It is called with the budget locked, so it should
+        only schedule work, e.g. with call_soon_threadsafe
+        """
+        with self.changed:
+            self._watchers.append(watcher)
+
+    def unwatch(self, watcher):
+        with self.changed:
+            self._watchers.remove(watcher)
+
+
+class _RetryQueue(object):
+    """
+    Hands out files to upload as (filepath, attempt) pairs: fresh ones from
+    files, interleaved with any whose upload failed once their backoff is
+    over, so that a failing file waits without holding up a worker. Each
+    file handed out must be reported done() or failed(). Files are given up
+    on after UPLOAD_ATTEMPTS, or once the deploy's retry budget is spent.
+    A file held back from files (see _Deduplicator) must be hold()ed, and
+    is handed out once release()d
+    """
+
+    def __init__(self):
+        self.retries = 0
+        self._files = 0
+        self._outstanding = 0
+        self._waiting = []
+        self._sequence = count()
+        self._changed = Condition()
+        self._budget_spent = False
+
+    def budget(self):
+        return RETRY_BUDGET_MIN + int(self._files * RETRY_BUDGET_RATIO)
+
+    def _take_retry(self, block):
+        with self._changed:
+            while True:
+                delay = None
+                if self._waiting:
+                    delay = self._waiting[0][0] - time()
+                    if delay <= 0:
+                        _, _, filepath, attempt = heappop(self._waiting)
+                        self._outstanding += 1
+                        return filepath, attempt
+                if not block or not (self._waiting or self._outstanding):
+                    return None
+                self._changed.wait(delay)
+
+    def schedule(self, files):
+        """
+        Yield files to upload until every one has been uploaded or given up
+        on. Once files is exhausted this blocks until retries are due
+        """
+        for filepath in files:
+            retry = self._take_retry(block=False)
+            while retry is not None:
+                yield retry
+                retry = self._take_retry(block=False)
+            with self._changed:
+                self._files += 1
+                self._outstanding += 1
+            yield filepath, 1
+        while True:
+            retry = self._take_retry(block=True)
+            if retry is None:
+                return
+            yield retry
+
+    def hold(self):
+        with self._changed:
+            self._files += 1
+            self._outstanding += 1
+
+    def release(self, filepath):
+        with self._changed:
+            self._outstanding -= 1
+            heappush(self._waiting, (time(), next(self._sequence), filepath,
+                                     1))
+            self._changed.notify_all()
+
+    def done(self):
+        with self._changed:
+            self._outstanding -= 1
+            self._changed.notify_all()
+
+    def failed(self, filepath, attempt, error):
+        """
+        Queue filepath to be retried after a backoff, returning False if it
+        won't be retried
+        """
+        with self._changed:
+            self._outstanding -= 1
+            self._changed.notify_all()
+            if attempt >= UPLOAD_ATTEMPTS or _classify_error(error) == FATAL:
+                return False
+            if self.retries >= self.budget():
+                if not self._budget_spent:
+                    log.warning("Retry budget of %d spent, no more failed "
+                                "uploads will be retried", self.retries)
+                    self._budget_spent = True
+                return False
+            self.retries += 1
+            heappush(self._waiting, (time() + _backoff_delay(attempt),
+                                     next(self._sequence), filepath,
+                                     attempt + 1))
+            return True
+
+
+class _Deduplicator(object):
+    """
+    Spots files whose content was already found under another key as they
+    are walked, so that only the first (the source) is uploaded and the
+    rest are copied from it within S3, each with its own headers. Files are
+    hashed as they are found, and duplicates are held back until their
+    source has finished: if it failed they are uploaded as usual. Only files
+    which would be sent identically, gzipped the same way and in a single
+    request, are deduplicated
+    """
+
+    def __init__(self, deploy):
+        self.deploy = deploy
+        self.sources = {}
+        self._retries = None
+        self._first = {}
+        self._held = {}
+        self._succeeded = set()
+        self._lock = Lock()
+
+    def _identity(self, filepath):
+        deploy = self.deploy
+        full_path = deploy.source(filepath)
+        headers, should_gzip = deploy.object_headers(full_path, filepath,
+                                                     deploy.config)
+        file_stat = _stat_of(full_path)
+        if file_stat.st_size < DEDUPLICATE_MIN_SIZE:
+            return None
+        if not should_gzip and \
+                _multipart_part_size(deploy.config, file_stat.st_size):
+            return None
+        if deploy.manifest is not None:
+            remote = None
+            if deploy.remote_objects is not None:
+                remote = deploy.remote_objects.get(filepath)
+            if deploy.manifest.is_unchanged(filepath, file_stat, headers,
+                                            remote):
+                return None
+        level = should_gzip and _gzip_level(deploy.config, full_path)
+        return deploy.digests.md5(full_path), level
+
+    def files(self, files, retries):
+        """Yield from files, holding duplicates back from retries"""
+        self._retries = retries
+        for filepath in files:
+            try:
+                with self.deploy.metrics.phase("deduplicate"):
+                    identity = self._identity(filepath)
+            except (IOError, OSError):
+                # Left for the upload to report
+                identity = None
+            if identity is not None:
+                with self._lock:
+                    source = self._first.setdefault(identity, filepath)
+                    if source == filepath:
+                        self._held[filepath] = []
+                    elif source in self._held:
+                        self._held[source].append(filepath)
+                        retries.hold()
+                        continue
+                    elif source in self._succeeded:
+                        self.sources[filepath] = source
+            yield filepath
+
+    def finished(self, filepath, outcome):
+        with self._lock:
+            held = self._held.pop(filepath, None)
+            if held is None:
+                return
+            if outcome != FAILED:
+                self._succeeded.add(filepath)
+                for duplicate in held:
+                    self.sources[duplicate] = filepath
+        for duplicate in held:
+            self._retries.release(duplicate)
+
+
+class DeploySummary(object):
+    """
+    Outcome of a deploy: how many objects were uploaded, skipped because
+    they were unchanged, and deleted by pruning, plus the keys of any which
+    never succeeded, along with the last error for each in errors, and any
+    stale objects which could not be deleted. error is set if the deploy
+    was stopped altogether, or couldn't read all of the site. Truthy only if
+    nothing failed
+    """
+
+    def __init__(self):
+        self.uploaded = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.failed = []
+        self.errors = {}
+        self.failed_deletes = []
+        self.error = None
+
+    def record(self, destination_key, outcome, error=None):
+        if outcome == UPLOADED:
+            self.uploaded += 1
+        elif outcome == SKIPPED:
+            self.skipped += 1
+        else:
+            self.failed.append(destination_key)
+            self.errors[destination_key] = error
+
+    def record_deletes(self, keys, not_deleted):
+        self.deleted += len(keys) - len(not_deleted)
+        self.failed_deletes.extend(not_deleted)
+
+    def __bool__(self):
+        return not (self.failed or self.failed_deletes or self.error)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return ("<DeploySummary uploaded={0} skipped={1} deleted={2} "
+                "failed={3}>").format(
+            self.uploaded, self.skipped, self.deleted,
+            len(self.failed) + len(self.failed_deletes))
+
+
+class FanOutSummary(dict):
+    """
+    Outcome of a deploy to several buckets: a DeploySummary for each, by
+    bucket name. Counts are totals across the buckets, and failed keys
+    are given as "bucket/key". Truthy only if every bucket's deploy is
+    """
+
+    def _total(self, name):
+        return sum(getattr(summary, name) for summary in self.values())
+
+    def _keys(self, name):
+        return ["{0}/{1}".format(bucket_name, key)
+                for bucket_name, summary in self.items()
+                for key in getattr(summary, name)]
+
+    uploaded = property(lambda self: self._total("uploaded"))
+    skipped = property(lambda self: self._total("skipped"))
+    deleted = property(lambda self: self._total("deleted"))
+    failed = property(lambda self: self._keys("failed"))
+    failed_deletes = property(lambda self: self._keys("failed_deletes"))
+
+    def __bool__(self):
+        return all(self.values())
+    __nonzero__ = __bool__
+
+
+class _Metrics(object):
+    """
+    Where a deploy's time goes. Time spent in each phase (walking, matching
+    headers, gzipping, hashing, uploading, and so on) is summed across every
+    thread, along with how often it was entered. Each uploaded object's
+    request latency and size before and after compression is kept, and how
+    many attempts each file took, by bucket_name so that the deploys to
+    several buckets can share one _Metrics. report() puts this together for
+    JSON
+    """
+
+    def __init__(self):
+        self.started = time()
+        self.phases = {}
+        self.objects = {}
+        self.attempts = {}
+        self._lock = Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += seconds
+            phase[1] += 1
+
+    @contextmanager
+    def phase(self, name):
+        started = time()
+        try:
+            yield
+        finally:
+            self.add(name, time() - started)
+
+    def timed(self, name, iterable):
+        """Yield from iterable, counting the time taken by it as phase name"""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def attempt(self, filepath, bucket_name=None):
+        with self._lock:
+            key = (bucket_name, filepath)
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+
+    def uploaded(self, upload, seconds, copied=False, bucket_name=None):
+        with self._lock:
+            self.objects[(bucket_name, upload.destination_key)] = (
+                seconds, upload.size, upload.payload_size,
+                0 if copied else upload.payload_size)
+
+    def report(self, summary):
+        latencies = sorted(seconds * 1e3 for seconds, _, _, _ in
+                           self.objects.values())
+        histogram = [[bound, 0] for bound in LATENCY_BUCKETS]
+        histogram.append([None, 0])
+        for latency in latencies:
+            for bucket in histogram:
+                if bucket[0] is None or latency <= bucket[0]:
+                    bucket[1] += 1
+                    break
+
+        def _percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1,
+                                 int(fraction * len(latencies)))]
+        slowest = sorted(self.objects.items(), key=lambda item: -item[1][0])
+        return {
+            "seconds": time() - self.started,
+            "phases": dict(
+                (name, {"seconds": seconds, "count": count})
+                for name, (seconds, count) in self.phases.items()),
+            "objects": {"uploaded": summary.uploaded,
+                        "skipped": summary.skipped,
+                        "deleted": summary.deleted,
+                        "failed": sorted(summary.failed),
+                        "failed_deletes": sorted(summary.failed_deletes)},
+            "bytes": {
+                "before_compression": sum(
+                    size for _, size, _, _ in self.objects.values()),
+                "after_compression": sum(
+                    payload_size for _, _, payload_size, _ in
+                    self.objects.values()),
+                "transmitted": sum(
+                    transmitted for _, _, _, transmitted in
+                    self.objects.values())},
+            "retries": sum(self.attempts.values()) - len(self.attempts),
+            "latency_ms": {
+                "p50": _percentile(0.5),
+                "p90": _percentile(0.9),
+                "p99": _percentile(0.99),
+                "max": latencies[-1] if latencies else None,
+                "histogram": [{"le": bound, "count": count}
+                              for bound, count in histogram]},
+            "slowest": [
+                {"bucket": bucket_name, "key": key, "ms": seconds * 1e3,
+                 "bytes": size, "transmitted": transmitted,
+                 "attempts": self.attempts.get((bucket_name, key), 1)}
+                for (bucket_name, key), (seconds, size, _, transmitted) in
+                slowest[:SLOWEST_OBJECTS]]}
+
+    def save(self, path, summary):
+        with open(path, "w") as f:
+            dump(self.report(summary), f, indent=2, sort_keys=True)
+        log.info("Wrote metrics report to %s", path)
+
+
+class _NoMetrics(_Metrics):
+    """Metrics for when nobody is counting"""
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def add(self, name, seconds):
+        pass
+
+    def attempt(self, filepath, bucket_name=None):
+        pass
+
+    def uploaded(self, upload, seconds, copied=False, bucket_name=None):
+        pass
+
+
+_NO_METRICS = _NoMetrics()
+
+
+@contextmanager
+def _profiled(path):
+    """
+    Capture a cProfile of everything run inside, in every thread started
+    meanwhile as well as this one, and write the combined stats to path
+    """
+    profiles = []
+
+    def _profile_thread(*args):
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        profile.enable()
+    profile = cProfile.Profile()
+    profiles.append(profile)
+    setprofile(_profile_thread)
+    profile.enable()
+    try:
+        yield
+    finally:
+        setprofile(None)
+        for thread_profile in profiles:
+            thread_profile.disable()
+        stats = pstats.Stats(profiles[0])
+        for thread_profile in profiles[1:]:
+            stats.add(thread_profile)
+        stats.dump_stats(path)
+        log.info("Wrote profile of %d threads to %s", len(profiles), path)
+
+
+def _bounded(iterable, slots):
+    """
+    Yield from iterable, but only once one of slots (a Semaphore) is free.
+    Whoever processes each item must release a slot when done with it
+    """
+    for item in iterable:
+        slots.acquire()
+        yield item
+
+
+def _remembering(iterable, seen):
+    """Yield from iterable, adding each item to the set seen"""
+    for item in iterable:
+        seen.add(item)
+        yield item
+
+
+class _AsyncS3Client(object):
+    """
+    A minimal HTTP/1.1 client for PUTting objects from asyncio, so that
+    hundreds of requests can be in flight on one thread. Requests are built
+    and signed by boto, so credentials and signing behave exactly as they do
+    for the thread pool engine, and are sent over a pool of keep-alive
+    connections. Connecting, and each read or write, times out after the
+    same number of seconds as boto's sockets do, raising SocketTimeout, so
+    a stalled connection is retried like any other transport error
+    """
+
+    def __init__(self, connection, bucket_name, max_connections,
+                 timeout=None):
+        self.connection = connection
+        self.bucket_name = bucket_name
+        self.timeout = timeout or connection.http_connection_kwargs.get(
+            "timeout", ASYNCIO_SOCKET_TIMEOUT)
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _io(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise SocketTimeout("No progress in {0} seconds".format(
+                self.timeout))
+
+    def _build_request(self, method, key_name, headers, body):
+        conn = self.connection
+        calling_format = conn.calling_format
+        request = conn.build_base_http_request(
+            method,
+            calling_format.build_path_base(self.bucket_name, key_name),
+            calling_format.build_auth_path(self.bucket_name, key_name),
+            headers=headers, data=body,
+            host=calling_format.build_host(conn.server_name(),
+                                           self.bucket_name))
+        request.authorize(connection=conn)
+        return request
+
+    async def _connect(self, request):
+        if self._idle:
+            return self._idle.pop(), True
+        context = ssl.create_default_context() if \
+            self.connection.is_secure else None
+        connection = await self._io(asyncio.open_connection(
+            request.host.split(":")[0], request.port, ssl=context))
+        return connection, False
+
+    async def _exchange(self, connection, request):
+        reader, writer = connection
+        lines = ["{0} {1} HTTP/1.1".format(request.method, request.path),
+                 "Host: {0}".format(request.host)]
+        lines.extend("{0}: {1}".format(name, value)
+                     for name, value in request.headers.items()
+                     if name.lower() != "host")
+        writer.write("\r\n".join(lines).encode("latin-1") + b"\r\n\r\n")
+        # Written in chunks, so that a stall is noticed however large it is
+        body = memoryview(request.body)
+        for offset in range(0, len(body), 65536):
+            writer.write(body[offset:offset + 65536])
+            await self._io(writer.drain())
+        await self._io(writer.drain())
+        status_line = await self._io(reader.readline())
+        if not status_line:
+            raise ConnectionResetError("Connection closed by server")
+        _, status, reason = status_line.decode("latin-1").rstrip(
+            "\r\n").split(" ", 2)
+        headers = {}
+        while True:
+            line = await self._io(reader.readline())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await self._io(reader.readline())).split(
+                    b";")[0], 16)
+                body += await self._io(reader.readexactly(size + 2))
+                if not size:
+                    break
+        else:
+            body = await self._io(reader.readexactly(
+                int(headers.get("content-length", 0))))
+        return int(status), reason, headers, body
+
+    async def _send(self, method, key_name, body, headers):
+        request = self._build_request(method, key_name, headers, body)
+        async with self._slots:
+            connection, reused = await self._connect(request)
+            try:
+                response = await self._exchange(connection, request)
+            except (OSError, EOFError):
+                connection[1].close()
+                if not reused:
+                    raise
+                # The server may have timed out an idle connection
+                connection, _ = await self._connect(request)
+                try:
+                    response = await self._exchange(connection, request)
+                except BaseException:
+                    connection[1].close()
+                    raise
+            except BaseException:
+                connection[1].close()
+                raise
+            status, reason, response_headers, response_body = response
+            if response_headers.get("connection", "").lower() == "close":
+                connection[1].close()
+            else:
+                self._idle.append(connection)
+        if status != 200:
+            raise S3ResponseError(status, reason, response_body)
+        return response_headers, response_body
+
+    async def put(self, key_name, body, headers, content_md5=None):
+        """
+        PUT an object, returning its ETag. Given the MD5 hex digest of body,
+        S3 checks that it arrived intact
+        """
+        if content_md5:
+            headers = dict(headers)
+            headers["Content-MD5"] = _boto_md5(content_md5)[1]
+        response_headers, _ = await self._send("PUT", key_name, body,
+                                               headers)
+        return response_headers.get("etag")
+
+    async def copy(self, key_name, source_key_name, headers):
+        """Copy an object within the bucket, giving the copy headers"""
+        headers = dict(headers)
+        headers["x-amz-copy-source"] = "{0}/{1}".format(
+            self.bucket_name, quote(source_key_name.encode("utf-8")))
+        headers["x-amz-metadata-directive"] = "REPLACE"
+        _, body = await self._send("PUT", key_name, b"", headers)
+        # Copies can fail after S3 has already answered 200
+        if b"<Error>" in body:
+            raise S3ResponseError(200, "Copy failed", body)
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+class _Deploy(object):
+    """
+    What every upload in one deploy shares: where files come from, the site
+    config, connections to the bucket, what is known about its contents,
+    and how uploads are carried out. Requests start at concurrency at once,
+    adapting up to max_concurrency (see _AdaptiveConcurrency), and the
+    engines run as many workers as the largest of these. Files in memory
+    are kept within memory_budget bytes (see _MemoryBudget). With
+    deduplicate, files with the same content as another are copied (see
+    _Deduplicator). Given shared, a _PreparationConsumer, headers and
+    gzipped output come from it, and compressor isn't used. Given a
+    journal, what is confirmed in the bucket is recorded there, and what
+    it already holds is skipped (see _Journal). Given an _Archive, files
+    come from it rather than local_directory
+    """
+
+    def __init__(self, local_directory, config, buckets, remote_objects=None,
+                 manifest=None, compressor=None, concurrency=WORKERS,
+                 max_concurrency=None, deduplicate=False, metrics=None,
+                 memory_budget=None, digests=None, shared=None,
+                 journal=None, archive=None):
+        self.local_directory = local_directory
+        self.config = config
+        self.buckets = buckets
+        self.remote_objects = remote_objects
+        self.manifest = manifest
+        self.compressor = compressor
+        self.concurrency = max(concurrency, max_concurrency or 0)
+        self.limiter = _AdaptiveConcurrency(concurrency, self.concurrency)
+        self.deduplicator = _Deduplicator(self) if deduplicate else None
+        self.metrics = metrics or _NO_METRICS
+        self.memory = _MemoryBudget(memory_budget)
+        self.digests = digests or _Digests()
+        self.shared = shared
+        self.journal = journal and journal.bucket(buckets.bucket_name)
+        self.archive = archive
+        self.object_headers = _get_object_headers
+        if shared is not None:
+            self.compressor = shared
+            self.object_headers = shared.headers
+
+    def discover(self, files, retries):
+        if self.deduplicator is None:
+            return files
+        return self.deduplicator.files(files, retries)
+
+    def copy_source(self, upload):
+        if upload.metadata_only:
+            return upload.destination_key
+        if self.deduplicator is None or upload.part_size:
+            return None
+        return self.deduplicator.sources.get(upload.destination_key)
+
+    def finished(self, filepath, outcome):
+        if self.deduplicator is not None:
+            self.deduplicator.finished(filepath, outcome)
+        if self.archive is not None:
+            self.archive.finished(filepath)
+
+    def source(self, filepath):
+        """The full path of a file, or a handle on it in the archive"""
+        if self.archive is not None:
+            return self.archive.open(filepath)
+        return join(self.local_directory, filepath)
+
+    def memory_needed(self, filepath):
+        """
+        How much of the memory budget to reserve before preparing filepath,
+        or None if it doesn't fit in the budget and so must be streamed.
+        Files large enough to be sent in parts need only one part's size
+        """
+        if self.archive is not None:
+            size = self.archive.size(filepath)
+        else:
+            size = getsize(join(self.local_directory, filepath))
+            size = min(size, _multipart_part_size(self.config, size) or size)
+        if not self.memory.fits(size):
+            log.debug("Streaming %s, as it is larger than the memory budget",
+                      filepath)
+            return None
+        return size
+
+    def prepare_upload(self, filepath, streaming=False):
+        self.metrics.attempt(filepath, self.buckets.bucket_name)
+        full_path = self.source(filepath)
+        try:
+            return _prepare_upload(
+                full_path, filepath, self.config, self.remote_objects,
+                self.manifest, self.compressor, self.metrics, streaming,
+                self.digests, self.object_headers, self.journal)
+        finally:
+            if self.shared is not None:
+                self.shared.done(full_path)
+
+    def in_parts(self, upload):
+        """
+        True if upload is sent in parts, each of which takes a turn from the
+        limiter itself, so none should be taken for the upload as a whole
+        """
+        return bool(upload.part_size) and self.copy_source(upload) is None
+
+    def send(self, upload, helpers=None):
+        source = self.copy_source(upload)
+        token = None
+        if not self.in_parts(upload):
+            token = self.limiter.acquire()
+        started = time()
+        try:
+            if source is None:
+                bytes_written = _send_upload(upload, self.buckets,
+                                             self.limiter, helpers,
+                                             self.memory)
+            else:
+                _copy_upload(upload, self.buckets.get(), source)
+                bytes_written = 0
+        except Exception as error:
+            if token is not None:
+                self.limiter.release(token, error=error)
+            raise
+        elapsed = time() - started
+        self.metrics.add("upload", elapsed)
+        self.metrics.uploaded(upload, elapsed, copied=bool(source),
+                              bucket_name=self.buckets.bucket_name)
+        if token is not None:
+            self.limiter.release(token, elapsed)
+        return bytes_written
+
+    def upload_file(self, filepath, helpers=None):
+        reserved = self.memory_needed(filepath)
+        if reserved is not None:
+            self.memory.reserve(reserved)
+        try:
+            upload = self.prepare_upload(filepath, reserved is None)
+            if upload is None:
+                return None
+            with upload:
+                bytes_written = self.send(upload, helpers)
+        finally:
+            if reserved is not None:
+                self.memory.release(reserved)
+        upload.record(self.manifest, self.journal)
+        return bytes_written
+
+
+def _worker_count(deploy):
+    """
+    How many threads the threads engine uploads with: deploy.concurrency,
+    or more to keep every compression process busy, as each thread waits
+    for the file it is gzipping. Requests are still held to the limiter
+    """
+    return max(deploy.concurrency,
+               getattr(deploy.compressor, "processes", 0))
+
+
+def _upload_with_thread_pool(deploy, files, summary, pool=None):
+    """
+    Upload files on a pool of threads, one request per thread, recording
+    the outcomes in summary as they complete. files may be a generator;
+    only a few files per thread are taken from it ahead of being uploaded.
+    Failed uploads are retried alongside later files, see _RetryQueue.
+    Given a pool of _worker_count(deploy) threads, it is used and left
+    open, so that its threads' connections can be used again. The parts of
+    multipart uploads are shared with threads of their own, as the pool's
+    can only be handed work through files
+    """
+    buckets = deploy.buckets
+    workers = _worker_count(deploy)
+    slots = Semaphore(workers * PENDING_PER_WORKER)
+    own_pool = pool is None
+    # Threads are only started once there are parts to share. Each part
+    # waits for a turn from the limiter, so they add no requests beyond it
+    helpers = ThreadPoolExecutor(max(1, deploy.concurrency - 1),
+                                 thread_name_prefix="s3sitedeploy-part")
+
+    def _offer_to_idle_workers(work):
+        for _ in range(deploy.concurrency - 1):
+            helpers.submit(work)
+
+    def _threadsafe_upload_file_to_s3(work):
+        filepath, attempt = work
+        log.debug("Uploading %s (attempt %s)", filepath, attempt)
+        try:
+            bytes_written = deploy.upload_file(filepath,
+                                               _offer_to_idle_workers)
+        except Exception as error:
+            log.exception("Could not upload file %s after %s attempts",
+                          filepath, attempt)
+            if isinstance(error, TRANSPORT_ERRORS):
+                buckets.reset()
+            if retries.failed(filepath, attempt, error):
+                return filepath, None, None
+            return filepath, FAILED, error
+        else:
+            retries.done()
+            outcome = SKIPPED if bytes_written is None else UPLOADED
+            return filepath, outcome, None
+        finally:
+            slots.release()
+    retries = _RetryQueue()
+    if own_pool:
+        pool = ThreadPool(workers)
+    try:
+        for filepath, outcome, error in pool.imap_unordered(
+                _threadsafe_upload_file_to_s3,
+                _bounded(retries.schedule(deploy.discover(files, retries)),
+                         slots)):
+            if outcome is not None:
+                summary.record(filepath, outcome, error)
+                deploy.finished(filepath, outcome)
+    finally:
+        helpers.shutdown()
+        if own_pool:
+            pool.close()
+            pool.join()
+
+
+async def _async_upload_all(deploy, files, summary, executor, io_threads):
+    loop = asyncio.get_event_loop()
+    buckets = deploy.buckets
+    concurrency = deploy.concurrency
+    # Only S3 is sent to from the event loop itself, and other backends
+    # (which have no connection) from the I/O threads
+    client = None
+    connection = getattr(buckets.get(), "connection", None)
+    if connection is not None:
+        client = _AsyncS3Client(connection, buckets.bucket_name, concurrency)
+    # Files are found on their own thread, as walking a directory blocks
+    pending = asyncio.Queue(concurrency * PENDING_PER_WORKER)
+    finished = object()
+    retries = _RetryQueue()
+
+    def _feed_pending():
+        try:
+            for work in retries.schedule(deploy.discover(files, retries)):
+                asyncio.run_coroutine_threadsafe(
+                    pending.put(work), loop).result()
+        finally:
+            for _ in range(concurrency):
+                asyncio.run_coroutine_threadsafe(
+                    pending.put(finished), loop).result()
+    feeder = Thread(target=_feed_pending, name="s3sitedeploy-walk")
+    feeder.daemon = True
+
+    def _offer_to_idle_workers(work):
+        for _ in range(io_threads - 1):
+            executor.submit(work)
+
+    # Requests and memory are limited on the event loop, so wait on asyncio
+    # conditions rather than the limiter's and budget's own. Sends from the
+    # I/O threads, and the parts of multipart uploads, take their turns
+    # there, and the budget is shared with other deploys and their loops,
+    # so every release wakes the loop
+    limiter = deploy.limiter
+    limit_changed = asyncio.Condition()
+
+    async def _limit_released():
+        async with limit_changed:
+            limit_changed.notify_all()
+    limiter.on_release = lambda: asyncio.run_coroutine_threadsafe(
+        _limit_released(), loop)
+    memory = deploy.memory
+    memory_changed = asyncio.Condition()
+
+    async def _memory_released():
+        async with memory_changed:
+            memory_changed.notify_all()
+
+    def _wake_on_release():
+        asyncio.run_coroutine_threadsafe(_memory_released(), loop)
+    memory.watch(_wake_on_release)
+
+    async def _acquire():
+        async with limit_changed:
+            while True:
+                token = limiter.try_acquire()
+                if token is not None:
+                    return token
+                await limit_changed.wait()
+
+    async def _reserve(size):
+        async with memory_changed:
+            while not memory.try_reserve(size):
+                await memory_changed.wait()
+
+    async def _attempt_upload(filepath):
+        reserved = deploy.memory_needed(filepath)
+        if reserved is not None:
+            await _reserve(reserved)
+        try:
+            return await _prepare_and_send(filepath, reserved is None)
+        finally:
+            if reserved is not None:
+                memory.release(reserved)
+
+    async def _prepare_and_send(filepath, streaming):
+        upload = await loop.run_in_executor(executor, deploy.prepare_upload,
+                                            filepath, streaming)
+        if upload is None:
+            return SKIPPED
+        with upload:
+            source = deploy.copy_source(upload)
+            if client is None or (source is None and bool(
+                    upload.part_size or upload.streaming)):
+                # The I/O thread waits for its own turn (or each part's), so
+                # that no turn is held while waiting for a free thread
+                await loop.run_in_executor(executor, deploy.send, upload,
+                                           _offer_to_idle_workers)
+            else:
+                await _send_from_loop(upload, source)
+        upload.record(deploy.manifest, deploy.journal)
+        return UPLOADED
+
+    async def _send_from_loop(upload, source):
+        body = None
+        if source is None:
+            body = await loop.run_in_executor(executor, upload.read)
+        token = await _acquire()
+        started = loop.time()
+        try:
+            if source is not None:
+                await client.copy(upload.destination_key, source,
+                                  upload.headers)
+            else:
+                await client.put(upload.destination_key, body,
+                                 upload.headers, upload.md5)
+        except Exception as error:
+            limiter.release(token, error=error)
+            raise
+        elapsed = loop.time() - started
+        deploy.metrics.add("upload", elapsed)
+        deploy.metrics.uploaded(upload, elapsed, copied=bool(source),
+                                bucket_name=buckets.bucket_name)
+        limiter.release(token, elapsed)
+        if source is not None:
+            _log_copied(upload.destination_key, source)
+        else:
+            log.info("Uploaded '%s' (transmitted %d bytes)",
+                     upload.destination_key, upload.payload_size)
+
+    async def _worker():
+        while True:
+            work = await pending.get()
+            if work is finished:
+                return
+            filepath, attempt = work
+            log.debug("Uploading %s (attempt %s)", filepath, attempt)
+            try:
+                outcome = await _attempt_upload(filepath)
+            except Exception as error:
+                log.exception("Could not upload file %s after %s attempts",
+                              filepath, attempt)
+                if not retries.failed(filepath, attempt, error):
+                    summary.record(filepath, FAILED, error)
+                    deploy.finished(filepath, FAILED)
+            else:
+                retries.done()
+                summary.record(filepath, outcome)
+                deploy.finished(filepath, outcome)
+    feeder.start()
+    try:
+        await asyncio.gather(*[_worker() for _ in range(concurrency)])
+    finally:
+        limiter.on_release = None
+        memory.unwatch(_wake_on_release)
+        if client is not None:
+            client.close()
+
+
+def _upload_with_asyncio(deploy, files, summary):
+    """
+    Upload files from an asyncio event loop with up to concurrency requests
+    in flight, while reading, gzipping and hashing happen on a small fixed
+    pool of threads (enough to keep every compression process busy), which
+    also send to storage backends other than S3. Outcomes are recorded in
+    summary as they complete
+    """
+    io_threads = max(ASYNCIO_IO_THREADS,
+                     getattr(deploy.compressor, "processes", 0))
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(io_threads)
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(_async_upload_all(
+            deploy, files, summary, executor, io_threads))
+    finally:
+        executor.shutdown()
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def _shard_of(key, shard_count):
+    """
+    Which of shard_count shards a key belongs to. Keys are spread evenly by
+    hashing, with the same result on every machine and Python version
+    """
+    return int(md5(key.encode("utf-8")).hexdigest()[:16], 16) % shard_count
+
+
+def _stale_keys(remote_keys, local_keys, exclude=()):
+    """
+    The remote keys which aren't local, other than those matching any of
+    the regular expressions in exclude, in order
+    """
+    excluded = [compile(pattern) for pattern in exclude]
+    return sorted(key for key in remote_keys if key not in local_keys and
+                  not any(pattern.match(key) for pattern in excluded))
+
+
+def _retried(buckets, request, description):
+    """
+    Return request(bucket) for a bucket from buckets, retrying it with
+    backoff as uploads are, unless retrying can't help. As boto doesn't
+    retry (see _fail_fast), this is for requests other than uploads, which
+    have retries of their own. The last error is raised
+    """
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            return request(buckets.get())
+        except Exception as error:
+            log.warning("Could not %s (attempt %s): %s", description,
+                        attempt, error)
+            if isinstance(error, TRANSPORT_ERRORS):
+                buckets.reset()
+            if _classify_error(error) == FATAL or attempt == UPLOAD_ATTEMPTS:
+                raise
+            sleep(_backoff_delay(attempt))
+
+
+def _delete_batch(buckets, keys):
+    """
+    Delete up to DELETE_BATCH_SIZE keys with one DeleteObjects request,
+    retrying it with backoff. Returns the keys which could not be deleted
+    """
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            errors = buckets.get().delete(keys)
+        except Exception as error:
+            log.exception("Could not delete %d stale objects after %s "
+                          "attempts", len(keys), attempt)
+            if isinstance(error, TRANSPORT_ERRORS):
+                buckets.reset()
+            if _classify_error(error) == FATAL or attempt == UPLOAD_ATTEMPTS:
+                return list(keys)
+            sleep(_backoff_delay(attempt))
+        else:
+            for key, code, message in errors:
+                log.error("Could not delete '%s': %s %s", key, code, message)
+            log.info("Deleted %d stale objects", len(keys) - len(errors))
+            return [key for key, _, _ in errors]
+
+
+def _prune_stale_objects(buckets, stale_keys, concurrency, summary):
+    """
+    Delete stale_keys from the bucket in batches, making up to concurrency
+    DeleteObjects requests at once, and record the outcome in summary
+    """
+    batches = [stale_keys[start:start + DELETE_BATCH_SIZE]
+               for start in range(0, len(stale_keys), DELETE_BATCH_SIZE)]
+    pool = ThreadPool(concurrency)
+    try:
+        for batch, not_deleted in pool.imap_unordered(
+                lambda batch: (batch, _delete_batch(buckets, batch)),
+                batches):
+            summary.record_deletes(batch, not_deleted)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class _FanOut(object):
+    """
+    Walks files once, on a thread of its own, handing every item to each of
+    several consumers (see consumer()). No consumer gets more than
+    FAN_OUT_LEAD items ahead of the slowest, unless that one has stopped
+    taking them (see stop()). Errors from the walk are raised to every
+    consumer once it has had the items before them
+    """
+    _FINISHED = object()
+
+    def __init__(self, files, consumers):
+        self._files = files
+        self._queues = [Queue(FAN_OUT_LEAD) for _ in range(consumers)]
+        self._stopped = set()
+        self._error = None
+        self._thread = Thread(target=self._feed, name="s3sitedeploy-walk")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _feed(self):
+        try:
+            for item in self._files:
+                for index in range(len(self._queues)):
+                    self._put(index, item)
+        except Exception as error:
+            self._error = error
+        finally:
+            for index in range(len(self._queues)):
+                self._put(index, self._FINISHED)
+
+    def _put(self, index, item):
+        while index not in self._stopped:
+            try:
+                self._queues[index].put(item, timeout=WATCH_STOP_CHECK)
+                return
+            except Full:
+                pass
+
+    def consumer(self, index):
+        queue = self._queues[index]
+        while True:
+            item = queue.get()
+            if item is self._FINISHED:
+                break
+            yield item
+        if self._error is not None:
+            raise self._error
+
+    def stop(self, index):
+        self._stopped.add(index)
+
+
+def parallel_upload_dir_to_s3(local_directory, bucket_name, access_key_id,
+                              secret_access_key, incremental=False,
+                              manifest_path=None, verify_manifest=False,
+                              engine=THREADS_ENGINE, concurrency=WORKERS,
+                              compression_processes=None,
+                              compression_cache=None,
+                              compression_cache_size=None,
+                              max_concurrency=None, prune=False,
+                              deduplicate=False, metrics_report=None,
+                              shard_index=0, shard_count=1,
+                              memory_budget=DEFAULT_MEMORY_BUDGET,
+                              region=None, targets=None, journal_path=None,
+                              archive_directory="", storage=None):
+    """
+    Upload every file in local_directory to the bucket. In incremental mode
+    the bucket is listed once up front and only new or changed objects are
+    PUT. Giving a manifest_path implies incremental mode, but the bucket is
+    only listed if the manifest is missing or verify_manifest is set.
+
+    engine is either "threads", which makes concurrency requests at once
+    from a pool of that many threads, or "asyncio", which keeps concurrency
+    requests in flight from a single event loop. Given max_concurrency,
+    that grows while S3 keeps up, and whenever S3 throttles requests the
+    concurrency is cut back. Failed requests are retried with exponential
+    backoff, unless retrying can't help. Uploads hold at most about
+    memory_budget bytes of file content in memory at once (256MB by
+    default, or None for no limit), and larger files are streamed from
+    disk. Gzipping happens on compression_processes processes (by default
+    one per core), or on the upload threads if it is 0. Given a
+    compression_cache directory, compressed output is kept there (up to
+    compression_cache_size bytes, 512MB by default) and reused by later
+    deploys.
+
+    With prune, objects in the bucket which aren't in local_directory are
+    deleted once the upload is done, other than those matching one of the
+    prune_exclude expressions in s3sitedeploy.json. With deduplicate, files
+    whose content is the same as another's are created by copying it within
+    S3 rather than uploading it again. Given metrics_report, a JSON report
+    of where the time went is written there (see _Metrics).
+
+    Deploys can be split between shard_count machines: each deploys (and
+    prunes) only the keys in its own shard_index, counting from 0.
+
+    The bucket is in region, by default us-east-1. Given storage, a backend
+    such as a LocalBucket, files are deployed there instead, and bucket_name
+    and the credentials aren't used. targets is a list of further buckets
+    to deploy the same files to at the same time, as dicts with a
+    bucket_name and optionally a region, access_key_id and
+    secret_access_key (defaulting to the first bucket's credentials), or a
+    storage in place of all of those. Each
+    file is walked, has its headers matched and is gzipped once for all
+    of them, but every bucket is deployed to by its own workers, so one
+    failing or falling behind by more than FAN_OUT_LEAD files doesn't
+    hold back the rest. A manifest can only be used with one bucket.
+
+    Given a journal_path, each object confirmed in a bucket is recorded
+    there as the deploy goes, so that if it is interrupted, running it again
+    skips whatever was deployed and hasn't changed since (see _Journal).
+    The journal is removed once a deploy succeeds completely.
+
+    local_directory can also be a tar (which may be compressed) or zip of
+    the site, whose files are read straight out of it and deployed without
+    it being extracted to disk. Only the files under archive_directory
+    within it are deployed, along with its s3sitedeploy.json.
+
+    Returns a DeploySummary, or with targets a FanOutSummary
+    """
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine '{0}', expected one of {1}".format(
+            engine, ", ".join(ENGINES)))
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("Shard index {0} out of range for {1} shards".format(
+            shard_index, shard_count))
+    if manifest_path and targets:
+        raise ValueError("A manifest can't be used with several targets")
+    all_buckets = [storage or _ThreadLocalBucket(
+        bucket_name, access_key_id, secret_access_key, region)]
+    for target in targets or ():
+        all_buckets.append(target.get("storage") or _ThreadLocalBucket(
+            target["bucket_name"],
+            target.get("access_key_id", access_key_id),
+            target.get("secret_access_key", secret_access_key),
+            target.get("region")))
+    metrics = _Metrics()
+    archive = None
+    if isfile(local_directory):
+        # Files read out of the archive ahead of being uploaded are kept
+        # within half of the memory budget, and uploads within the rest
+        archive_budget = memory_budget and memory_budget // 2
+        archive = _Archive(local_directory, archive_directory,
+                           len(all_buckets), _MemoryBudget(archive_budget))
+        memory_budget = memory_budget and memory_budget - archive_budget
+    with metrics.phase("config"):
+        if archive is not None:
+            config = archive.config()
+        else:
+            config = _get_s3site_config(local_directory)
+    manifest = None
+    if manifest_path:
+        manifest = _Manifest(manifest_path)
+    must_list = incremental or verify_manifest or \
+        (manifest is not None and not manifest.loaded)
+    compressor = None
+    if compression_processes != 0:
+        compressor = _ProcessPoolCompressor(compression_processes)
+    digests = _Digests()
+    if compression_cache:
+        compressor = _CachingCompressor(
+            compression_cache,
+            compression_cache_size or DEFAULT_COMPRESSION_CACHE_SIZE,
+            compressor or _compress_the_file, digests)
+    journal = None
+    if journal_path:
+        journal = _Journal(journal_path)
+    shared = None
+    if targets:
+        shared = compressor = _SharedPreparation(len(all_buckets),
+                                                 compressor)
+    deploys = [
+        _Deploy(local_directory, config, buckets, None, manifest,
+                compressor, concurrency, max_concurrency, deduplicate,
+                metrics, memory_budget, digests,
+                shared and shared.consumer(index), journal,
+                archive and archive.consumer(index))
+        for index, buckets in enumerate(all_buckets)]
+    for deploy in deploys:
+        # One budget for memory however many buckets are deployed to
+        deploy.memory = deploys[0].memory
+    if shared is not None:
+        # Which also covers output kept for deploys yet to prepare a file
+        shared.memory = deploys[0].memory
+    upload = _upload_with_thread_pool
+    if engine == ASYNCIO_ENGINE:
+        upload = _upload_with_asyncio
+    if shard_count > 1:
+        log.info("Deploying shard %d of %d", shard_index + 1, shard_count)
+
+    def _in_shard(filepath):
+        return shard_count == 1 or \
+            _shard_of(filepath, shard_count) == shard_index
+    unreadable = []
+    if archive is not None:
+        # Files outside the shard aren't read out of the archive at all
+        files = archive.files(_in_shard)
+    else:
+        files = (filepath for filepath in
+                 _iter_files_in_dir(local_directory, unreadable=unreadable)
+                 if _in_shard(filepath))
+    files = metrics.timed("walk", files)
+    local_keys = set()
+    if prune:
+        files = _remembering(files, local_keys)
+
+    def _deploy_to(deploy, files, summary):
+        buckets = deploy.buckets
+        listed = None
+        if must_list:
+            with metrics.phase("list"):
+                deploy.remote_objects = listed = _list_remote_objects(
+                    buckets)
+            if manifest is not None:
+                manifest.verify(listed)
+        elif manifest is not None:
+            deploy.remote_objects = manifest.remote_objects()
+        with metrics.phase("deploy"):
+            upload(deploy, files, summary)
+        if unreadable:
+            summary.error = IOError("Could not read {0} in '{1}'".format(
+                ", ".join(sorted(unreadable)), local_directory))
+            if prune:
+                # Their files would look deleted, and be pruned
+                log.error("Not pruning, as some directories could not be "
+                          "read")
+            return
+        if not prune:
+            return
+        if not local_keys:
+            log.warning("Not pruning, as no files were found in '%s'",
+                        local_directory)
+            return
+        if listed is None:
+            with metrics.phase("list"):
+                listed = _list_remote_objects(buckets)
+        if shard_count > 1:
+            listed = [key for key in listed
+                      if _shard_of(key, shard_count) == shard_index]
+        stale_keys = _stale_keys(listed, local_keys,
+                                 config.get("prune_exclude", ()))
+        log.info("Pruning %d stale objects from '%s'", len(stale_keys),
+                 buckets.bucket_name)
+        with metrics.phase("prune"):
+            _prune_stale_objects(buckets, stale_keys, deploy.concurrency,
+                                 summary)
+
+    summary = DeploySummary()
+    try:
+        if not targets:
+            _deploy_to(deploys[0], files, summary)
+        else:
+            summary = _deploy_to_targets(deploys, files, _deploy_to)
+    finally:
+        if compressor is not None:
+            compressor.close()
+        if journal is not None:
+            journal.close()
+        if archive is not None:
+            archive.close()
+    if journal is not None:
+        if summary:
+            journal.discard()
+        else:
+            log.warning("Deploy incomplete, kept journal %s to resume from",
+                        journal_path)
+    if manifest is not None:
+        with metrics.phase("manifest"):
+            manifest.save()
+    summaries = summary if targets else {all_buckets[0].bucket_name: summary}
+    for target_bucket_name, target_summary in summaries.items():
+        if target_summary.error is not None:
+            log.error("Deploy to '%s' failed: %s", target_bucket_name,
+                      target_summary.error)
+        for destination_key in sorted(target_summary.failed):
+            log.error("Failed to upload '%s' to '%s': %s", destination_key,
+                      target_bucket_name,
+                      target_summary.errors[destination_key])
+    log.info("Deploy finished: %d uploaded, %d skipped, %d deleted, "
+             "%d failed", summary.uploaded, summary.skipped, summary.deleted,
+             len(summary.failed) + len(summary.failed_deletes))
+    if metrics_report:
+        metrics.save(metrics_report, summary)
+    return summary
+
+
+def _deploy_to_targets(deploys, files, deploy_to):
+    """
+    Run deploy_to(deploy, files, summary) for each of deploys at once, each
+    on a thread of its own and with its own DeploySummary, sharing one walk
+    of files. Returns the summaries as a FanOutSummary
+    """
+    fan_out = _FanOut(files, len(deploys))
+    summaries = FanOutSummary()
+
+    def _deploy(index, deploy, summary):
+        try:
+            deploy_to(deploy, fan_out.consumer(index), summary)
+        except Exception as error:
+            log.exception("Could not deploy to '%s'",
+                          deploy.buckets.bucket_name)
+            summary.error = error
+        finally:
+            fan_out.stop(index)
+            deploy.shared.retire()
+            if deploy.archive is not None:
+                deploy.archive.retire()
+    threads = []
+    for index, deploy in enumerate(deploys):
+        summary = summaries[deploy.buckets.bucket_name] = DeploySummary()
+        thread = Thread(target=_deploy, args=(index, deploy, summary),
+                        name="s3sitedeploy-{0}".format(
+                            deploy.buckets.bucket_name))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return summaries
+
+
+class _PollingWatcher(object):
+    """
+    Finds changed files by walking the directory every interval seconds and
+    comparing each file's modification time and size with the last walk.
+    Used where inotify isn't available
+    """
+
+    def __init__(self, directory, interval=WATCH_POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self._next_scan = time() + interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for relative_path in chain(_iter_files_in_dir(self.directory),
+                                   [CONFIG_FILENAME]):
+            try:
+                file_stat = stat(join(self.directory, relative_path))
+            except OSError:
+                continue
+            snapshot[relative_path] = (file_stat.st_mtime_ns,
+                                       file_stat.st_size)
+        return snapshot
+
+    def changes(self, timeout):
+        """
+        The paths, relative to the directory, of files created, changed or
+        removed since last called, waiting up to timeout seconds for any
+        """
+        wait = self._next_scan - time()
+        if wait > timeout:
+            sleep(timeout)
+            return set()
+        sleep(max(0, wait))
+        self._next_scan = time() + self.interval
+        previous, self._snapshot = self._snapshot, self._scan()
+        return set(
+            relative_path
+            for relative_path in set(previous) | set(self._snapshot)
+            if previous.get(relative_path) !=
+            self._snapshot.get(relative_path))
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher(object):
+    """
+    Finds changed paths with Linux's inotify, called through libc, watching
+    every directory under the directory as well as those created or moved
+    into it later. Changed paths may be files or whole directories, and
+    if events were lost the root ("") is reported as changed. Raises
+    OSError or AttributeError where inotify can't be used
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE)
+    # struct inotify_event, not counting its name
+    EVENT = Struct("iIII")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._libc = CDLL(None, use_errno=True)
+        fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(get_errno(), strerror(get_errno()))
+        self._events = open(fd, "rb", buffering=0)
+        self._watches = {}
+        try:
+            self._watch_tree("")
+        except Exception:
+            self.close()
+            raise
+
+    def _watch_tree(self, relative_dir):
+        """Watch relative_dir (ending in a slash, or "") and all under it"""
+        pending = [relative_dir]
+        while pending:
+            relative_dir = pending.pop()
+            wd = self._libc.inotify_add_watch(
+                self._events.fileno(),
+                fsencode(join(self.directory, relative_dir)), self.MASK)
+            if wd < 0:
+                error = OSError(get_errno(), strerror(get_errno()))
+                if not relative_dir:
+                    raise error
+                log.warning("Could not watch %s: %s", relative_dir, error)
+                continue
+            self._watches[wd] = relative_dir
+            try:
+                entries = scandir(join(self.directory, relative_dir))
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(relative_dir + entry.name + "/")
+
+    def _unwatch_tree(self, relative_dir):
+        for wd, watched in list(self._watches.items()):
+            if watched.startswith(relative_dir):
+                self._libc.inotify_rm_watch(self._events.fileno(), wd)
+                del self._watches[wd]
+
+    def changes(self, timeout):
+        """
+        The paths, relative to the directory, of files and directories
+        created, changed or removed since last called, waiting up to
+        timeout seconds for any
+        """
+        changed = set()
+        if not select([self._events], [], [], timeout)[0]:
+            return changed
+        data = self._events.read(65536) or b""
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                log.warning("Missed changes, so the whole directory will be "
+                            "deployed")
+                changed.add("")
+                continue
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            relative_dir = self._watches.get(wd)
+            if relative_dir is None or not name:
+                continue
+            relative_path = relative_dir + name
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_MOVED_FROM | self.IN_DELETE):
+                    self._unwatch_tree(relative_path + "/")
+                elif mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._watch_tree(relative_path + "/")
+            changed.add(relative_path)
+        return changed
+
+    def close(self):
+        self._events.close()
+
+
+def _watcher(directory, poll_interval=None):
+    """
+    An _InotifyWatcher for directory if possible, otherwise a
+    _PollingWatcher. Given a poll_interval, polling is always used
+    """
+    if poll_interval is None:
+        try:
+            return _InotifyWatcher(directory)
+        except (OSError, AttributeError) as error:
+            log.info("Can't use inotify (%s), polling for changes instead",
+                     error)
+    return _PollingWatcher(directory, poll_interval or WATCH_POLL_INTERVAL)
+
+
+def _next_batch(watcher, stop, debounce=WATCH_DEBOUNCE,
+                max_delay=WATCH_MAX_DELAY):
+    """
+    Wait for changes, then keep gathering them until none arrive for
+    debounce seconds, or max_delay has passed. Returns the changed paths,
+    which are empty only if stop was set while waiting
+    """
+    changed = set()
+    while not changed:
+        if stop.is_set():
+            return changed
+        changed = watcher.changes(WATCH_STOP_CHECK)
+    deadline = time() + max_delay
+    while time() < deadline:
+        more = watcher.changes(min(debounce, deadline - time()))
+        if not more:
+            break
+        changed |= more
+    return changed
+
+
+def _resolve_changes(directory, changed, known_keys):
+    """
+    Work out from changed paths (files or directories, which may no longer
+    exist, or "" for everything) which keys to upload and which to delete,
+    going by the keys known to have been deployed from directory. Nothing
+    under a directory which couldn't be read is deleted
+    """
+    to_upload = set()
+    to_delete = set()
+    for relative_path in changed:
+        prefix = relative_path + "/" if relative_path else ""
+        full_path = join(directory, relative_path)
+        if not relative_path or isdir(full_path):
+            unreadable = []
+            found = set(_iter_files_in_dir(directory, prefix, unreadable))
+            to_upload |= found
+            to_delete |= set(key for key in known_keys
+                             if key.startswith(prefix) and key not in found
+                             and not key.startswith(tuple(unreadable)))
+        elif relative_path == CONFIG_FILENAME:
+            continue
+        elif isfile(full_path):
+            to_upload.add(relative_path)
+        else:
+            to_delete |= set(key for key in known_keys
+                             if key == relative_path or
+                             key.startswith(prefix))
+    return to_upload, to_delete
+
+
+def _delete_keys(buckets, keys, summary):
+    """Delete keys from the bucket on this thread, recording in summary"""
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        summary.record_deletes(batch, _delete_batch(buckets, batch))
+
+
+def watch_dir_to_s3(local_directory, bucket_name, access_key_id,
+                    secret_access_key, concurrency=WORKERS,
+                    compression_processes=None, max_concurrency=None,
+                    prune=False, memory_budget=DEFAULT_MEMORY_BUDGET,
+                    debounce=WATCH_DEBOUNCE, poll_interval=None,
+                    stop=None, region=None):
+    """
+    Deploy local_directory incrementally, then keep watching it and deploy
+    each batch of changes as it happens, until stop (an Event) is set or
+    the process is interrupted. Changes are found with inotify, or by
+    walking the directory every poll_interval seconds where that isn't
+    available (or poll_interval is given), and batched until none have
+    arrived for debounce seconds. Only the files changed are uploaded, with
+    the same headers and gzipping as a full deploy; a change to
+    s3sitedeploy.json uploads everything again. With prune, the objects
+    of files removed from local_directory are deleted.
+
+    Uploads use the "threads" engine, on one pool of threads kept for the
+    whole time so that their connections to S3 stay open between batches
+    """
+    stop = stop or Event()
+    # Watch first, so nothing changed during the initial deploy is missed
+    watcher = _watcher(local_directory, poll_interval)
+    buckets = _ThreadLocalBucket(bucket_name, access_key_id,
+                                 secret_access_key, region)
+    compressor = None
+    if compression_processes != 0:
+        compressor = _ProcessPoolCompressor(compression_processes)
+    config = _get_s3site_config(local_directory)
+    listed = _list_remote_objects(buckets)
+    deploy = _Deploy(local_directory, config, buckets, listed,
+                     compressor=compressor, concurrency=concurrency,
+                     max_concurrency=max_concurrency,
+                     memory_budget=memory_budget)
+    pool = ThreadPool(_worker_count(deploy))
+    try:
+        known_keys = set()
+        unreadable = []
+        summary = DeploySummary()
+        _upload_with_thread_pool(
+            deploy, _remembering(_iter_files_in_dir(
+                local_directory, unreadable=unreadable), known_keys),
+            summary, pool)
+        if unreadable:
+            log.error("Not pruning, as some directories could not be read")
+        elif prune and known_keys:
+            _delete_keys(buckets, _stale_keys(
+                listed, known_keys, config.get("prune_exclude", ())),
+                summary)
+        log.info("Deployed %d, skipped %d unchanged and deleted %d, now "
+                 "watching '%s' for changes", summary.uploaded,
+                 summary.skipped, summary.deleted, local_directory)
+        # Everything from here on has changed, so compare nothing
+        deploy.remote_objects = None
+        while True:
+            changed = _next_batch(watcher, stop, debounce)
+            if not changed:
+                break
+            if CONFIG_FILENAME in changed:
+                try:
+                    deploy.config = _get_s3site_config(local_directory)
+                except (ValueError, ValidationError):
+                    # Perhaps saved half way, so wait for the next change
+                    log.exception("Keeping the previous configuration, as "
+                                  "%s is invalid", CONFIG_FILENAME)
+                    changed.discard(CONFIG_FILENAME)
+                    if not changed:
+                        continue
+                else:
+                    log.info("%s changed, deploying everything again",
+                             CONFIG_FILENAME)
+                    changed = set([""])
+            to_upload, to_delete = _resolve_changes(
+                local_directory, changed, known_keys)
+            summary = DeploySummary()
+            _upload_with_thread_pool(deploy, sorted(to_upload), summary,
+                                     pool)
+            known_keys |= to_upload
+            known_keys -= to_delete
+            if prune and to_delete:
+                _delete_keys(buckets, _stale_keys(
+                    to_delete, known_keys,
+                    deploy.config.get("prune_exclude", ())), summary)
+            log.info("Deployed %d changed paths: %d uploaded, %d deleted, "
+                     "%d failed", len(changed), summary.uploaded,
+                     summary.deleted,
+                     len(summary.failed) + len(summary.failed_deletes))
+    except KeyboardInterrupt:
+        log.info("Stopped watching '%s'", local_directory)
+    finally:
+        pool.close()
+        pool.join()
+        watcher.close()
+        if compressor is not None:
+            compressor.close()
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     e = extract_wercker_env_vars()
-    try:
-        local_directory = join(e["source_dir"], e["deploy_dir"])
-    except KeyError:
-        local_directory = e["source_dir"]
-    parallel_upload_dir_to_s3(
-        local_directory, e["bucket_name"], e["access_key_id"],
-        e["secret_access_key"])
+    archive_directory = ""
+    if e.get("archive"):
+        local_directory = join(e["source_dir"], e["archive"])
+        archive_directory = e.get("deploy_dir", "")
+    else:
+        try:
+            local_directory = join(e["source_dir"], e["deploy_dir"])
+        except KeyError:
+            local_directory = e["source_dir"]
+    cache_mb = _optional_int(e.get("compression_cache_size"))
+    budget_mb = _optional_int(e.get("memory_budget"))
+    memory_budget = (budget_mb * 1024 * 1024 if budget_mb
+                     else DEFAULT_MEMORY_BUDGET)
+    concurrency = _optional_int(e.get("concurrency")) or WORKERS
+    profile_path = environ.get(PROFILE_ENV_VAR)
+    if _is_true(e.get("watch", False)):
+        watch_dir_to_s3(
+            local_directory, e["bucket_name"], e["access_key_id"],
+            e["secret_access_key"],
+            concurrency=concurrency,
+            compression_processes=_optional_int(
+                e.get("compression_processes")),
+            max_concurrency=_optional_int(e.get("max_concurrency")),
+            prune=_is_true(e.get("prune", False)),
+            memory_budget=memory_budget,
+            region=e.get("region"))
+    else:
+        with _profiled(profile_path) if profile_path else nullcontext():
+            summary = parallel_upload_dir_to_s3(
+                local_directory, e["bucket_name"], e["access_key_id"],
+                e["secret_access_key"],
+                incremental=_is_true(e.get("incremental", False)),
+                manifest_path=e.get("manifest_path"),
+                verify_manifest=_is_true(e.get("verify_manifest", False)),
+                engine=e.get("engine", THREADS_ENGINE),
+                concurrency=concurrency,
+                max_concurrency=_optional_int(e.get("max_concurrency")),
+                memory_budget=memory_budget,
+                prune=_is_true(e.get("prune", False)),
+                deduplicate=_is_true(e.get("deduplicate", False)),
+                metrics_report=e.get("metrics_report"),
+                shard_index=int(e.get("shard_index", 0)),
+                shard_count=int(e.get("shard_count", 1)),
+                compression_processes=_optional_int(
+                    e.get("compression_processes")),
+                compression_cache=e.get("compression_cache"),
+                compression_cache_size=cache_mb and cache_mb * 1024 * 1024,
+                region=e.get("region"),
+                journal_path=e.get("journal_path"),
+                archive_directory=archive_directory,
+                targets=loads(e["targets"]) if e.get("targets") else None)
+        # Fail the step if anything wasn't deployed, so the build shows it
+        if not summary:
+            raise SystemExit(1)
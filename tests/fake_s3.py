@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+A small S3 stand-in served over real HTTP on localhost, for exercising the
+upload engines end to end without network access. Only path style requests
+for a single bucket are understood.
+
+A PUT's Content-MD5, if sent, is checked as S3 would. Latency can be
+added to every request, and PUTs throttled with 503 SlowDown
+at random (throttle_rate), or whenever more than max_in_flight are being
+handled at once, to see how the engines behave against a busy bucket.
+Listings can be throttled too (throttle_lists). How
+long each request took to handle is kept in timings, as (method, key,
+status, seconds) tuples.
+"""
+from base64 import b64encode
+from hashlib import md5
+from random import Random
+from time import sleep
+from timeit import default_timer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+from functools import partial
+from urllib.parse import unquote, urlsplit, parse_qs
+
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeS3Server(object):
+
+    def __init__(self, bucket_name, latency=0.0, throttle_rate=0.0,
+                 max_in_flight=None, seed=1):
+        self.bucket_name = bucket_name
+        self.objects = {}
+        self.requests = []
+        self.timings = []
+        # How many of the next PUTs to turn away with 503 SlowDown
+        self.throttle_puts = 0
+        # And the next listings
+        self.throttle_lists = 0
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._random = Random(seed)
+        self._lock = Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0),
+                                            partial(_Handler, self))
+        self.port = self._server.server_address[1]
+        self._thread = Thread(target=self._server.serve_forever,
+                              kwargs={"poll_interval": 0.05})
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def connection(self, *args, **kwargs):
+        """Drop in replacement for S3Connection which talks to this server"""
+        return S3Connection(
+            "fake-key-id", "fake-secret", host="127.0.0.1", port=self.port,
+            is_secure=False, calling_format=OrdinaryCallingFormat())
+
+    def put(self, key_name, body, headers):
+        etag = '"{0}"'.format(md5(body).hexdigest())
+        with self._lock:
+            self.objects[key_name] = (body, headers, etag)
+        return etag
+
+    def should_throttle(self):
+        with self._lock:
+            if self.throttle_puts > 0:
+                self.throttle_puts -= 1
+                return True
+            if self.max_in_flight is not None and \
+                    self.in_flight > self.max_in_flight:
+                return True
+            return self._random.random() < self.throttle_rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, fake, *args, **kwargs):
+        self.fake = fake
+        BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+    def log_message(self, *args):
+        pass
+
+    def parse_request(self):
+        self._started = default_timer()
+        if not BaseHTTPRequestHandler.parse_request(self):
+            return False
+        with self.fake._lock:
+            self.fake.in_flight += 1
+        if self.fake.latency:
+            sleep(self.fake.latency)
+        return True
+
+    def _key_name(self):
+        path = urlsplit(self.path).path
+        prefix = "/{0}/".format(self.fake.bucket_name)
+        if path == prefix[:-1]:
+            return ""
+        if not path.startswith(prefix):
+            return None
+        return unquote(path[len(prefix):])
+
+    def _query(self):
+        return parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+
+    def _respond(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.fake._lock:
+            self.fake.in_flight -= 1
+            self.fake.timings.append((self.command, self._key_name(), status,
+                                      default_timer() - self._started))
+
+    def _copy(self, key_name, copy_source):
+        source_key_name = unquote(copy_source.lstrip("/").split("/", 1)[1])
+        with self.fake._lock:
+            self.fake.requests.append(("COPY", key_name))
+            stored = self.fake.objects.get(source_key_name)
+        if stored is None:
+            return self._respond(404, b"<Error><Code>NoSuchKey</Code>"
+                                      b"</Error>")
+        etag = self.fake.put(key_name, stored[0], dict(self.headers.items()))
+        self._respond(200, "<CopyObjectResult><ETag>{0}</ETag>"
+                           "</CopyObjectResult>".format(
+                               escape(etag)).encode("utf-8"))
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        key_name = self._key_name()
+        copy_source = self.headers.get("x-amz-copy-source")
+        if key_name and copy_source:
+            return self._copy(key_name, copy_source)
+        with self.fake._lock:
+            self.fake.requests.append(("PUT", key_name))
+        if not key_name:
+            return self._respond(400)
+        if self.fake.should_throttle():
+            return self._respond(503, b"<Error><Code>SlowDown</Code>"
+                                      b"</Error>")
+        content_md5 = self.headers.get("Content-MD5")
+        if content_md5 and \
+                content_md5 != b64encode(md5(body).digest()).decode("ascii"):
+            return self._respond(400, b"<Error><Code>BadDigest</Code>"
+                                      b"</Error>")
+        etag = self.fake.put(key_name, body, dict(self.headers.items()))
+        self._respond(200, headers={"ETag": etag})
+
+    def _list(self):
+        with self.fake._lock:
+            throttled = self.fake.throttle_lists > 0
+            if throttled:
+                self.fake.throttle_lists -= 1
+            objects = sorted(self.fake.objects.items())
+        if throttled:
+            return self._respond(503, b"<Error><Code>SlowDown</Code>"
+                                      b"</Error>")
+        contents = "".join(
+            "<Contents><Key>{0}</Key><ETag>{1}</ETag><Size>{2}</Size>"
+            "<StorageClass>STANDARD</StorageClass></Contents>".format(
+                escape(key_name), escape(etag), len(body))
+            for key_name, (body, _, etag) in objects)
+        self._respond(200, (
+            "<ListBucketResult><Name>{0}</Name><IsTruncated>false"
+            "</IsTruncated>{1}</ListBucketResult>").format(
+                self.fake.bucket_name, contents).encode("utf-8"))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        key_name = self._key_name()
+        with self.fake._lock:
+            self.fake.requests.append(("POST", key_name))
+        if key_name != "" or "delete" not in self._query():
+            return self._respond(400)
+        deleted = [element.text for element in
+                   ElementTree.fromstring(body).iter("Key")]
+        with self.fake._lock:
+            for deleted_key in deleted:
+                self.fake.objects.pop(deleted_key, None)
+        self._respond(200, b"<DeleteResult></DeleteResult>")
+
+    def do_GET(self):
+        key_name = self._key_name()
+        with self.fake._lock:
+            self.fake.requests.append(("GET", key_name))
+            stored = self.fake.objects.get(key_name)
+        if key_name == "":
+            return self._list()
+        if stored is None:
+            return self._respond(404, b"<Error><Code>NoSuchKey</Code>"
+                                      b"</Error>")
+        body, headers, etag = stored
+        self._respond(200, body, {"ETag": etag})
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from hashlib import md5
+from unittest import TestCase, main
+from socket import socket
+from boto.exception import S3ResponseError
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+
+from s3sitedeploy import (
+    _AsyncS3Client, _fail_fast, _classify_error, RETRYABLE,
+    TRANSPORT_ERRORS)
+from tests.fake_s3 import FakeS3Server
+
+
+class AsyncS3ClientTestCase(TestCase):
+
+    def setUp(self):
+        self.server = FakeS3Server("www-test-com-bucket").start()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.server.stop()
+
+    def run_client(self, coroutine_function, max_connections=4):
+        async def _run():
+            client = _AsyncS3Client(self.server.connection(),
+                                    "www-test-com-bucket", max_connections)
+            try:
+                return await coroutine_function(client)
+            finally:
+                client.close()
+        return self.loop.run_until_complete(_run())
+
+    def test_put_stores_object_with_headers(self):
+        etag = self.run_client(lambda client: client.put(
+            "text/poem £.txt", b"Roses are red",
+            {"Content-Type": "text/plain", "Cache-Control": "max-age=60"}))
+        body, headers, stored_etag = \
+            self.server.objects["text/poem £.txt"]
+        self.assertEqual(b"Roses are red", body)
+        self.assertEqual("max-age=60", headers["Cache-Control"])
+        self.assertTrue(headers["Authorization"].startswith("AWS "))
+        self.assertEqual(stored_etag, etag)
+
+    def test_many_puts_share_connections(self):
+        async def _put_many(client):
+            await asyncio.gather(*[
+                client.put("{0}.txt".format(i), b"x", {})
+                for i in range(50)])
+            return len(client._idle)
+        self.assertTrue(self.run_client(_put_many) <= 4)
+        self.assertEqual(50, len(self.server.objects))
+
+    def test_content_md5_checked(self):
+        self.run_client(lambda client: client.put(
+            "index.html", b"<html></html>", {},
+            md5(b"<html></html>").hexdigest()))
+        self.assertIn("Content-MD5", self.server.objects["index.html"][1])
+        with self.assertRaises(S3ResponseError) as raised:
+            self.run_client(lambda client: client.put(
+                "index.html", b"<html></html>", {}, "0" * 32))
+        self.assertEqual(400, raised.exception.status)
+
+    def test_error_response_raised(self):
+        async def _put_outside_bucket(client):
+            client.bucket_name = ""
+            await client.put("", b"x", {})
+        self.assertRaises(S3ResponseError, self.run_client,
+                          _put_outside_bucket)
+
+    def test_stalled_connection_times_out(self):
+        # Connections are accepted by the listen backlog, but never answered
+        stalled = socket()
+        stalled.bind(("127.0.0.1", 0))
+        stalled.listen(1)
+        self.addCleanup(stalled.close)
+        connection = S3Connection(
+            "fake-key-id", "fake-secret", host="127.0.0.1",
+            port=stalled.getsockname()[1], is_secure=False,
+            calling_format=OrdinaryCallingFormat())
+
+        async def _put():
+            client = _AsyncS3Client(connection, "www-test-com-bucket", 1,
+                                    timeout=0.2)
+            try:
+                await client.put("index.html", b"<html></html>", {})
+            finally:
+                client.close()
+        with self.assertRaises(OSError) as raised:
+            self.loop.run_until_complete(_put())
+        self.assertIsInstance(raised.exception, TRANSPORT_ERRORS)
+        self.assertEqual(RETRYABLE, _classify_error(raised.exception))
+
+    def test_timeout_defaults_to_boto_socket_timeout(self):
+        connection = self.server.connection()
+        connection.http_connection_kwargs["timeout"] = 12
+        client = _AsyncS3Client(connection, "www-test-com-bucket", 1)
+        self.assertEqual(12, client.timeout)
+
+
+class FailFastTestCase(TestCase):
+
+    def setUp(self):
+        self.server = FakeS3Server("www-test-com-bucket").start()
+        self.bucket = _fail_fast(self.server.connection()).get_bucket(
+            "www-test-com-bucket", validate=False)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_server_errors_raised_without_retrying(self):
+        self.server.throttle_puts = 1
+        key = self.bucket.new_key("index.html")
+        with self.assertRaises(S3ResponseError) as raised:
+            key.set_contents_from_string("<html></html>")
+        self.assertEqual("SlowDown", raised.exception.error_code)
+        self.assertEqual([("PUT", "index.html")], self.server.requests)
+
+    def test_requests_still_succeed(self):
+        self.bucket.new_key("index.html").set_contents_from_string("x")
+        self.assertEqual(b"x", self.server.objects["index.html"][0])
+
+
+if __name__ == '__main__':
+    main()
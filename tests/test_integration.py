@@ -0,0 +1,611 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+from io import BytesIO
+import tarfile
+import zipfile
+from hashlib import md5
+from os import mkdir, remove, scandir
+from os.path import join, isfile
+from tempfile import mkdtemp
+from shutil import rmtree
+from threading import Thread, Event, current_thread
+from time import sleep
+from unittest import TestCase, main
+from mock import patch
+
+from s3sitedeploy import (
+    parallel_upload_dir_to_s3, ASYNCIO_ENGINE, THREADS_ENGINE, _shard_of,
+    watch_dir_to_s3, _get_object_headers, _Journal, _get_s3site_config,
+    LocalBucket, CONFIG_FILENAME, _etag_of_file, _Archive)
+from tests.fake_s3 import FakeS3Server
+
+SITE = "tests/fixtures/example-multi-depth-project"
+
+
+class DeployTestCase(TestCase):
+    """
+    Deploys to a FakeS3Server for the bucket www-test-com-bucket, which
+    S3Connection is patched to connect to, with a temporary directory to
+    build sites in
+    """
+
+    def setUp(self):
+        self.server = self.start_server("www-test-com-bucket")
+        self.temp_dir = mkdtemp()
+        self.addCleanup(rmtree, self.temp_dir)
+        patcher = patch("s3sitedeploy.S3Connection", self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_server(self, bucket_name):
+        server = FakeS3Server(bucket_name).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def connection(self, *args, **kwargs):
+        return self.server.connection()
+
+    def deploy(self, local_directory=SITE, **kwargs):
+        return parallel_upload_dir_to_s3(
+            local_directory, "www-test-com-bucket", "dkf20fj", "3jf9d0sf",
+            **kwargs)
+
+
+class EachEngine(object):
+    """Runs a DeployTestCase's assertDeployed(engine) with each engine"""
+
+    def test_threads_engine(self):
+        self.assertDeployed(THREADS_ENGINE)
+
+    def test_asyncio_engine(self):
+        self.assertDeployed(ASYNCIO_ENGINE)
+
+
+class EnginesTestCase(EachEngine, DeployTestCase):
+
+    def assertDeployed(self, engine, **kwargs):
+        summary = self.deploy(engine=engine, concurrency=3, **kwargs)
+        self.assertTrue(summary)
+        self.assertEqual(4, summary.uploaded)
+        body, headers, _ = self.server.objects["text/2014/attempt-1.txt"]
+        self.assertEqual(b"This is a great story\n", body)
+        self.assertEqual("max-age=3600", headers["Cache-Control"])
+        body, headers, _ = self.server.objects["index.html"]
+        self.assertEqual("text/html; charset=UTF-8", headers["Content-Type"])
+        self.assertIn("Content-MD5", headers)
+
+    def assertGzipped(self, engine, **kwargs):
+        with open(join(self.temp_dir, "s3sitedeploy.json"), "w") as f:
+            f.write('{"gzip_mimetypes": ["text/html"]}')
+        with open(join(self.temp_dir, "index.html"), "w") as f:
+            f.write("<html></html>")
+        self.deploy(self.temp_dir, engine=engine, **kwargs)
+        body, headers, _ = self.server.objects["index.html"]
+        self.assertEqual("gzip", headers["Content-Encoding"])
+        self.assertEqual(b"<html></html>", gzip.decompress(body))
+
+    def test_asyncio_engine_gzips(self):
+        self.assertGzipped(ASYNCIO_ENGINE)
+
+    def test_threads_engine_streams_files_larger_than_memory_budget(self):
+        self.assertDeployed(THREADS_ENGINE, memory_budget=8)
+        self.assertGzipped(THREADS_ENGINE, memory_budget=8)
+
+    def test_asyncio_engine_streams_files_larger_than_memory_budget(self):
+        self.assertDeployed(ASYNCIO_ENGINE, memory_budget=8)
+        self.assertGzipped(ASYNCIO_ENGINE, memory_budget=8)
+
+    def test_uploads_wait_for_memory_budget(self):
+        self.assertDeployed(ASYNCIO_ENGINE, memory_budget=64)
+
+    @patch("s3sitedeploy.RETRY_BASE_DELAY", 0.001)
+    def test_threads_engine_retries_when_throttled(self):
+        self.server.throttle_puts = 3
+        self.assertDeployed(THREADS_ENGINE)
+        self.assertEqual(7, len(self.server.requests))
+
+    @patch("s3sitedeploy.RETRY_BASE_DELAY", 0.001)
+    def test_asyncio_engine_retries_when_throttled(self):
+        self.server.throttle_puts = 3
+        self.assertDeployed(ASYNCIO_ENGINE)
+        self.assertEqual(7, len(self.server.requests))
+
+    def test_prune_deletes_stale_objects(self):
+        with open(join(self.temp_dir, "s3sitedeploy.json"), "w") as f:
+            f.write('{"prune_exclude": ["^archive/"]}')
+        with open(join(self.temp_dir, "index.html"), "w") as f:
+            f.write("<html></html>")
+        for key_name in ("old.html", "text/old £.txt", "archive/2001.html"):
+            self.server.put(key_name, b"stale", {})
+        summary = self.deploy(self.temp_dir, prune=True)
+        self.assertEqual(2, summary.deleted)
+        self.assertEqual(["archive/2001.html", "index.html"],
+                         sorted(self.server.objects))
+
+    @patch("s3sitedeploy.RETRY_BASE_DELAY", 0.001)
+    def test_throttled_listing_retried(self):
+        self.server.put("old.html", b"stale", {})
+        self.server.throttle_lists = 1
+        summary = self.deploy(incremental=True, prune=True)
+        self.assertTrue(summary)
+        self.assertEqual(1, summary.deleted)
+        self.assertEqual(2, self.server.requests.count(("GET", "")))
+
+    def test_nothing_pruned_if_a_directory_is_unreadable(self):
+        mkdir(join(self.temp_dir, "text"))
+        for relative_path in ("index.html", "text/a.txt"):
+            with open(join(self.temp_dir, relative_path), "w") as f:
+                f.write("x")
+        for key_name in ("old.html", "text/a.txt"):
+            self.server.put(key_name, b"x", {})
+
+        def scandir_but_text(path):
+            if path.endswith("text/"):
+                raise PermissionError(13, "Permission denied")
+            return scandir(path)
+        with patch("s3sitedeploy.scandir", side_effect=scandir_but_text):
+            summary = self.deploy(self.temp_dir, prune=True)
+        self.assertFalse(summary)
+        self.assertEqual(1, summary.uploaded)
+        self.assertEqual(0, summary.deleted)
+        self.assertEqual(["index.html", "old.html", "text/a.txt"],
+                         sorted(self.server.objects))
+
+    def test_nothing_pruned_by_default(self):
+        self.server.put("old.html", b"stale", {})
+        self.deploy()
+        self.assertIn("old.html", self.server.objects)
+
+    def assertDeduplicated(self, engine):
+        with open(join(self.temp_dir, "s3sitedeploy.json"), "w") as f:
+            f.write('{"gzip_mimetypes": ["text/html"], "object_specific": '
+                    '[{"path": "^b", "headers": {"Cache-Control": "max-age=60"'
+                    '}}]}')
+        for name in ("a.png", "b.png", "c.png"):
+            with open(join(self.temp_dir, name), "wb") as f:
+                f.write(b"\x89PNG" * 10000)
+        for name in ("a.html", "b.html"):
+            with open(join(self.temp_dir, name), "w") as f:
+                f.write("<p>Hello</p>" * 10000)
+        summary = self.deploy(self.temp_dir, engine=engine,
+                              deduplicate=True)
+        self.assertEqual(5, summary.uploaded)
+        methods = [method for method, _ in self.server.requests]
+        self.assertEqual(2, methods.count("PUT"))
+        self.assertEqual(3, methods.count("COPY"))
+        body, headers, _ = self.server.objects["b.png"]
+        self.assertEqual(b"\x89PNG" * 10000, body)
+        self.assertEqual("image/png", headers["Content-Type"])
+        self.assertEqual("max-age=60", headers["Cache-Control"])
+        self.assertEqual("no-cache",
+                         self.server.objects["c.png"][1]["Cache-Control"])
+        body, headers, _ = self.server.objects["b.html"]
+        self.assertEqual("gzip", headers["Content-Encoding"])
+        self.assertEqual(b"<p>Hello</p>" * 10000, gzip.decompress(body))
+
+    def test_threads_engine_deduplicates(self):
+        self.assertDeduplicated(THREADS_ENGINE)
+
+    def test_asyncio_engine_deduplicates(self):
+        self.assertDeduplicated(ASYNCIO_ENGINE)
+
+    def assertHeadersUpdatedInPlace(self, engine):
+        manifest_path = join(self.temp_dir, "manifest.json")
+        site_dir = join(self.temp_dir, "site")
+        mkdir(site_dir)
+        with open(join(site_dir, "index.html"), "w") as f:
+            f.write("<html></html>")
+        with open(join(site_dir, "about.html"), "w") as f:
+            f.write("<html>About</html>")
+        self.deploy(site_dir, engine=engine, manifest_path=manifest_path)
+        with open(join(site_dir, "s3sitedeploy.json"), "w") as f:
+            f.write('{"object_specific": [{"path": "^index", "headers": '
+                    '{"Cache-Control": "max-age=60"}}]}')
+        del self.server.requests[:]
+        summary = self.deploy(site_dir, engine=engine,
+                              manifest_path=manifest_path)
+        self.assertEqual(1, summary.uploaded)
+        self.assertEqual([("COPY", "index.html")], self.server.requests)
+        body, headers, _ = self.server.objects["index.html"]
+        self.assertEqual(b"<html></html>", body)
+        self.assertEqual("max-age=60", headers["Cache-Control"])
+        self.assertEqual("text/html; charset=UTF-8", headers["Content-Type"])
+
+    def test_threads_engine_updates_headers_in_place(self):
+        self.assertHeadersUpdatedInPlace(THREADS_ENGINE)
+
+    def test_asyncio_engine_updates_headers_in_place(self):
+        self.assertHeadersUpdatedInPlace(ASYNCIO_ENGINE)
+
+    def test_metrics_report(self):
+        path = join(self.temp_dir, "metrics.json")
+        self.deploy(engine=ASYNCIO_ENGINE, metrics_report=path)
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(4, report["objects"]["uploaded"])
+        for phase in ("config", "walk", "headers", "upload", "deploy"):
+            self.assertIn(phase, report["phases"])
+        self.assertEqual(4, len(report["slowest"]))
+        # Nothing in this site is gzipped
+        self.assertEqual(report["bytes"]["before_compression"],
+                         report["bytes"]["after_compression"])
+
+    def test_shards_partition_the_site(self):
+        uploaded = 0
+        for shard_index in range(3):
+            uploaded += self.deploy(shard_index=shard_index,
+                                    shard_count=3).uploaded
+        self.assertEqual(4, uploaded)
+        self.assertEqual(4, len(self.server.objects))
+        self.assertEqual(4, len(self.server.requests))
+
+    def test_shard_prunes_only_its_own_keys(self):
+        for i in range(20):
+            self.server.put("old-{0}.html".format(i), b"stale", {})
+        self.deploy(prune=True, shard_index=1, shard_count=2)
+        remaining = [key for key in self.server.objects
+                     if key.startswith("old-")]
+        self.assertTrue(0 < len(remaining) < 20)
+        self.assertTrue(all(_shard_of(key, 2) == 0 for key in remaining))
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, self.deploy, engine="carrier-pigeon")
+
+
+class LocalBucketTestCase(EachEngine, DeployTestCase):
+
+    def setUp(self):
+        super(LocalBucketTestCase, self).setUp()
+        self.bucket = LocalBucket(join(self.temp_dir, "bucket"))
+
+    def deploy(self, local_directory=SITE, **kwargs):
+        return parallel_upload_dir_to_s3(
+            local_directory, None, None, None, storage=self.bucket, **kwargs)
+
+    def assertDeployed(self, engine):
+        summary = self.deploy(engine=engine, concurrency=3)
+        self.assertTrue(summary)
+        self.assertEqual(4, summary.uploaded)
+        with open(join(self.temp_dir, "bucket", "text/2014/attempt-1.txt"),
+                  "rb") as f:
+            self.assertEqual(b"This is a great story\n", f.read())
+        self.assertEqual(
+            "max-age=3600",
+            self.bucket.metadata("text/2014/attempt-1.txt")["headers"][
+                "Cache-Control"])
+        summary = self.deploy(engine=engine, concurrency=3, incremental=True)
+        self.assertEqual(0, summary.uploaded)
+        self.assertEqual(4, summary.skipped)
+
+    def assertPartsSpread(self, engine, max_in_flight=4, **kwargs):
+        site = join(self.temp_dir, "site")
+        mkdir(site)
+        with open(join(site, CONFIG_FILENAME), "w") as f:
+            json.dump({"multipart_threshold": 5 * 1024 * 1024,
+                       "multipart_part_size": 5 * 1024 * 1024}, f)
+        with open(join(site, "video.mp4"), "wb") as f:
+            f.write(b"0123456789" * 3 * 1024 * 1024)
+        threads = set()
+        in_flight = []
+        most_in_flight = [0]
+        put_part = self.bucket.put_part
+
+        def _put_part(*args):
+            threads.add(current_thread().name)
+            in_flight.append(None)
+            most_in_flight[0] = max(most_in_flight[0], len(in_flight))
+            # Long enough that one thread can't take every part
+            sleep(0.1)
+            in_flight.pop()
+            return put_part(*args)
+        self.bucket.put_part = _put_part
+        summary = self.deploy(site, engine=engine, concurrency=4, **kwargs)
+        self.assertTrue(summary)
+        self.assertEqual(
+            _etag_of_file(join(site, "video.mp4"), 5 * 1024 * 1024)[1],
+            self.bucket.list()["video.mp4"][0])
+        self.assertTrue(len(threads) > 1)
+        self.assertTrue(most_in_flight[0] <= max_in_flight)
+
+    def test_parts_spread_over_threads_engine(self):
+        self.assertPartsSpread(THREADS_ENGINE)
+
+    def test_parts_spread_over_asyncio_engine(self):
+        self.assertPartsSpread(ASYNCIO_ENGINE)
+
+    def test_parts_spread_within_memory_budget(self):
+        # Room for the part reserved up front, and one alongside it
+        self.assertPartsSpread(THREADS_ENGINE, max_in_flight=2,
+                               memory_budget=12 * 1024 * 1024)
+
+    def test_parts_spread_within_memory_budget_on_asyncio_engine(self):
+        self.assertPartsSpread(ASYNCIO_ENGINE, max_in_flight=2,
+                               memory_budget=12 * 1024 * 1024)
+
+    def test_stale_objects_pruned(self):
+        self.bucket.put("old.html", BytesIO(b"stale"), {})
+        summary = self.deploy(concurrency=3, prune=True)
+        self.assertEqual(1, summary.deleted)
+        self.assertNotIn("old.html", self.bucket.list())
+
+    def test_deployed_alongside_a_bucket(self):
+        summary = super(LocalBucketTestCase, self).deploy(
+            targets=[{"storage": self.bucket}])
+        self.assertTrue(summary)
+        self.assertEqual(sorted(self.server.objects),
+                         sorted(self.bucket.list()))
+
+
+class ArchiveTestCase(EachEngine, DeployTestCase):
+
+    def deployed(self, local_directory, **kwargs):
+        """The objects deploying local_directory to an empty bucket makes"""
+        objects = self.server.objects
+        self.server.objects = {}
+        summary = self.deploy(local_directory, concurrency=3, **kwargs)
+        self.assertTrue(summary)
+        deployed, self.server.objects = self.server.objects, objects
+        return deployed
+
+    def assertSameAsDirectory(self, archive_path, **kwargs):
+        with open(join(self.temp_dir, "s3sitedeploy.json"), "w") as f:
+            f.write('{"gzip_mimetypes": ["text/plain"]}')
+        with tarfile.open(archive_path, "w:gz") as archive:
+            archive.add(SITE, "public")
+            archive.add(join(self.temp_dir, "s3sitedeploy.json"),
+                        "s3sitedeploy.json")
+        from_directory = self.deployed(SITE)
+        from_archive = self.deployed(archive_path, archive_directory="public",
+                                     **kwargs)
+        self.assertEqual(sorted(from_directory), sorted(from_archive))
+        for key_name, (body, headers, etag) in from_directory.items():
+            self.assertEqual(body, from_archive[key_name][0])
+            self.assertEqual(headers["Content-Type"],
+                             from_archive[key_name][1]["Content-Type"])
+            self.assertEqual(headers.get("Content-Encoding"),
+                             from_archive[key_name][1].get(
+                                 "Content-Encoding"))
+
+    def assertDeployed(self, engine):
+        self.assertSameAsDirectory(join(self.temp_dir, "site.tar.gz"),
+                                   engine=engine)
+
+    def test_compression_processes(self):
+        self.assertSameAsDirectory(join(self.temp_dir, "site.tar.gz"),
+                                   compression_processes=1, deduplicate=True)
+
+    def test_streamed_when_larger_than_memory_budget(self):
+        self.assertSameAsDirectory(join(self.temp_dir, "site.tar.gz"),
+                                   memory_budget=8)
+
+    def test_zip(self):
+        path = join(self.temp_dir, "site.zip")
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr("index.html", "<html></html>")
+            archive.writestr("s3sitedeploy.json",
+                             '{"gzip_mimetypes": ["text/html"]}')
+        body, headers, _ = self.deployed(path)["index.html"]
+        self.assertEqual("gzip", headers["Content-Encoding"])
+        self.assertEqual(b"<html></html>", gzip.decompress(body))
+
+
+class JournalTestCase(EachEngine, DeployTestCase):
+
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        self.path = join(self.temp_dir, "journal")
+
+    def assertDeployed(self, engine):
+        """Deploying again after being interrupted resumes the deploy"""
+        journal = _Journal(self.path)
+        config = _get_s3site_config(SITE)
+        for key_name in ("index.html", "text/2014/attempt-1.txt"):
+            filepath = join(SITE, key_name)
+            headers, _ = _get_object_headers(filepath, key_name, config)
+            with open(filepath, "rb") as f:
+                content_md5 = md5(f.read()).hexdigest()
+            journal.bucket("www-test-com-bucket").record(
+                key_name, content_md5, headers)
+        journal.close()
+        summary = self.deploy(engine=engine, concurrency=3,
+                              journal_path=self.path)
+        self.assertTrue(summary)
+        self.assertEqual(2, summary.uploaded)
+        self.assertEqual(2, summary.skipped)
+        self.assertNotIn(("GET", ""), self.server.requests)
+        self.assertNotIn(("PUT", "index.html"), self.server.requests)
+        self.assertFalse(isfile(self.path))
+
+    @patch("s3sitedeploy.RETRY_BASE_DELAY", 0.001)
+    def test_journal_kept_if_deploy_fails(self):
+        self.server.throttle_puts = 1000
+        self.assertFalse(self.deploy(concurrency=3, journal_path=self.path))
+        self.assertTrue(isfile(self.path))
+
+
+class FanOutTestCase(EachEngine, DeployTestCase):
+
+    def setUp(self):
+        super(FanOutTestCase, self).setUp()
+        self.primary = self.server
+        self.replica = self.start_server("replica-bucket")
+
+    def connection(self, access_key_id, *args, **kwargs):
+        if access_key_id == "replica-key":
+            return self.replica.connection()
+        return self.primary.connection()
+
+    def deploy(self, local_directory=SITE, **kwargs):
+        return super(FanOutTestCase, self).deploy(
+            local_directory, concurrency=3,
+            targets=[{"bucket_name": "replica-bucket",
+                      "access_key_id": "replica-key",
+                      "region": "eu-west-1"}],
+            **kwargs)
+
+    def assertDeployed(self, engine):
+        with patch("s3sitedeploy._get_object_headers",
+                   side_effect=_get_object_headers) as mock_headers:
+            summary = self.deploy(engine=engine)
+        self.assertTrue(summary)
+        self.assertEqual(8, summary.uploaded)
+        self.assertEqual(["replica-bucket", "www-test-com-bucket"],
+                         sorted(summary))
+        self.assertEqual(4, mock_headers.call_count)
+        self.assertEqual(sorted(self.primary.objects),
+                         sorted(self.replica.objects))
+        for key_name, stored in self.primary.objects.items():
+            self.assertEqual(stored[0], self.replica.objects[key_name][0])
+
+    def test_each_bucket_listed_and_pruned(self):
+        self.primary.put("old.html", b"stale", {})
+        self.replica.put("older.html", b"stale", {})
+        summary = self.deploy(incremental=True, prune=True)
+        self.assertEqual(1, summary["www-test-com-bucket"].deleted)
+        self.assertEqual(1, summary["replica-bucket"].deleted)
+        self.assertNotIn("old.html", self.primary.objects)
+        self.assertNotIn("older.html", self.replica.objects)
+
+    def test_failing_bucket_does_not_stop_others(self):
+        self.replica.stop()
+        summary = self.deploy()
+        self.assertFalse(summary)
+        self.assertTrue(summary["www-test-com-bucket"])
+        self.assertEqual(4, summary["www-test-com-bucket"].uploaded)
+        self.assertFalse(summary["replica-bucket"])
+        self.assertEqual(4, len(self.primary.objects))
+
+    def test_manifest_refused(self):
+        self.assertRaises(ValueError, self.deploy, manifest_path="manifest")
+
+    def test_metrics_report_counts_every_bucket(self):
+        path = join(self.temp_dir, "metrics.json")
+        self.deploy(metrics_report=path)
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(8, report["objects"]["uploaded"])
+        self.assertEqual(0, report["retries"])
+        self.assertEqual(8, sum(bucket["count"] for bucket in
+                                report["latency_ms"]["histogram"]))
+        self.assertEqual(2 * sum(len(body) for body, _, _ in
+                                 self.primary.objects.values()),
+                         report["bytes"]["transmitted"])
+
+    def test_asyncio_engine_shares_a_tight_memory_budget(self):
+        site = join(self.temp_dir, "site")
+        mkdir(site)
+        for i in range(150):
+            with open(join(site, "{0}.bin".format(i)), "wb") as f:
+                f.write(bytes([i]) * 40000)
+        buckets = [LocalBucket(join(self.temp_dir, name))
+                   for name in ("a", "b")]
+        summaries = []
+        deploy = Thread(target=lambda: summaries.append(
+            parallel_upload_dir_to_s3(
+                site, None, None, None, engine=ASYNCIO_ENGINE,
+                memory_budget=100000, storage=buckets[0],
+                targets=[{"storage": buckets[1]}])))
+        deploy.daemon = True
+        deploy.start()
+        deploy.join(30)
+        self.assertFalse(deploy.is_alive(), "Deploy never finished")
+        self.assertEqual(300, summaries[0].uploaded)
+        for bucket in buckets:
+            self.assertEqual(150, len(bucket.list()))
+
+    def test_failing_bucket_does_not_hold_archive_members(self):
+        path = join(self.temp_dir, "site.tar.gz")
+        with tarfile.open(path, "w:gz") as archive:
+            archive.add(SITE, ".")
+        held = []
+        close = _Archive.close
+
+        def closing(archive):
+            held.extend(archive._members)
+            close(archive)
+        self.replica.stop()
+        with patch.object(_Archive, "close", closing):
+            summary = self.deploy(path, incremental=True)
+        self.assertEqual(4, summary["www-test-com-bucket"].uploaded)
+        self.assertFalse(summary["replica-bucket"])
+        self.assertEqual([], held)
+
+
+class WatchTestCase(DeployTestCase):
+
+    def setUp(self):
+        super(WatchTestCase, self).setUp()
+        self.write("index.html", "<html></html>")
+        self.server.put("old.html", b"stale", {})
+
+    def write(self, relative_path, content):
+        with open(join(self.temp_dir, relative_path), "w") as f:
+            f.write(content)
+
+    def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            sleep(0.05)
+        self.fail("Change was not deployed")
+
+    def start_watching(self, **kwargs):
+        """Watch on a thread of its own, once the first deploy is done"""
+        stop = Event()
+        watcher = Thread(target=watch_dir_to_s3, args=(
+            self.temp_dir, "www-test-com-bucket", "dkf20fj", "3jf9d0sf"),
+            kwargs=dict(compression_processes=0, prune=True, debounce=0.05,
+                        stop=stop, **kwargs))
+        watcher.start()
+        self.addCleanup(watcher.join)
+        self.addCleanup(stop.set)
+        objects = self.server.objects
+        self.wait_for(lambda: "index.html" in objects and
+                      "old.html" not in objects)
+        del self.server.requests[:]
+        return watcher
+
+    def watch(self, **kwargs):
+        self.start_watching(**kwargs)
+        objects = self.server.objects
+        self.write("index.html", "<html>Changed</html>")
+        mkdir(join(self.temp_dir, "css"))
+        self.write("css/site.css", "body {}")
+        self.wait_for(lambda: "css/site.css" in objects and
+                      objects["index.html"][0] == b"<html>Changed</html>")
+        self.assertEqual("text/css; charset=UTF-8",
+                         objects["css/site.css"][1]["Content-Type"])
+
+        remove(join(self.temp_dir, "css/site.css"))
+        self.wait_for(lambda: "css/site.css" not in objects)
+
+        self.write("s3sitedeploy.json", '{"gzip_mimetypes": ["text/html"]}')
+        self.wait_for(lambda: objects["index.html"][1].get(
+            "Content-Encoding") == "gzip")
+        self.assertEqual(b"<html>Changed</html>",
+                         gzip.decompress(objects["index.html"][0]))
+        self.assertNotIn(("GET", ""), self.server.requests)
+
+    def test_changes_deployed_with_inotify(self):
+        self.watch()
+
+    def test_changes_deployed_by_polling(self):
+        self.watch(poll_interval=0.05)
+
+    def test_invalid_config_keeps_previous(self):
+        watcher = self.start_watching(poll_interval=0.05)
+        objects = self.server.objects
+        self.write("s3sitedeploy.json", '{"gzip_mimetypes": [')
+        sleep(0.5)
+        self.write("index.html", "<html>Changed</html>")
+        self.wait_for(
+            lambda: objects["index.html"][0] == b"<html>Changed</html>")
+        self.assertTrue(watcher.is_alive())
+        self.write("s3sitedeploy.json", '{"gzip_mimetypes": ["text/html"]}')
+        self.wait_for(lambda: objects["index.html"][1].get(
+            "Content-Encoding") == "gzip")
+
+
+if __name__ == '__main__':
+    main()
@@ -49,6 +49,63 @@ class ValidateGzipMimetypesPropertyTestCase(BaseJsonSchemaTestCase):
         self.assertInvalid({"gzip_mimetypes": ["text/html", "text/html"]})
 
 
+class ValidateGzipLevelPropertyTestCase(BaseJsonSchemaTestCase):
+
+    def test_valid_use_cases(self):
+        self.assertValid({"gzip_level": 1})
+        self.assertValid({"gzip_level": 9})
+
+    def test_must_be_within_range(self):
+        self.assertInvalid({"gzip_level": 0})
+        self.assertInvalid({"gzip_level": 10})
+
+    def test_must_be_integer(self):
+        self.assertInvalid({"gzip_level": "9"})
+        self.assertInvalid({"gzip_level": 4.5})
+
+
+class ValidateGzipLevelsPropertyTestCase(BaseJsonSchemaTestCase):
+
+    def test_valid_use_cases(self):
+        self.assertValid({"gzip_levels": {}})
+        self.assertValid({"gzip_levels": {"text/html": 9,
+                                          "application/javascript": 6}})
+
+    def test_levels_must_be_within_range(self):
+        self.assertInvalid({"gzip_levels": {"text/html": 0}})
+        self.assertInvalid({"gzip_levels": {"text/html": 10}})
+
+    def test_must_be_mimetype_to_integer_map(self):
+        self.assertInvalid({"gzip_levels": ["text/html"]})
+        self.assertInvalid({"gzip_levels": {"text/html": "9"}})
+
+
+class ValidateMultipartPropertiesTestCase(BaseJsonSchemaTestCase):
+
+    def test_valid_use_cases(self):
+        self.assertValid({"multipart_threshold": 104857600,
+                          "multipart_part_size": 8388608})
+
+    def test_parts_must_be_at_least_5mb(self):
+        self.assertInvalid({"multipart_part_size": 1024})
+        self.assertInvalid({"multipart_threshold": 1024})
+
+    def test_parts_must_be_at_most_5gb(self):
+        self.assertInvalid({"multipart_part_size": 5368709121})
+
+
+class ValidatePruneExcludePropertyTestCase(BaseJsonSchemaTestCase):
+
+    def test_valid_use_cases(self):
+        self.assertValid({"prune_exclude": []})
+        self.assertValid({"prune_exclude": [r"^archive/", r"\.pdf$"]})
+
+    def test_must_be_list_of_expressions(self):
+        self.assertInvalid({"prune_exclude": r"^archive/"})
+        self.assertInvalid({"prune_exclude": [""]})
+        self.assertInvalid({"prune_exclude": [1]})
+
+
 class ValidateObjectSpecificHeadersPropertyTestCase(BaseJsonSchemaTestCase):
 
     def test_not_required(self):
@@ -3,10 +3,10 @@ from os.path import join
 from tempfile import mkdtemp
 from shutil import rmtree
 from unittest import TestCase, main
-import boto
-from moto import mock_s3
+from mock import patch
 
 from s3sitedeploy import parallel_upload_dir_to_s3
+from tests.fake_s3 import FakeS3Server
 
 
 class ParallelUploadDirToS3TestCase(TestCase):
@@ -14,36 +14,33 @@ class ParallelUploadDirToS3TestCase(TestCase):
     def setUp(self):
         self.bucket_name = "www-test-com-bucket"
         self.temp_dir = mkdtemp()
+        self.server = FakeS3Server(self.bucket_name).start()
+        patcher = patch("s3sitedeploy.S3Connection", self.server.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
+        self.server.stop()
         rmtree(self.temp_dir)
 
-    @mock_s3
     def test_normal_use_case(self):
-        conn = boto.connect_s3()
-        conn.create_bucket(self.bucket_name)
         parallel_upload_dir_to_s3(
             "tests/fixtures/example-multi-depth-project",
             self.bucket_name, "dkf20fj", "3jf9d0sf")
-        bucket = conn.get_bucket(self.bucket_name)
-        self.assertEquals(
-            "This is a great story\n",
-            bucket.get_key("text/2014/attempt-1.txt").read())
+        body, _, _ = self.server.objects["text/2014/attempt-1.txt"]
+        self.assertEqual(b"This is a great story\n", body)
 
-    @mock_s3
     def test_can_handle_many_files(self):
         for i in range(1, 500):
             example_file = join(self.temp_dir, str(i) + ".txt")
             with open(example_file, "w") as f:
                 f.write("test of this \n thing")
-        conn = boto.connect_s3()
-        conn.create_bucket(self.bucket_name)
         status = parallel_upload_dir_to_s3(self.temp_dir, self.bucket_name,
                                            "dkf20fj", "3jf9d0sf")
         self.assertTrue(status)
-        bucket = conn.get_bucket(self.bucket_name)
-        self.assertEquals("test of this \n thing",
-                          bucket.get_key("1.txt").read())
+        self.assertEqual(499, len(self.server.objects))
+        body, _, _ = self.server.objects["1.txt"]
+        self.assertEqual(b"test of this \n thing", body)
 
 
 if __name__ == '__main__':
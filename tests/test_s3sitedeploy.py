@@ -1,15 +1,40 @@
 # -*- coding: utf-8 -*-
 from unittest import TestCase, main
-from mock import patch, Mock
-from os.path import abspath
-from os import environ
+from mock import patch, Mock, ANY
+from os.path import abspath, getsize, isfile, dirname, basename
+from os import environ, stat, listdir, mkdir, symlink, remove, scandir
+from os.path import join
+from tempfile import mkdtemp
+from shutil import rmtree
+from threading import Thread, Event, Barrier, current_thread
+from multiprocessing import cpu_count
 import gzip
+import pstats
+import tarfile
+import zipfile
+import re
+from hashlib import md5
+from io import BytesIO
 from jsonschema import ValidationError
+from boto.exception import S3ResponseError
 
 from s3sitedeploy import (
-    _list_all_files_in_dir, _upload_file_to_s3, _compress_the_file,
+    _compress_the_file,
     extract_wercker_env_vars, _append_charset, _get_object_directives,
-    _get_s3site_config)
+    _get_s3site_config, _list_remote_objects, _payload_matches_remote,
+    _md5_of_file, DeploySummary, UPLOADED, SKIPPED, FAILED, _Manifest,
+    _ThreadLocalBucket, _etag_of_file, _multipart_part_size,
+    _MultipartUpload, _DirectiveMatcher, _literal_prefix, _literal_suffix,
+    _iter_files_in_dir, _upload_with_thread_pool, PENDING_PER_WORKER,
+    _Deploy, _ProcessPoolCompressor, _gzip_level, _CachingCompressor,
+    _classify_error, _backoff_delay, _AdaptiveConcurrency, THROTTLED,
+    RETRYABLE, FATAL, RETRY_MAX_DELAY, _RetryQueue, UPLOAD_ATTEMPTS,
+    RETRY_BUDGET_MIN, _stale_keys, _delete_batch, _prune_stale_objects,
+    DEDUPLICATE_MIN_SIZE, _Metrics, _NO_METRICS, _profiled, _PreparedUpload,
+    _shard_of, parallel_upload_dir_to_s3, _MemoryBudget, _PollingWatcher,
+    _InotifyWatcher, _next_batch, _resolve_changes, _boto_md5, _Digests,
+    _prepare_upload, FanOutSummary, _SharedPreparation, _FanOut, _Journal,
+    JOURNAL_SYNC_ENTRIES, _Archive, _S3Bucket, LocalBucket)
 
 
 class ExtractWerckerEnvVarsTestCase(TestCase):
@@ -136,6 +161,72 @@ class GetObjectDirectivesTestCase(TestCase):
                       "/first/style/css/app.css")
 
 
+class DirectiveMatcherTestCase(TestCase):
+
+    def assertSameAsLinearScan(self, directives, paths):
+        matcher = _DirectiveMatcher(directives)
+        for path in paths:
+            expected = None
+            for directive in directives:
+                if re.match(directive["path"], path):
+                    expected = directive
+                    break
+            self.assertIs(expected, matcher.match(path), path)
+
+    def test_literal_prefix(self):
+        self.assertEqual("assets/", _literal_prefix(r"^assets/.*"))
+        self.assertEqual("images/10", _literal_prefix(r"images/10.jpg"))
+        self.assertEqual("a", _literal_prefix(r"ab*"))
+        self.assertEqual("ab", _literal_prefix(r"ab+c"))
+        self.assertEqual("index.htm", _literal_prefix(r"index\.html?"))
+        self.assertEqual("", _literal_prefix(r".*"))
+        self.assertEqual("", _literal_prefix(r"a|b"))
+        self.assertEqual("", _literal_prefix(r"(?i)assets/"))
+
+    def test_literal_suffix(self):
+        self.assertEqual(".css", _literal_suffix(r".*\.css$"))
+        self.assertEqual(".txt", _literal_suffix(r"\d+\.txt$"))
+        self.assertEqual("", _literal_suffix(r".*\.css"))
+        self.assertEqual("", _literal_suffix(r".*\.html?$"))
+        self.assertEqual("", _literal_suffix(r".*\.css$|.*\.js$"))
+        self.assertEqual("", _literal_suffix(r"(?i).*\.CSS$"))
+
+    def test_equal_to_list_of_directives(self):
+        directives = [{"path": r".*", "gzip": False}]
+        self.assertEqual(directives, _DirectiveMatcher(directives))
+
+    def test_first_match_wins_across_indexes(self):
+        directives = [{"path": r".*\.jpg$"},
+                      {"path": r"^images/.*"},
+                      {"path": r".*"}]
+        matcher = _DirectiveMatcher(directives)
+        self.assertIs(directives[0], matcher.match("images/1.jpg"))
+        self.assertIs(directives[1], matcher.match("images/1.png"))
+        self.assertIs(directives[2], matcher.match("index.html"))
+
+    def test_same_as_linear_scan(self):
+        directives = [{"path": p} for p in (
+            r"^assets/css/.*", r"assets/.*\.js$", r"^images/[0-3]+.jpg$",
+            r"images/99.jpg", r".*css/.*", r"news/2014/how-to/index\.html*",
+            r"(?i).*\.PNG$", r".*\.png$", r"robots.txt", r"a|.*\.txt$",
+            r"\d+\.txt$", r"ab?c/", r"^$")]
+        paths = ["assets/css/site.css", "assets/app.js", "assets/app.json",
+                 "images/123.jpg", "images/99.jpg", "images/99xjpg",
+                 "first/style/css/app.css", "news/2014/how-to/index.htm",
+                 "news/2014/how-to/index.html", "photo.png", "photo.PNG",
+                 "robots.txt", "about.txt", "10.txt", "ac/", "abc/", "",
+                 "style.css\n", "x.png\n"]
+        self.assertSameAsLinearScan(directives, paths)
+
+    @patch("s3sitedeploy.compile")
+    def test_rules_compiled_once(self, mock_compile):
+        mock_compile.return_value.match.return_value = None
+        matcher = _DirectiveMatcher([{"path": r"a"}, {"path": r"b"}])
+        for _ in range(10):
+            matcher.match("a")
+        self.assertEqual(2, mock_compile.call_count)
+
+
 class AppendCharsetTestCase(TestCase):
 
     def test_multiple_text_files(self):
@@ -157,18 +248,18 @@ class AppendCharsetTestCase(TestCase):
         self.assertEqual(examples, actual)
 
 
-class ListAllFilesInDirTestCase(TestCase):
+class IterFilesInDirTestCase(TestCase):
 
     def test_non_existant_directory(self):
-        self.assertEquals(set([]), _list_all_files_in_dir("non-existent"))
+        self.assertEquals(set([]), set(_iter_files_in_dir("non-existent")))
 
     def test_empty_directory(self):
-        self.assertEquals(set([]), _list_all_files_in_dir(
-            "tests/fixtures/empty-project/"))
+        self.assertEquals(set([]), set(_iter_files_in_dir(
+            "tests/fixtures/empty-project/")))
 
     def test_s3siteconfig_not_returned(self):
-        files = _list_all_files_in_dir(
-            "tests/fixtures/example-multi-depth-project/")
+        files = set(_iter_files_in_dir(
+            "tests/fixtures/example-multi-depth-project/"))
         self.assertTrue("s3sitedeploy.json" not in files)
 
     def test_multi_depth_project(self):
@@ -176,17 +267,40 @@ class ListAllFilesInDirTestCase(TestCase):
                     "text/poem.txt",
                     "text/2014/attempt-1.txt",
                     "text/2014/attempt-43.txt"}
-        files = _list_all_files_in_dir(
-            "tests/fixtures/example-multi-depth-project/")
+        files = set(_iter_files_in_dir(
+            "tests/fixtures/example-multi-depth-project/"))
         self.assertEquals(expected, files)
 
-    def test_check_leading_trailing_slashes(self):
-        trailing = _list_all_files_in_dir(
+    def test_iter_is_lazy(self):
+        files = _iter_files_in_dir(
             "tests/fixtures/example-multi-depth-project/")
-        no_trailing = _list_all_files_in_dir(
-            "tests/fixtures/example-multi-depth-project")
-        absolute = _list_all_files_in_dir(
-            abspath("tests/fixtures/example-multi-depth-project/"))
+        self.assertEqual(files, iter(files))
+        self.assertEqual(4, len(list(files)))
+
+    def test_nested_config_filename_is_uploaded(self):
+        temp_dir = mkdtemp()
+        self.addCleanup(rmtree, temp_dir)
+        mkdir(join(temp_dir, "docs"))
+        for path in ("s3sitedeploy.json", "docs/s3sitedeploy.json"):
+            with open(join(temp_dir, path), "w") as f:
+                f.write("{}")
+        self.assertEqual({"docs/s3sitedeploy.json"},
+                         set(_iter_files_in_dir(temp_dir)))
+
+    def test_symlinked_directories_not_followed(self):
+        temp_dir = mkdtemp()
+        self.addCleanup(rmtree, temp_dir)
+        symlink(abspath("tests/fixtures/example-multi-depth-project"),
+                join(temp_dir, "linked"))
+        self.assertEqual(set(), set(_iter_files_in_dir(temp_dir)))
+
+    def test_check_leading_trailing_slashes(self):
+        trailing = set(_iter_files_in_dir(
+            "tests/fixtures/example-multi-depth-project/"))
+        no_trailing = set(_iter_files_in_dir(
+            "tests/fixtures/example-multi-depth-project"))
+        absolute = set(_iter_files_in_dir(
+            abspath("tests/fixtures/example-multi-depth-project/")))
         self.assertEquals(trailing, no_trailing)
         self.assertEquals(trailing, absolute)
 
@@ -209,11 +323,187 @@ class CompressTheFileTestCase(TestCase):
         with open(filepath) as f_original:
             self.assertEqual(original_contents, f_original.read())
 
+    def test_nothing_written_next_to_source(self):
+        before = listdir("tests/fixtures/compression-tests")
+        _compress_the_file("tests/fixtures/compression-tests/webpage.html")
+        self.assertEqual(before, listdir("tests/fixtures/compression-tests"))
+
+    def test_output_is_reproducible(self):
+        filepath = "tests/fixtures/compression-tests/webpage.html"
+        self.assertEqual(_compress_the_file(filepath).read(),
+                         _compress_the_file(filepath).read())
+
+    def test_header_has_no_mtime_or_filename(self):
+        header = _compress_the_file(
+            "tests/fixtures/compression-tests/webpage.html").read(10)
+        flags = ord(header[3:4])
+        self.assertEqual(0, flags & 0x08)
+        self.assertEqual(b"\x00\x00\x00\x00", header[4:8])
+
+    def test_level_is_configurable(self):
+        filepath = "tests/fixtures/compression-tests/webpage.html"
+        fastest = _compress_the_file(filepath, 1).read()
+        smallest = _compress_the_file(filepath, 9).read()
+        self.assertNotEqual(fastest, smallest)
+        self.assertEqual(gzip.decompress(fastest), gzip.decompress(smallest))
+
+    def test_digests_worked_out_while_compressing(self):
+        filepath = "tests/fixtures/compression-tests/webpage.html"
+        compressed = _compress_the_file(filepath)
+        self.assertEqual(_md5_of_file(filepath), compressed.source_md5)
+        self.assertEqual(md5(compressed.read()).hexdigest(), compressed.md5)
+
+
+class ProcessPoolCompressorTestCase(TestCase):
+
+    def setUp(self):
+        self.compressor = _ProcessPoolCompressor(2)
+
+    def tearDown(self):
+        self.compressor.close()
+
+    def test_same_output_as_compressing_in_process(self):
+        filepath = "tests/fixtures/compression-tests/webpage.html"
+        compressed = self.compressor(filepath, 6)
+        self.assertEqual(_compress_the_file(filepath, 6).read(),
+                         compressed.read())
+        self.assertEqual(_md5_of_file(filepath), compressed.source_md5)
+
+    @patch("s3sitedeploy.COMPRESSION_SPOOL_SIZE", 10)
+    @patch("s3sitedeploy._compress_the_file")
+    def test_large_files_compressed_by_caller(self, mock_compress):
+        filepath = "tests/fixtures/compression-tests/webpage.html"
+        self.assertEqual(mock_compress.return_value,
+                         self.compressor(filepath, 6))
+        mock_compress.assert_called_once_with(filepath, 6)
+
+    def test_sized_to_core_count_by_default(self):
+        compressor = _ProcessPoolCompressor()
+        self.addCleanup(compressor.close)
+        self.assertEqual(cpu_count(), compressor.processes)
+
 
-class UploadFileToS3TestCase(TestCase):
+class CachingCompressorTestCase(TestCase):
+
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        self.site_dir = mkdtemp()
+        self.filepath = "tests/fixtures/compression-tests/webpage.html"
+        self.compressor = Mock(side_effect=_compress_the_file)
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+        rmtree(self.site_dir)
+
+    def write_file(self, name, contents):
+        filepath = join(self.site_dir, name)
+        with open(filepath, "w") as f:
+            f.write(contents)
+        return filepath
+
+    def test_miss_compresses_and_records_md5(self):
+        cache = _CachingCompressor(self.cache_dir, 10 ** 6, self.compressor)
+        compressed = cache(self.filepath, 9)
+        contents = compressed.read()
+        self.assertEqual(_compress_the_file(self.filepath, 9).read(),
+                         contents)
+        self.assertEqual(md5(contents).hexdigest(), compressed.md5)
+        self.assertEqual(1, self.compressor.call_count)
+
+    def test_hit_reused_across_deploys(self):
+        expected = _CachingCompressor(
+            self.cache_dir, 10 ** 6, self.compressor)(self.filepath, 9)
+        cache = _CachingCompressor(self.cache_dir, 10 ** 6, self.compressor)
+        with cache(self.filepath, 9) as cached:
+            self.assertEqual(expected.read(), cached.read())
+            self.assertEqual(expected.md5, cached.md5)
+        self.assertEqual(1, self.compressor.call_count)
+
+    def test_keyed_by_content_not_path(self):
+        cache = _CachingCompressor(self.cache_dir, 10 ** 6, self.compressor)
+        cache(self.write_file("a.html", "same"), 9)
+        cache(self.write_file("b.html", "same"), 9)
+        self.assertEqual(1, self.compressor.call_count)
+
+    def test_keyed_by_level(self):
+        cache = _CachingCompressor(self.cache_dir, 10 ** 6, self.compressor)
+        cache(self.filepath, 9)
+        cache(self.filepath, 1)
+        self.assertEqual(2, self.compressor.call_count)
+
+    def test_md5_not_recomputed_for_cached_output(self):
+        cache = _CachingCompressor(self.cache_dir, 10 ** 6, self.compressor)
+        compressed = cache(self.filepath, 9)
+        compressed.md5 = "from-cache"
+        self.assertEqual("from-cache", _md5_of_file(compressed))
+        self.assertEqual(("from-cache", "from-cache"),
+                         _etag_of_file(compressed))
+
+    def test_least_recently_used_evicted(self):
+        paths = [self.write_file("{0}.html".format(i), str(i) * 2000)
+                 for i in range(3)]
+        one_entry = len(_compress_the_file(paths[0], 9).read())
+        cache = _CachingCompressor(self.cache_dir, one_entry * 2.5,
+                                   self.compressor)
+        cache(paths[0], 9)
+        cache(paths[1], 9)
+        cache(paths[0], 9)
+        cache(paths[2], 9)
+        self.assertEqual(3, self.compressor.call_count)
+        cache(paths[0], 9)
+        cache(paths[2], 9)
+        self.assertEqual(3, self.compressor.call_count)
+        cache(paths[1], 9)
+        self.assertEqual(4, self.compressor.call_count)
+
+
+class GzipLevelTestCase(TestCase):
+
+    def test_default(self):
+        self.assertEqual(9, _gzip_level({}, "index.html"))
+
+    def test_site_wide_level(self):
+        self.assertEqual(4, _gzip_level({"gzip_level": 4}, "index.html"))
+
+    def test_mimetype_level_overrides(self):
+        config = {"gzip_level": 4,
+                  "gzip_levels": {"text/css": 7}}
+        self.assertEqual(7, _gzip_level(config, "css/style.css"))
+        self.assertEqual(4, _gzip_level(config, "index.html"))
+
+
+def upload_file(filepath, bucket, config, remote_objects=None,
+                manifest=None, helpers=None):
+    """Upload a file as a _Deploy of the directory it is in would"""
+    buckets = Mock(bucket_name="bucket")
+    buckets.get.return_value = bucket
+    deploy = _Deploy(dirname(filepath), config, buckets, remote_objects,
+                     manifest)
+    return deploy.upload_file(basename(filepath), helpers)
+
+
+class UploadFileTestCase(TestCase):
+
+    def upload_file(self, mock_key, filepath):
+        """upload_file, keeping what is sent from memory in self.sent"""
+        self.sent = []
+
+        def _sent(payload, **kwargs):
+            self.sent.append((payload.read(), kwargs))
+            return len(self.sent[-1][0])
+        mock_key.return_value.set_contents_from_file.side_effect = _sent
+        upload_file(filepath, self.bucket, self.example_config)
+
+    def assertSentFromMemory(self, filepath, headers):
+        with open(filepath, "rb") as f:
+            contents = f.read()
+        self.assertEqual([(contents, {
+            "headers": headers, "rewind": True,
+            "md5": _boto_md5(md5(contents).hexdigest())})], self.sent)
 
     def setUp(self):
         self.mock_bucket = Mock()
+        self.bucket = _S3Bucket(self.mock_bucket)
         self.example_config = {
             "object_specific": [
                 {"path": r".*",
@@ -225,21 +515,25 @@ class UploadFileToS3TestCase(TestCase):
     @patch("s3sitedeploy._compress_the_file")
     def test_content_type_guessed_and_set_correctly_for_html_file(
             self, mock_compress_the_file, mock_key):
-        mock_compress_the_file.return_value = "example-file.gz"
+        compressed = BytesIO(b"compressed")
+        mock_compress_the_file.return_value = compressed
         expected_headers = {
             "x-amz-acl": "public-read",
             "Content-Type": "text/html; charset=UTF-8",
             "Content-Encoding": "gzip",
             "Cache-Control": "max-age=60"}
-        _upload_file_to_s3(
-            "tests/fixtures/webpage-without-compression.html",
-            self.mock_bucket, "webpage-without-compression.html",
-            self.example_config)
+        self.upload_file(
+            mock_key, "tests/fixtures/webpage-without-compression.html")
         mock_key.assert_called_once_with(self.mock_bucket)
-        mock_key.key.assertEquals("webpage-without-compression.html")
-        mock_key.return_value.set_contents_from_filename.\
-            assert_called_once_with("example-file.gz",
-                                    headers=expected_headers)
+        self.assertEqual("webpage-without-compression.html",
+                         mock_key.return_value.key)
+        mock_compress_the_file.assert_called_once_with(
+            "tests/fixtures/webpage-without-compression.html", 9)
+        mock_key.return_value.set_contents_from_file.\
+            assert_called_once_with(
+                compressed, headers=expected_headers, rewind=True,
+                md5=_boto_md5(md5(b"compressed").hexdigest()))
+        self.assertTrue(compressed.closed)
 
     @patch("s3sitedeploy.Key")
     def test_gzipping_not_performed_if_file_is_already_gzipped(self, mock_key):
@@ -248,16 +542,14 @@ class UploadFileToS3TestCase(TestCase):
             "Content-Type": "text/html; charset=UTF-8",
             "Content-Encoding": "gzip",
             "Cache-Control": "max-age=60"}
-        _upload_file_to_s3(
-            "tests/fixtures/webpage-with-compression.html.gz",
-            self.mock_bucket, "webpage-with-compression.html.gz",
-            self.example_config)
+        self.upload_file(
+            mock_key, "tests/fixtures/webpage-with-compression.html.gz")
         mock_key.assert_called_once_with(self.mock_bucket)
-        mock_key.key.assertEquals("webpage-without-compression.html.gz")
-        mock_key.return_value.set_contents_from_filename.\
-            assert_called_once_with(
-                "tests/fixtures/webpage-with-compression.html.gz",
-                headers=expected_headers)
+        self.assertEqual("webpage-with-compression.html.gz",
+                         mock_key.return_value.key)
+        self.assertSentFromMemory(
+            "tests/fixtures/webpage-with-compression.html.gz",
+            expected_headers)
 
     @patch("s3sitedeploy.Key")
     def test_gzipping_not_performed_if_mimetype_is_not_in_list(self, mock_key):
@@ -265,14 +557,13 @@ class UploadFileToS3TestCase(TestCase):
             "x-amz-acl": "public-read",
             "Content-Type": "image/jpeg",
             "Cache-Control": "max-age=60"}
-        _upload_file_to_s3("tests/fixtures/example-image.jpg",
-                           self.mock_bucket, "example-image.jpg",
-                           self.example_config)
+        self.upload_file(
+            mock_key, "tests/fixtures/compression-tests/example-image.jpg")
         mock_key.assert_called_once_with(self.mock_bucket)
-        mock_key.key.assertEquals("example-image.jpg")
-        mock_key.return_value.set_contents_from_filename.\
-            assert_called_once_with("tests/fixtures/example-image.jpg",
-                                    headers=expected_headers)
+        self.assertEqual("example-image.jpg", mock_key.return_value.key)
+        self.assertSentFromMemory(
+            "tests/fixtures/compression-tests/example-image.jpg",
+            expected_headers)
 
     @patch("s3sitedeploy.Key")
     def test_gzipping_not_performed_if_object_override(self, mock_key):
@@ -286,16 +577,14 @@ class UploadFileToS3TestCase(TestCase):
             "x-amz-acl": "public-read",
             "Content-Type": "text/html; charset=UTF-8",
             "Cache-Control": "no-cache"}
-        _upload_file_to_s3(
-            "tests/fixtures/webpage-without-compression.html",
-            self.mock_bucket, "webpage-without-compression.html",
-            self.example_config)
+        self.upload_file(
+            mock_key, "tests/fixtures/webpage-without-compression.html")
         mock_key.assert_called_once_with(self.mock_bucket)
-        mock_key.key.assertEquals("webpage-without-compression.html")
-        mock_key.return_value.set_contents_from_filename.\
-            assert_called_once_with(
-                "tests/fixtures/webpage-without-compression.html",
-                headers=expected_headers)
+        self.assertEqual("webpage-without-compression.html",
+                         mock_key.return_value.key)
+        self.assertSentFromMemory(
+            "tests/fixtures/webpage-without-compression.html",
+            expected_headers)
 
     @patch("s3sitedeploy.Key")
     def test_header_overrides_honoured(self, mock_key):
@@ -310,14 +599,1685 @@ class UploadFileToS3TestCase(TestCase):
             "x-amz-acl": "public-dance",
             "Content-Type": "image/jpeg",
             "Cache-Control": "private, max-age=10"}
-        _upload_file_to_s3("tests/fixtures/example-image.jpg",
-                           self.mock_bucket, "example-image.jpg",
-                           self.example_config)
+        self.upload_file(
+            mock_key, "tests/fixtures/compression-tests/example-image.jpg")
         mock_key.assert_called_once_with(self.mock_bucket)
-        mock_key.key.assertEquals("example-image.jpg")
-        mock_key.return_value.set_contents_from_filename.\
-            assert_called_once_with("tests/fixtures/example-image.jpg",
-                                    headers=expected_headers)
+        self.assertEqual("example-image.jpg", mock_key.return_value.key)
+        self.assertSentFromMemory(
+            "tests/fixtures/compression-tests/example-image.jpg",
+            expected_headers)
+
+
+class IncrementalUploadTestCase(TestCase):
+
+    def setUp(self):
+        self.mock_bucket = Mock()
+        self.bucket = _S3Bucket(self.mock_bucket)
+        self.filepath = "tests/fixtures/compression-tests/example-image.jpg"
+        self.md5 = _md5_of_file(self.filepath)
+        self.size = getsize(self.filepath)
+        self.config = {"gzip_mimetypes": []}
+
+    def test_list_remote_objects_strips_etag_quotes(self):
+        remote_key = Mock(etag='"abc123"', size=10)
+        remote_key.name = "index.html"
+        self.mock_bucket.list.return_value = [remote_key]
+        buckets = Mock(bucket_name="bucket")
+        buckets.get.return_value = self.bucket
+        self.assertEqual({"index.html": ("abc123", 10)},
+                         _list_remote_objects(buckets))
+
+    @patch("s3sitedeploy.sleep")
+    def test_listing_retried(self, mock_sleep):
+        buckets = Mock(bucket_name="bucket")
+        buckets.get.return_value.list.side_effect = [
+            ConnectionResetError(), {"index.html": ("abc123", 10)}]
+        self.assertEqual({"index.html": ("abc123", 10)},
+                         _list_remote_objects(buckets))
+        self.assertEqual(1, buckets.reset.call_count)
+        self.assertEqual(1, mock_sleep.call_count)
+
+    def test_listing_not_retried_on_access_denied(self):
+        buckets = Mock(bucket_name="bucket")
+        buckets.get.return_value.list.side_effect = s3_error(
+            403, "AccessDenied")
+        self.assertRaises(S3ResponseError, _list_remote_objects, buckets)
+        self.assertEqual(1, buckets.get.return_value.list.call_count)
+
+    def test_payload_matches_identical_remote(self):
+        self.assertTrue(_payload_matches_remote(
+            self.filepath, (self.md5, self.size)))
+
+    def test_payload_differs_on_size(self):
+        self.assertFalse(_payload_matches_remote(
+            self.filepath, (self.md5, self.size + 1)))
+
+    def test_payload_differs_on_etag(self):
+        self.assertFalse(_payload_matches_remote(
+            self.filepath, ("0" * 32, self.size)))
+
+    def test_multipart_etag_never_matches(self):
+        self.assertFalse(_payload_matches_remote(
+            self.filepath, (self.md5 + "-2", self.size)))
+
+    @patch("s3sitedeploy.Key")
+    def test_unchanged_object_is_skipped(self, mock_key):
+        remote = {"example-image.jpg": (self.md5, self.size)}
+        self.assertEqual(None, upload_file(
+            self.filepath, self.bucket, self.config, remote))
+        self.assertFalse(
+            mock_key.return_value.set_contents_from_file.called)
+
+    @patch("s3sitedeploy.Key")
+    def test_new_object_is_uploaded(self, mock_key):
+        mock_key.return_value.set_contents_from_file.return_value = 3
+        self.assertEqual(3, upload_file(
+            self.filepath, self.bucket, self.config, {}))
+
+    @patch("s3sitedeploy.Key")
+    def test_changed_object_is_uploaded(self, mock_key):
+        mock_key.return_value.set_contents_from_file.return_value = 3
+        remote = {"example-image.jpg": ("0" * 32, self.size)}
+        self.assertEqual(3, upload_file(
+            self.filepath, self.bucket, self.config, remote))
+
+
+class ManifestTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.manifest_path = join(self.temp_dir, "manifest.json")
+        self.mock_bucket = Mock()
+        self.bucket = _S3Bucket(self.mock_bucket)
+        self.filepath = "tests/fixtures/compression-tests/example-image.jpg"
+        self.stat = stat(self.filepath)
+        self.md5 = _md5_of_file(self.filepath)
+        self.size = getsize(self.filepath)
+        self.headers = {"x-amz-acl": "public-read",
+                        "Content-Type": "image/jpeg",
+                        "Cache-Control": "no-cache"}
+        self.config = {}
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def saved_manifest(self):
+        manifest = _Manifest(self.manifest_path)
+        manifest.record("example-image.jpg", self.stat, self.headers,
+                        self.md5, self.md5, self.size, self.md5)
+        manifest.save()
+        return _Manifest(self.manifest_path)
+
+    def test_missing_manifest_is_not_loaded(self):
+        self.assertFalse(_Manifest(self.manifest_path).loaded)
+
+    def test_corrupt_manifest_is_not_loaded(self):
+        with open(self.manifest_path, "w") as f:
+            f.write("{not json")
+        self.assertFalse(_Manifest(self.manifest_path).loaded)
+
+    def test_round_trip(self):
+        manifest = self.saved_manifest()
+        self.assertTrue(manifest.loaded)
+        self.assertEqual({"example-image.jpg": (self.md5, self.size)},
+                         manifest.remote_objects())
+
+    def test_unchanged_if_stat_headers_and_remote_match(self):
+        manifest = self.saved_manifest()
+        self.assertTrue(manifest.is_unchanged(
+            "example-image.jpg", self.stat, self.headers,
+            (self.md5, self.size)))
+
+    def test_changed_if_headers_differ(self):
+        manifest = self.saved_manifest()
+        headers = dict(self.headers, **{"Cache-Control": "max-age=10"})
+        self.assertFalse(manifest.is_unchanged(
+            "example-image.jpg", self.stat, headers, (self.md5, self.size)))
+        self.assertFalse(manifest.headers_match("example-image.jpg",
+                                                headers))
+
+    def test_changed_if_remote_differs(self):
+        manifest = self.saved_manifest()
+        self.assertFalse(manifest.is_unchanged(
+            "example-image.jpg", self.stat, self.headers,
+            ("0" * 32, self.size)))
+
+    def test_verify_drops_stale_entries(self):
+        manifest = self.saved_manifest()
+        manifest.verify({})
+        self.assertEqual({}, manifest.remote_objects())
+
+    def test_only_confirmed_entries_are_saved(self):
+        manifest = self.saved_manifest()
+        manifest.save()
+        self.assertEqual({}, _Manifest(self.manifest_path).remote_objects())
+
+    @patch("s3sitedeploy._md5_of_file")
+    @patch("s3sitedeploy.Key")
+    def test_unchanged_file_is_not_hashed(self, mock_key, mock_md5):
+        manifest = self.saved_manifest()
+        self.assertEqual(None, upload_file(
+            self.filepath, self.bucket, self.config,
+            manifest.remote_objects(), manifest))
+        self.assertFalse(mock_md5.called)
+        self.assertFalse(mock_key.called)
+
+    @patch("s3sitedeploy.Key")
+    def test_header_change_copies_object_onto_itself(self, mock_key):
+        manifest = self.saved_manifest()
+        self.config = {"object_specific": [
+            {"path": ".*", "headers": {"Cache-Control": "max-age=10"}}]}
+        self.assertEqual(0, upload_file(
+            self.filepath, self.bucket, self.config,
+            manifest.remote_objects(), manifest))
+        self.assertFalse(mock_key.called)
+        args, kwargs = self.mock_bucket.copy_key.call_args
+        self.assertEqual(("example-image.jpg", self.mock_bucket.name,
+                          "example-image.jpg"), args)
+        self.assertEqual("max-age=10", kwargs["headers"]["Cache-Control"])
+
+    @patch("s3sitedeploy.Key")
+    def test_object_missing_from_manifest_is_copied_onto_itself(
+            self, mock_key):
+        manifest = _Manifest(self.manifest_path)
+        self.assertFalse(manifest.headers_match("example-image.jpg",
+                                                self.headers))
+        self.assertEqual(0, upload_file(
+            self.filepath, self.bucket, self.config,
+            {"example-image.jpg": (self.md5, self.size)}, manifest))
+        self.assertFalse(mock_key.called)
+        args, kwargs = self.mock_bucket.copy_key.call_args
+        self.assertEqual(("example-image.jpg", self.mock_bucket.name,
+                          "example-image.jpg"), args)
+        self.assertEqual("no-cache", kwargs["headers"]["Cache-Control"])
+
+    @patch("s3sitedeploy.Key")
+    def test_entry_dropped_by_verify_is_copied_onto_itself(self, mock_key):
+        manifest = self.saved_manifest()
+        manifest.verify({})
+        self.config = {"object_specific": [
+            {"path": ".*", "headers": {"Cache-Control": "max-age=10"}}]}
+        self.assertEqual(0, upload_file(
+            self.filepath, self.bucket, self.config,
+            {"example-image.jpg": (self.md5, self.size)}, manifest))
+        self.assertFalse(mock_key.called)
+        args, kwargs = self.mock_bucket.copy_key.call_args
+        self.assertEqual("max-age=10", kwargs["headers"]["Cache-Control"])
+
+    @patch("s3sitedeploy.Key")
+    def test_header_and_content_change_causes_upload(self, mock_key):
+        mock_key.return_value.set_contents_from_file.return_value = 3
+        manifest = self.saved_manifest()
+        self.config = {"object_specific": [
+            {"path": ".*", "headers": {"Cache-Control": "max-age=10"}}]}
+        self.assertEqual(3, upload_file(
+            self.filepath, self.bucket, self.config,
+            {"example-image.jpg": ("0" * 32, self.size)},
+            manifest))
+        self.assertFalse(self.mock_bucket.copy_key.called)
+
+    @patch("s3sitedeploy.Key")
+    def test_upload_is_recorded(self, mock_key):
+        mock_key.return_value.set_contents_from_file.return_value = 3
+        manifest = _Manifest(self.manifest_path)
+        upload_file(self.filepath, self.bucket, self.config, {}, manifest)
+        manifest.save()
+        self.assertEqual({"example-image.jpg": (self.md5, self.size)},
+                         _Manifest(self.manifest_path).remote_objects())
+
+
+class JournalTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.path = join(self.temp_dir, "journal")
+        self.filepath = join(self.temp_dir, "index.html")
+        with open(self.filepath, "w") as f:
+            f.write("<html></html>")
+        self.headers = {"Content-Type": "text/html"}
+        self.digests = _Digests()
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def record(self, headers=None):
+        journal = _Journal(self.path)
+        journal.bucket("bucket").record(
+            "index.html", md5(b"<html></html>").hexdigest(),
+            headers or self.headers)
+        journal.close()
+
+    def is_done(self, bucket_name="bucket", headers=None):
+        journal = _Journal(self.path)
+        self.addCleanup(journal.close)
+        return journal.bucket(bucket_name).is_done(
+            "index.html", self.filepath, headers or self.headers,
+            self.digests)
+
+    def test_recorded_entry_done_after_restart(self):
+        self.record()
+        self.assertTrue(self.is_done())
+
+    def test_entries_kept_by_bucket(self):
+        self.record()
+        self.assertFalse(self.is_done("other-bucket"))
+
+    def test_changed_content_not_done(self):
+        self.record()
+        with open(self.filepath, "w") as f:
+            f.write("<html>Changed</html>")
+        self.assertFalse(self.is_done())
+
+    def test_changed_headers_not_done(self):
+        self.record()
+        self.assertFalse(self.is_done(headers={"Content-Type": "text/plain"}))
+
+    def test_later_entry_wins(self):
+        self.record({"Content-Type": "text/plain"})
+        self.record()
+        self.assertTrue(self.is_done())
+
+    def test_torn_line_dropped(self):
+        self.record()
+        with open(self.path, "a") as f:
+            f.write('{"bucket": "bucket", "key": "ab')
+        self.record({"Content-Type": "text/plain"})
+        with open(self.path) as f:
+            self.assertEqual(2, len(f.read().splitlines()))
+        self.assertFalse(self.is_done())
+
+    @patch("s3sitedeploy.JOURNAL_SYNC_INTERVAL", 3600)
+    def test_synced_in_batches(self):
+        journal = _Journal(self.path).bucket("bucket")
+        with patch("s3sitedeploy.fsync") as mock_fsync:
+            for index in range(JOURNAL_SYNC_ENTRIES * 2 + 1):
+                journal.record("{0}.html".format(index), "0" * 32, {})
+            self.assertEqual(2, mock_fsync.call_count)
+            journal.journal.close()
+            self.assertEqual(3, mock_fsync.call_count)
+
+    def test_discard_removes_journal(self):
+        self.record()
+        _Journal(self.path).discard()
+        self.assertFalse(isfile(self.path))
+
+
+@patch("s3sitedeploy.RETRY_BASE_DELAY", 0.001)
+class MultipartUploadTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.filepath = join(self.temp_dir, "video.mp4")
+        with open(self.filepath, "wb") as f:
+            f.write(b"0123456789")
+        self.mock_bucket = Mock()
+        self.mock_bucket.initiate_multipart_upload.return_value.id = "up-1"
+        self.bucket = _S3Bucket(self.mock_bucket)
+        self.buckets = Mock()
+        self.buckets.get.return_value = self.bucket
+        self.limiter = _AdaptiveConcurrency(4, 4)
+        self.headers = {"Content-Type": "video/mp4",
+                        "Cache-Control": "max-age=60"}
+        self.uploaded = []
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def fake_upload_part(self, failures=(), error=None):
+        failures = list(failures)
+
+        def upload_part_from_file(f, part_number, size):
+            if part_number in failures:
+                failures.remove(part_number)
+                raise error or IOError("Connection reset")
+            self.uploaded.append((part_number, f.read(size)))
+            return Mock(etag='"etag-{0}"'.format(part_number))
+        return upload_part_from_file
+
+    def test_etag_of_single_part(self):
+        self.assertEqual(_md5_of_file(self.filepath),
+                         _etag_of_file(self.filepath)[1])
+
+    def test_etag_of_multiple_parts(self):
+        part_md5s = [md5(part).digest()
+                     for part in (b"0123", b"4567", b"89")]
+        expected = "{0}-3".format(md5(b"".join(part_md5s)).hexdigest())
+        self.assertEqual((_md5_of_file(self.filepath), expected),
+                         _etag_of_file(self.filepath, 4))
+
+    def test_part_size_below_threshold(self):
+        self.assertEqual(None, _multipart_part_size(
+            {"multipart_threshold": 100}, 99))
+
+    def test_part_size_from_config(self):
+        self.assertEqual(10, _multipart_part_size(
+            {"multipart_threshold": 100, "multipart_part_size": 10}, 100))
+
+    def test_part_size_raised_to_stay_within_part_limit(self):
+        self.assertEqual(2, _multipart_part_size(
+            {"multipart_threshold": 1, "multipart_part_size": 1}, 20000))
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_parts_uploaded_and_completed(self, mock_multipart):
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            self.fake_upload_part()
+        upload = _MultipartUpload(self.buckets, "video.mp4",
+                                  self.filepath, 4, self.headers,
+                                  self.limiter)
+        upload.help()
+        upload.finish()
+        self.mock_bucket.initiate_multipart_upload.assert_called_once_with(
+            "video.mp4", headers=self.headers)
+        self.assertEqual([(1, b"0123"), (2, b"4567"), (3, b"89")],
+                         self.uploaded)
+        self.mock_bucket.complete_multipart_upload.assert_called_once_with(
+            "video.mp4", "up-1",
+            "<CompleteMultipartUpload>"
+            "<Part><PartNumber>1</PartNumber><ETag>\"etag-1\"</ETag></Part>"
+            "<Part><PartNumber>2</PartNumber><ETag>\"etag-2\"</ETag></Part>"
+            "<Part><PartNumber>3</PartNumber><ETag>\"etag-3\"</ETag></Part>"
+            "</CompleteMultipartUpload>")
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_only_failed_part_is_retried(self, mock_multipart):
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            self.fake_upload_part(failures=[2])
+        upload = _MultipartUpload(self.buckets, "video.mp4",
+                                  self.filepath, 4, self.headers,
+                                  self.limiter)
+        upload.help()
+        upload.finish()
+        self.assertEqual([1, 2, 3], [part for part, _ in self.uploaded])
+        self.assertEqual(
+            4, mock_multipart.return_value.upload_part_from_file.call_count)
+
+    def help_while_first_part_is_sent(self, mock_multipart, memory):
+        """
+        Call help() as an idle worker while the thread which started the
+        upload is sending the first part, returning memory used by the
+        parts the idle worker sent
+        """
+        sending = Event()
+        sent = Event()
+        used = {}
+        idle_worker = current_thread()
+        upload_part = self.fake_upload_part()
+
+        def upload_part_from_file(f, part_number, size):
+            if part_number == 1:
+                sending.set()
+                sent.wait(5)
+            elif current_thread() is idle_worker:
+                used[part_number] = memory.used
+            return upload_part(f, part_number, size)
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            upload_part_from_file
+        upload = _MultipartUpload(self.buckets, "video.mp4", self.filepath,
+                                  4, self.headers, self.limiter, memory)
+        starter = Thread(target=lambda: (upload.help(wait=True),
+                                         upload.finish()))
+        starter.start()
+        self.assertTrue(sending.wait(5))
+        upload.help()
+        sent.set()
+        starter.join()
+        self.assertEqual([1, 2, 3], sorted(part for part, _ in self.uploaded))
+        return used
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_parts_alongside_the_first_reserve_their_size(
+            self, mock_multipart):
+        memory = _MemoryBudget(100)
+        self.assertEqual({2: 4, 3: 2}, self.help_while_first_part_is_sent(
+            mock_multipart, memory))
+        self.assertEqual(0, memory.used)
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_idle_workers_stop_helping_without_room(self, mock_multipart):
+        memory = _MemoryBudget(4)
+        memory.reserve(4)
+        self.assertEqual({}, self.help_while_first_part_is_sent(
+            mock_multipart, memory))
+        self.assertEqual(4, memory.used)
+
+    def test_file_sent_in_parts_reserves_a_part(self):
+        deploy = _Deploy(self.temp_dir, {"multipart_threshold": 10,
+                                         "multipart_part_size": 4},
+                         self.buckets, memory_budget=100)
+        self.assertEqual(4, deploy.memory_needed("video.mp4"))
+        deploy.config = {"multipart_threshold": 11}
+        self.assertEqual(10, deploy.memory_needed("video.mp4"))
+
+    def multipart_upload(self, part_size=4):
+        return _MultipartUpload(self.buckets, "video.mp4", self.filepath,
+                                part_size, self.headers, self.limiter)
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_aborted_if_part_keeps_failing(self, mock_multipart):
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            self.fake_upload_part(failures=[1] * UPLOAD_ATTEMPTS)
+        upload = self.multipart_upload()
+        upload.help()
+        self.assertRaises(IOError, upload.finish)
+        self.assertEqual(
+            UPLOAD_ATTEMPTS,
+            mock_multipart.return_value.upload_part_from_file.call_count)
+        self.mock_bucket.cancel_multipart_upload.assert_called_once_with(
+            "video.mp4", "up-1")
+        self.assertFalse(self.mock_bucket.complete_multipart_upload.called)
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_part_not_retried_if_retrying_cant_help(self, mock_multipart):
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            self.fake_upload_part([1], s3_error(403, "AccessDenied"))
+        upload = self.multipart_upload()
+        upload.help()
+        with self.assertRaises(S3ResponseError) as raised:
+            upload.finish()
+        self.assertEqual(FATAL, _classify_error(raised.exception))
+        self.assertEqual(
+            1, mock_multipart.return_value.upload_part_from_file.call_count)
+
+    @patch("s3sitedeploy.sleep")
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_part_retried_after_backoff(self, mock_multipart, mock_sleep):
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            self.fake_upload_part([2, 2])
+        upload = self.multipart_upload()
+        upload.help()
+        upload.finish()
+        self.assertEqual(2, mock_sleep.call_count)
+        # Each IOError is a transport error, after which the thread reconnects
+        self.assertEqual(2, self.buckets.reset.call_count)
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_throttled_part_cuts_concurrency(self, mock_multipart):
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            self.fake_upload_part([1], s3_error(503, "SlowDown"))
+        upload = self.multipart_upload()
+        upload.help()
+        upload.finish()
+        self.assertEqual(2, self.limiter.limit)
+        self.assertEqual(0, self.limiter.in_flight)
+        self.assertFalse(self.buckets.reset.called)
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_parts_wait_for_a_turn(self, mock_multipart):
+        in_flight = []
+
+        def upload_part_from_file(f, part_number, size):
+            in_flight.append(self.limiter.in_flight)
+            return Mock(etag='"etag-{0}"'.format(part_number))
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            upload_part_from_file
+        self.limiter = _AdaptiveConcurrency(1, 1)
+        self.limiter.acquire()
+        upload = self.multipart_upload()
+        helper = Thread(target=upload.help)
+        helper.start()
+        helper.join(0.1)
+        self.assertTrue(helper.is_alive())
+        self.limiter.release(0)
+        helper.join()
+        upload.finish()
+        self.assertEqual([1, 1, 1], in_flight)
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    def test_parts_shared_between_threads(self, mock_multipart):
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            self.fake_upload_part()
+        upload = self.multipart_upload(1)
+        helpers = [Thread(target=upload.help) for _ in range(3)]
+        for helper in helpers:
+            helper.start()
+        upload.help()
+        upload.finish()
+        for helper in helpers:
+            helper.join()
+        self.assertEqual(list(range(1, 11)),
+                         sorted(part for part, _ in self.uploaded))
+
+    @patch("s3sitedeploy.MultiPartUpload")
+    @patch("s3sitedeploy.Key")
+    def test_large_file_uploaded_in_parts_with_headers(self, mock_key,
+                                                       mock_multipart):
+        mock_multipart.return_value.upload_part_from_file.side_effect = \
+            self.fake_upload_part()
+        config = {"multipart_threshold": 5, "multipart_part_size": 5,
+                  "object_specific": [
+                      {"path": ".*",
+                       "headers": {"Cache-Control": "max-age=60"}}]}
+        offered = []
+        self.assertEqual(10, upload_file(
+            self.filepath, self.bucket, config,
+            helpers=offered.append))
+        self.assertFalse(mock_key.called)
+        self.assertEqual(1, len(offered))
+        self.mock_bucket.initiate_multipart_upload.assert_called_once_with(
+            "video.mp4", headers={"x-amz-acl": "public-read",
+                                  "Content-Type": "video/mp4",
+                                  "Cache-Control": "max-age=60"})
+
+    def test_multipart_etag_matches_remote(self):
+        remote = (_etag_of_file(self.filepath, 4)[1], 10)
+        self.assertTrue(_payload_matches_remote(self.filepath, remote, 4))
+        self.assertFalse(_payload_matches_remote(self.filepath, remote))
+
+
+class LocalBucketTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.bucket = LocalBucket(join(self.temp_dir, "bucket"))
+        self.filepath = join(self.temp_dir, "index.html")
+        with open(self.filepath, "wb") as f:
+            f.write(b"0123456789")
+        self.md5 = md5(b"0123456789").hexdigest()
+        self.headers = {"Content-Type": "text/html"}
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def read(self, key_name):
+        with open(join(self.temp_dir, "bucket", key_name), "rb") as f:
+            return f.read()
+
+    def test_put_keeps_headers_alongside(self):
+        self.assertEqual(10, self.bucket.put("text/index.html", self.filepath,
+                                             self.headers))
+        self.assertEqual(b"0123456789", self.read("text/index.html"))
+        self.assertEqual({"headers": self.headers, "etag": self.md5,
+                          "size": 10},
+                         self.bucket.metadata("text/index.html"))
+        self.assertEqual({"text/index.html": (self.md5, 10)},
+                         self.bucket.list())
+
+    def test_put_from_buffer(self):
+        self.bucket.put("index.html", BytesIO(b"abc"), self.headers)
+        self.assertEqual(b"abc", self.read("index.html"))
+
+    def test_put_checks_md5(self):
+        with self.assertRaises(S3ResponseError) as raised:
+            self.bucket.put("index.html", self.filepath, self.headers,
+                            "0" * 32)
+        self.assertEqual(FATAL, _classify_error(raised.exception))
+        self.assertEqual({}, self.bucket.list())
+
+    def test_put_with_bad_md5_leaves_previous_object(self):
+        self.bucket.put("index.html", BytesIO(b"before"), self.headers)
+        with self.assertRaises(S3ResponseError):
+            self.bucket.put("index.html", self.filepath, {}, "0" * 32)
+        self.assertEqual(b"before", self.read("index.html"))
+        self.assertEqual(self.headers,
+                         self.bucket.metadata("index.html")["headers"])
+        self.assertEqual([".s3sitedeploy", "index.html"],
+                         sorted(listdir(join(self.temp_dir, "bucket"))))
+
+    def test_upload_ids_unique_across_instances(self):
+        other = LocalBucket(join(self.temp_dir, "bucket"))
+        self.assertNotEqual(
+            self.bucket.start_multipart("index.html", self.headers),
+            other.start_multipart("index.html", self.headers))
+
+    def test_objects_put_there_by_something_else_listed(self):
+        mkdir(join(self.temp_dir, "bucket"))
+        with open(join(self.temp_dir, "bucket", "old.html"), "wb") as f:
+            f.write(b"0123456789")
+        self.assertEqual({"old.html": (self.md5, 10)}, self.bucket.list())
+
+    def test_copy(self):
+        self.bucket.put("index.html", self.filepath, self.headers)
+        self.bucket.copy("copy.html", "index.html", {"Cache-Control": "1"})
+        self.assertEqual(b"0123456789", self.read("copy.html"))
+        self.assertEqual({"headers": {"Cache-Control": "1"},
+                          "etag": self.md5, "size": 10},
+                         self.bucket.metadata("copy.html"))
+
+    def test_copy_of_missing_object(self):
+        with self.assertRaises(S3ResponseError) as raised:
+            self.bucket.copy("copy.html", "index.html", self.headers)
+        self.assertEqual(404, raised.exception.status)
+
+    def test_delete(self):
+        self.bucket.put("index.html", self.filepath, self.headers)
+        self.assertEqual([], self.bucket.delete(["index.html", "gone.html"]))
+        self.assertEqual({}, self.bucket.list())
+
+    def test_multipart_etag_as_s3_gives(self):
+        upload = _MultipartUpload(self.bucket, "index.html", self.filepath,
+                                  4, self.headers, _AdaptiveConcurrency(1, 1))
+        upload.help()
+        upload.finish()
+        self.assertEqual(b"0123456789", self.read("index.html"))
+        self.assertEqual(
+            {"index.html": (_etag_of_file(self.filepath, 4)[1], 10)},
+            self.bucket.list())
+        self.assertEqual(self.headers,
+                         self.bucket.metadata("index.html")["headers"])
+
+    @patch("s3sitedeploy.sleep")
+    def test_latency_added_to_requests(self, mock_sleep):
+        bucket = LocalBucket(join(self.temp_dir, "bucket"), 0.25)
+        bucket.put("index.html", self.filepath, self.headers)
+        bucket.list()
+        self.assertEqual(2, mock_sleep.call_count)
+        mock_sleep.assert_called_with(0.25)
+
+
+class ThreadLocalBucketTestCase(TestCase):
+
+    def setUp(self):
+        self.buckets = _ThreadLocalBucket("bucket", "id", "secret")
+
+    @patch("s3sitedeploy.S3Connection")
+    def test_bucket_not_validated(self, mock_conn):
+        self.buckets.get()
+        mock_conn.return_value.get_bucket.assert_called_once_with(
+            "bucket", validate=False)
+
+    @patch("s3sitedeploy.S3Connection")
+    def test_connects_to_region(self, mock_conn):
+        _ThreadLocalBucket("bucket", "id", "secret", "eu-west-1").get()
+        mock_conn.assert_called_once_with(
+            "id", "secret", host="s3.eu-west-1.amazonaws.com")
+
+    @patch("s3sitedeploy.S3Connection")
+    def test_default_region_uses_default_host(self, mock_conn):
+        _ThreadLocalBucket("bucket", "id", "secret", "us-east-1").get()
+        mock_conn.assert_called_once_with("id", "secret")
+
+    @patch("s3sitedeploy.S3Connection")
+    def test_connection_reused_within_thread(self, mock_conn):
+        self.assertIs(self.buckets.get(), self.buckets.get())
+        self.assertEqual(1, mock_conn.call_count)
+
+    @patch("s3sitedeploy.S3Connection")
+    def test_each_thread_has_own_connection(self, mock_conn):
+        mock_conn.side_effect = lambda *args: Mock()
+        seen = []
+        threads = [Thread(target=lambda: seen.append(self.buckets.get()))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, mock_conn.call_count)
+        self.assertEqual(3, len(set(id(bucket) for bucket in seen)))
+
+    @patch("s3sitedeploy.S3Connection")
+    def test_reset_reconnects(self, mock_conn):
+        mock_conn.side_effect = lambda *args: Mock()
+        first = self.buckets.get()
+        self.buckets.reset()
+        first.connection.close.assert_called_once_with()
+        self.assertIsNot(first, self.buckets.get())
+        self.assertEqual(2, mock_conn.call_count)
+
+
+class DeploySummaryTestCase(TestCase):
+
+    def test_records_outcomes(self):
+        summary = DeploySummary()
+        summary.record("a.html", UPLOADED)
+        summary.record("b.html", SKIPPED)
+        summary.record("c.html", SKIPPED)
+        self.assertEqual(1, summary.uploaded)
+        self.assertEqual(2, summary.skipped)
+        self.assertEqual([], summary.failed)
+        self.assertTrue(summary)
+
+    def test_falsy_if_anything_failed(self):
+        summary = DeploySummary()
+        summary.record("a.html", UPLOADED)
+        summary.record("b.html", FAILED)
+        self.assertEqual(["b.html"], summary.failed)
+        self.assertFalse(summary)
+
+    def test_falsy_if_any_stale_object_remains(self):
+        summary = DeploySummary()
+        summary.record_deletes(["a.html", "b.html"], ["b.html"])
+        self.assertEqual(1, summary.deleted)
+        self.assertEqual(["b.html"], summary.failed_deletes)
+        self.assertFalse(summary)
+
+    def test_falsy_if_deploy_failed(self):
+        summary = DeploySummary()
+        summary.error = IOError("Connection refused")
+        self.assertFalse(summary)
+
+
+class FanOutSummaryTestCase(TestCase):
+
+    def setUp(self):
+        self.summary = FanOutSummary(primary=DeploySummary(),
+                                     replica=DeploySummary())
+        self.summary["primary"].record("a.html", UPLOADED)
+        self.summary["replica"].record("a.html", SKIPPED)
+
+    def test_totals_across_buckets(self):
+        self.summary["replica"].record("b.html", UPLOADED)
+        self.assertEqual(2, self.summary.uploaded)
+        self.assertEqual(1, self.summary.skipped)
+        self.assertTrue(self.summary)
+
+    def test_falsy_if_any_bucket_failed(self):
+        self.summary["replica"].record("b.html", FAILED)
+        self.assertEqual(["replica/b.html"], self.summary.failed)
+        self.assertFalse(self.summary)
+
+
+class SharedPreparationTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.filepath = join(self.temp_dir, "index.html")
+        with open(self.filepath, "w") as f:
+            f.write("<html></html>" * 100)
+        self.compressor = Mock(side_effect=_compress_the_file)
+        self.shared = _SharedPreparation(2, self.compressor)
+        self.first = self.shared.consumer(0)
+        self.second = self.shared.consumer(1)
+
+    def tearDown(self):
+        self.shared.close()
+        rmtree(self.temp_dir)
+
+    def test_compressed_once_for_every_consumer(self):
+        with self.first(self.filepath, 6) as first:
+            with self.second(self.filepath, 6) as second:
+                self.assertEqual(first.read(), second.read())
+                self.assertEqual(first.md5, second.md5)
+        self.assertEqual(1, self.compressor.call_count)
+
+    def test_compressed_again_when_prepared_again(self):
+        self.first(self.filepath, 6).close()
+        self.first.done(self.filepath)
+        self.first(self.filepath, 6).close()
+        self.assertEqual(2, self.compressor.call_count)
+
+    def test_headers_are_copies(self):
+        config = _get_s3site_config(self.temp_dir)
+        headers, _ = self.first.headers(self.filepath, "index.html", config)
+        headers["Content-Type"] = "text/plain"
+        headers, _ = self.second.headers(self.filepath, "index.html", config)
+        self.assertEqual("text/html; charset=UTF-8", headers["Content-Type"])
+
+    @patch("s3sitedeploy.COMPRESSION_SPOOL_SIZE", 16)
+    def test_kept_until_every_consumer_done(self):
+        self.first(self.filepath, 6).close()
+        self.first.done(self.filepath)
+        kept = self.shared._entries[self.filepath]["compressed"][1]
+        self.assertTrue(isfile(kept))
+        self.second(self.filepath, 6).close()
+        self.second.done(self.filepath)
+        self.assertFalse(isfile(kept))
+        self.assertEqual({}, self.shared._entries)
+
+    def test_nothing_kept_for_retired_consumer(self):
+        self.second.retire()
+        self.first(self.filepath, 6).close()
+        self.first.done(self.filepath)
+        self.assertEqual({}, self.shared._entries)
+
+    def test_nothing_kept_for_retry_after_every_consumer_done(self):
+        for consumer in (self.first, self.second):
+            consumer(self.filepath, 6).close()
+            consumer.done(self.filepath)
+        self.first(self.filepath, 6).close()
+        self.assertEqual({}, self.shared._entries)
+        self.assertEqual(2, self.compressor.call_count)
+
+    def test_kept_output_charged_to_memory_budget(self):
+        self.shared.memory = _MemoryBudget(10000)
+        self.first(self.filepath, 6).close()
+        self.first.done(self.filepath)
+        self.assertTrue(self.shared.memory.used > 0)
+        self.second(self.filepath, 6).close()
+        self.second.done(self.filepath)
+        self.assertEqual(0, self.shared.memory.used)
+
+    def test_kept_in_a_file_beyond_memory_budget(self):
+        self.shared.memory = _MemoryBudget(8)
+        self.first(self.filepath, 6).close()
+        self.first.done(self.filepath)
+        kept = self.shared._entries[self.filepath]["compressed"][1]
+        self.assertTrue(isfile(kept))
+        self.assertEqual(0, self.shared.memory.used)
+        with self.second(self.filepath, 6) as second:
+            with self.first(self.filepath, 6) as first:
+                self.assertEqual(first.read(), second.read())
+
+
+class FanOutTestCase(TestCase):
+
+    def test_every_consumer_gets_every_item(self):
+        fan_out = _FanOut(iter(range(5)), 2)
+        self.assertEqual(list(range(5)), list(fan_out.consumer(0)))
+        self.assertEqual(list(range(5)), list(fan_out.consumer(1)))
+
+    @patch("s3sitedeploy.FAN_OUT_LEAD", 1)
+    def test_stopped_consumer_does_not_hold_back_others(self):
+        fan_out = _FanOut(iter(range(5)), 2)
+        fan_out.stop(1)
+        self.assertEqual(list(range(5)), list(fan_out.consumer(0)))
+
+    def test_walk_errors_raised_to_every_consumer(self):
+        def _files():
+            yield 1
+            raise OSError("Gone")
+        fan_out = _FanOut(_files(), 2)
+        for index in range(2):
+            consumer = fan_out.consumer(index)
+            self.assertEqual(1, next(consumer))
+            self.assertRaises(OSError, next, consumer)
+
+
+@patch("s3sitedeploy.RETRY_BASE_DELAY", 0.001)
+class PruneTestCase(TestCase):
+
+    def setUp(self):
+        self.buckets = Mock()
+        self.buckets.get.return_value = _S3Bucket(Mock())
+        self.delete_keys = self.buckets.get.return_value.bucket.delete_keys
+        self.delete_keys.return_value.errors = []
+
+    def test_stale_keys_are_remote_but_not_local(self):
+        self.assertEqual(
+            ["old.html", "text/old.txt"],
+            _stale_keys({"index.html": None, "old.html": None,
+                         "text/old.txt": None, "archive/2001.html": None},
+                        {"index.html"}, [r"^archive/"]))
+
+    def test_batches_of_at_most_1000_keys(self):
+        summary = DeploySummary()
+        keys = ["{0}.html".format(i) for i in range(2500)]
+        _prune_stale_objects(self.buckets, keys, 3, summary)
+        self.assertEqual(2500, summary.deleted)
+        sizes = sorted(len(call[0][0])
+                       for call in self.delete_keys.call_args_list)
+        self.assertEqual([500, 1000, 1000], sizes)
+        self.delete_keys.assert_called_with(ANY, quiet=True)
+
+    def test_keys_not_deleted_returned(self):
+        error = Mock(key="b.html", code="AccessDenied", message="")
+        self.delete_keys.return_value.errors = [error]
+        self.assertEqual(["b.html"],
+                         _delete_batch(self.buckets, ["a.html", "b.html"]))
+
+    def test_request_retried_after_transport_error(self):
+        result = self.delete_keys.return_value
+        self.delete_keys.side_effect = [ConnectionResetError(), result]
+        self.assertEqual([], _delete_batch(self.buckets, ["a.html"]))
+        self.assertEqual(1, self.buckets.reset.call_count)
+
+    def test_whole_batch_fails_on_fatal_error(self):
+        self.delete_keys.side_effect = s3_error(403, "AccessDenied")
+        self.assertEqual(["a.html"], _delete_batch(self.buckets, ["a.html"]))
+        self.assertEqual(1, self.delete_keys.call_count)
+
+
+class StreamingUploadTestCase(TestCase):
+
+    def setUp(self):
+        self.first_uploaded = Event()
+        self.buckets = Mock()
+
+    def files_found_after_first_upload(self):
+        yield "first.txt"
+        if not self.first_uploaded.wait(5):
+            raise AssertionError("Walk finished before uploads started")
+        for i in range(20):
+            yield "{0}.txt".format(i)
+
+    def fake_upload(self, filepath, *args, **kwargs):
+        self.first_uploaded.set()
+        return 1
+
+    @patch("s3sitedeploy._Deploy.upload_file")
+    def test_thread_pool_uploads_while_walking(self, mock_upload):
+        mock_upload.side_effect = self.fake_upload
+        summary = DeploySummary()
+        deploy = _Deploy("site", {}, self.buckets, concurrency=3)
+        _upload_with_thread_pool(
+            deploy, self.files_found_after_first_upload(), summary)
+        self.assertEqual(21, summary.uploaded)
+
+    @patch("s3sitedeploy._Deploy.upload_file")
+    def test_files_taken_ahead_are_bounded(self, mock_upload):
+        taken = []
+        in_flight = []
+
+        def files():
+            for i in range(50):
+                taken.append(i)
+                in_flight.append(len(taken) - mock_upload.call_count)
+                yield "{0}.txt".format(i)
+        mock_upload.return_value = 1
+        summary = DeploySummary()
+        deploy = _Deploy("site", {}, self.buckets, concurrency=2)
+        _upload_with_thread_pool(deploy, files(), summary)
+        self.assertEqual(50, summary.uploaded)
+        self.assertTrue(max(in_flight) <= 2 * PENDING_PER_WORKER + 1)
+
+    @patch("s3sitedeploy._Deploy.upload_file")
+    def test_a_worker_for_every_compression_process(self, mock_upload):
+        compressing = Barrier(4, timeout=5)
+
+        def compress_alongside_others(filepath, *args):
+            compressing.wait()
+            return 1
+        mock_upload.side_effect = compress_alongside_others
+        summary = DeploySummary()
+        deploy = _Deploy("site", {}, self.buckets,
+                         compressor=Mock(processes=4), concurrency=2)
+        _upload_with_thread_pool(
+            deploy, ["{0}.txt".format(i) for i in range(8)], summary)
+        self.assertEqual(8, summary.uploaded)
+
+    @patch("s3sitedeploy.RETRY_BASE_DELAY", 0.001)
+    @patch("s3sitedeploy._Deploy.upload_file")
+    def test_failed_file_retried_without_holding_worker(self, mock_upload):
+        attempts = []
+
+        def upload_fails_first_time(filepath, *args):
+            attempts.append(filepath)
+            if attempts.count(filepath) == 1 and filepath == "a.txt":
+                raise s3_error(500, "InternalError")
+            return 1
+        mock_upload.side_effect = upload_fails_first_time
+        summary = DeploySummary()
+        deploy = _Deploy("site", {}, self.buckets, concurrency=1)
+        _upload_with_thread_pool(deploy, ["a.txt", "b.txt"], summary)
+        self.assertEqual(2, summary.uploaded)
+        self.assertEqual(["a.txt", "a.txt", "b.txt"], sorted(attempts))
+
+    @patch("s3sitedeploy._Deploy.upload_file")
+    def test_fatal_errors_not_retried(self, mock_upload):
+        mock_upload.side_effect = s3_error(403, "AccessDenied")
+        summary = DeploySummary()
+        deploy = _Deploy("site", {}, self.buckets, concurrency=2)
+        _upload_with_thread_pool(deploy, ["a.txt"], summary)
+        self.assertEqual(["a.txt"], summary.failed)
+        self.assertEqual("AccessDenied",
+                         summary.errors["a.txt"].error_code)
+        self.assertEqual(1, mock_upload.call_count)
+
+
+def s3_error(status, code):
+    return S3ResponseError(
+        status, "", "<Error><Code>{0}</Code></Error>".format(code))
+
+
+class ClassifyErrorTestCase(TestCase):
+
+    def test_slow_down_is_throttling(self):
+        self.assertEqual(THROTTLED, _classify_error(s3_error(503, "SlowDown")))
+
+    def test_server_errors_retryable(self):
+        self.assertEqual(RETRYABLE,
+                         _classify_error(s3_error(500, "InternalError")))
+        self.assertEqual(RETRYABLE,
+                         _classify_error(s3_error(400, "RequestTimeout")))
+
+    def test_transport_errors_retryable(self):
+        self.assertEqual(RETRYABLE,
+                         _classify_error(ConnectionResetError()))
+
+    def test_client_errors_fatal(self):
+        self.assertEqual(FATAL, _classify_error(s3_error(403, "AccessDenied")))
+
+    def test_backoff_grows_with_jitter_up_to_maximum(self):
+        delays = [_backoff_delay(1) for _ in range(100)]
+        self.assertTrue(all(0 <= delay <= 0.25 for delay in delays))
+        self.assertTrue(len(set(delays)) > 1)
+        self.assertTrue(max(_backoff_delay(4) for _ in range(100)) > 0.25)
+        self.assertTrue(_backoff_delay(100) <= RETRY_MAX_DELAY)
+
+
+class AdaptiveConcurrencyTestCase(TestCase):
+
+    def acquire_all(self, limiter):
+        tokens = []
+        while True:
+            token = limiter.try_acquire()
+            if token is None:
+                return tokens
+            tokens.append(token)
+
+    def test_limits_requests_in_flight(self):
+        limiter = _AdaptiveConcurrency(3, 10)
+        self.assertEqual(3, len(self.acquire_all(limiter)))
+
+    def test_grows_while_latency_steady(self):
+        limiter = _AdaptiveConcurrency(2, 5)
+        for _ in range(50):
+            for token in self.acquire_all(limiter):
+                limiter.release(token, 0.1)
+        self.assertEqual(5, len(self.acquire_all(limiter)))
+
+    def test_holds_while_latency_rising(self):
+        limiter = _AdaptiveConcurrency(2, 10)
+        latency = 0.1
+        for _ in range(50):
+            for token in self.acquire_all(limiter):
+                limiter.release(token, latency)
+            latency *= 2
+        self.assertTrue(int(limiter.limit) < 10)
+
+    def test_halved_once_per_throttling_episode(self):
+        limiter = _AdaptiveConcurrency(8, 8)
+        for token in self.acquire_all(limiter):
+            limiter.release(token, error=s3_error(503, "SlowDown"))
+        self.assertEqual(4, limiter.limit)
+        for token in self.acquire_all(limiter):
+            limiter.release(token, error=s3_error(503, "SlowDown"))
+        self.assertEqual(2, limiter.limit)
+
+    def test_other_errors_leave_limit(self):
+        limiter = _AdaptiveConcurrency(8, 8)
+        limiter.release(limiter.try_acquire(),
+                        error=s3_error(403, "AccessDenied"))
+        self.assertEqual(8, limiter.limit)
+
+    def test_never_below_minimum(self):
+        limiter = _AdaptiveConcurrency(1, 8)
+        limiter.release(limiter.try_acquire(),
+                        error=s3_error(503, "SlowDown"))
+        self.assertEqual(1, limiter.limit)
+
+    def test_acquire_waits_for_release(self):
+        limiter = _AdaptiveConcurrency(1, 1)
+        token = limiter.acquire()
+        acquired = Event()
+        waiter = Thread(target=lambda: (limiter.acquire(), acquired.set()))
+        waiter.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(token, 0.1)
+        self.assertTrue(acquired.wait(5))
+        waiter.join()
+
+
+class MemoryBudgetTestCase(TestCase):
+
+    def test_reservations_kept_within_budget(self):
+        budget = _MemoryBudget(100)
+        self.assertTrue(budget.try_reserve(60))
+        self.assertFalse(budget.try_reserve(60))
+        self.assertTrue(budget.try_reserve(40))
+        budget.release(60)
+        self.assertTrue(budget.try_reserve(60))
+
+    def test_files_larger_than_budget_dont_fit(self):
+        self.assertTrue(_MemoryBudget(100).fits(100))
+        self.assertFalse(_MemoryBudget(100).fits(101))
+        self.assertTrue(_MemoryBudget(None).fits(10 ** 12))
+        self.assertTrue(_MemoryBudget(None).try_reserve(10 ** 12))
+
+    def test_reserve_waits_for_release(self):
+        budget = _MemoryBudget(100)
+        budget.reserve(80)
+        reserved = Event()
+        waiter = Thread(target=lambda: (budget.reserve(30), reserved.set()))
+        waiter.start()
+        self.assertFalse(reserved.wait(0.1))
+        budget.release(80)
+        self.assertTrue(reserved.wait(5))
+        waiter.join()
+        self.assertEqual(30, budget.used)
+
+
+@patch("s3sitedeploy.RETRY_BASE_DELAY", 0.001)
+class RetryQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.retries = _RetryQueue()
+        self.error = s3_error(500, "InternalError")
+
+    def test_fresh_files_handed_out_in_order(self):
+        scheduled = []
+        for filepath, attempt in self.retries.schedule(["a", "b"]):
+            scheduled.append((filepath, attempt))
+            self.retries.done()
+        self.assertEqual([("a", 1), ("b", 1)], scheduled)
+
+    def test_failed_files_retried_after_fresh_work(self):
+        scheduled = []
+        for filepath, attempt in self.retries.schedule(["a", "b", "c"]):
+            scheduled.append((filepath, attempt))
+            if (filepath, attempt) == ("a", 1):
+                self.assertTrue(self.retries.failed("a", 1, self.error))
+            else:
+                self.retries.done()
+        self.assertEqual(("a", 2), scheduled[-1])
+        self.assertEqual(4, len(scheduled))
+
+    def test_retry_waits_for_its_backoff(self):
+        with patch("s3sitedeploy.RETRY_BASE_DELAY", 60):
+            scheduled = self.retries.schedule(["a", "b"])
+            next(scheduled)
+            self.retries.failed("a", 1, self.error)
+            self.assertEqual(("b", 1), next(scheduled))
+
+    def test_given_up_after_attempts(self):
+        self.assertFalse(
+            self.retries.failed("a", UPLOAD_ATTEMPTS, self.error))
+
+    def test_fatal_errors_not_retried(self):
+        self.assertFalse(
+            self.retries.failed("a", 1, s3_error(403, "AccessDenied")))
+
+    def test_budget_limits_retries_across_files(self):
+        retried = [self.retries.failed(str(i), 1, self.error)
+                   for i in range(RETRY_BUDGET_MIN + 5)]
+        self.assertEqual(RETRY_BUDGET_MIN, retried.count(True))
+        self.assertFalse(retried[-1])
+
+
+class DeduplicatorTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.retries = Mock()
+        self.deploy = _Deploy(self.temp_dir, {"gzip_mimetypes": ["text/html"]},
+                              Mock(), deduplicate=True)
+        self.deduplicator = self.deploy.deduplicator
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def write_files(self, contents, *names):
+        for name in names:
+            with open(join(self.temp_dir, name), "w") as f:
+                f.write(contents)
+        return list(names)
+
+    def discover(self, files):
+        return list(self.deploy.discover(files, self.retries))
+
+    def test_duplicates_held_until_source_finishes(self):
+        big = "x" * DEDUPLICATE_MIN_SIZE
+        files = self.write_files(big, "a.txt", "b.txt", "c.txt")
+        self.assertEqual(["a.txt"], self.discover(files))
+        self.assertEqual(2, self.retries.hold.call_count)
+        self.deploy.finished("a.txt", UPLOADED)
+        self.retries.release.assert_any_call("b.txt")
+        self.retries.release.assert_any_call("c.txt")
+        self.assertEqual({"b.txt": "a.txt", "c.txt": "a.txt"},
+                         self.deduplicator.sources)
+
+    def test_duplicates_of_finished_source_copied_straight_away(self):
+        files = self.write_files("x" * DEDUPLICATE_MIN_SIZE, "a.txt", "b.txt")
+        discovered = self.deploy.discover(iter(files), self.retries)
+        next(discovered)
+        self.deploy.finished("a.txt", SKIPPED)
+        self.assertEqual("b.txt", next(discovered))
+        self.assertEqual({"b.txt": "a.txt"}, self.deduplicator.sources)
+
+    def test_duplicates_uploaded_if_source_failed(self):
+        files = self.write_files("x" * DEDUPLICATE_MIN_SIZE, "a.txt", "b.txt")
+        self.discover(files)
+        self.deploy.finished("a.txt", FAILED)
+        self.retries.release.assert_called_once_with("b.txt")
+        self.assertEqual({}, self.deduplicator.sources)
+
+    def test_small_files_not_deduplicated(self):
+        files = self.write_files("x", "a.txt", "b.txt")
+        self.assertEqual(files, self.discover(files))
+
+    def test_files_gzipped_differently_not_duplicates(self):
+        files = self.write_files("x" * DEDUPLICATE_MIN_SIZE, "a.txt",
+                                 "a.html")
+        self.assertEqual(files, self.discover(files))
+
+    def test_copy_only_for_single_request_uploads(self):
+        self.deduplicator.sources["b.txt"] = "a.txt"
+        upload = Mock(destination_key="b.txt", part_size=None,
+                      metadata_only=False)
+        self.assertEqual("a.txt", self.deploy.copy_source(upload))
+        upload.part_size = 16 * 1024 * 1024
+        self.assertEqual(None, self.deploy.copy_source(upload))
+
+    def test_header_only_change_copied_onto_itself(self):
+        self.deduplicator.sources["b.txt"] = "a.txt"
+        upload = Mock(destination_key="b.txt", part_size=None,
+                      metadata_only=True)
+        self.assertEqual("b.txt", self.deploy.copy_source(upload))
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.metrics = _Metrics()
+
+    def upload(self, key, size, payload_size):
+        return _PreparedUpload(key, key, {}, key, payload_size, None, size)
+
+    def test_phases_summed(self):
+        self.metrics.add("compress", 0.5)
+        self.metrics.add("compress", 0.25)
+        with self.metrics.phase("walk"):
+            pass
+        self.assertEqual([0.75, 2], self.metrics.phases["compress"])
+        self.assertEqual(1, self.metrics.phases["walk"][1])
+
+    def test_timed_iterable_counted_as_phase(self):
+        self.assertEqual([1, 2], list(self.metrics.timed("walk", [1, 2])))
+        self.assertEqual(3, self.metrics.phases["walk"][1])
+
+    def test_report(self):
+        for i in range(20):
+            self.metrics.attempt("{0}.html".format(i))
+            self.metrics.uploaded(self.upload("{0}.html".format(i), 100, 40),
+                                  i / 1000.0)
+        self.metrics.attempt("19.html")
+        summary = DeploySummary()
+        summary.record("gone.html", FAILED)
+        report = self.metrics.report(summary)
+        self.assertEqual(2000, report["bytes"]["before_compression"])
+        self.assertEqual(800, report["bytes"]["after_compression"])
+        self.assertEqual(1, report["retries"])
+        self.assertEqual(["gone.html"], report["objects"]["failed"])
+        self.assertEqual(10, report["latency_ms"]["p50"])
+        self.assertEqual(19, report["latency_ms"]["max"])
+        histogram = report["latency_ms"]["histogram"]
+        self.assertEqual(20, sum(bucket["count"] for bucket in histogram))
+        self.assertEqual({"le": 1, "count": 2}, histogram[0])
+        self.assertEqual(10, len(report["slowest"]))
+        self.assertEqual({"bucket": None, "key": "19.html", "ms": 19,
+                          "bytes": 100, "transmitted": 40, "attempts": 2},
+                         report["slowest"][0])
+
+    def test_buckets_counted_apart(self):
+        for bucket_name in ("www", "replica"):
+            self.metrics.attempt("index.html", bucket_name)
+            self.metrics.uploaded(self.upload("index.html", 100, 40), 0.01,
+                                  bucket_name=bucket_name)
+        report = self.metrics.report(DeploySummary())
+        self.assertEqual(0, report["retries"])
+        self.assertEqual(80, report["bytes"]["transmitted"])
+        self.assertEqual(["replica", "www"], sorted(
+            slow["bucket"] for slow in report["slowest"]))
+
+    def test_nobody_counting(self):
+        with _NO_METRICS.phase("walk"):
+            _NO_METRICS.uploaded(self.upload("a.html", 1, 1), 1)
+        self.assertEqual({}, _NO_METRICS.phases)
+        self.assertEqual({}, _NO_METRICS.objects)
+
+    def test_profile_covers_threads(self):
+        temp_dir = mkdtemp()
+        self.addCleanup(rmtree, temp_dir)
+        path = join(temp_dir, "deploy.prof")
+
+        def _in_thread():
+            list(_iter_files_in_dir("tests/fixtures"))
+        with _profiled(path):
+            thread = Thread(target=_in_thread)
+            thread.start()
+            thread.join()
+        profiled = [function for _, _, function in
+                    pstats.Stats(path).stats]
+        self.assertIn("_iter_files_in_dir", profiled)
+
+
+class ShardTestCase(TestCase):
+
+    def test_stable_across_runs(self):
+        self.assertEqual(
+            [0, 0, 3, 2],
+            [_shard_of(key, 4) for key in
+             ("index.html", "a", "page-0.html", "page-1.html")])
+
+    def test_keys_spread_evenly(self):
+        shards = [_shard_of("page-{0}.html".format(i), 4)
+                  for i in range(4000)]
+        for shard in range(4):
+            self.assertTrue(900 < shards.count(shard) < 1100)
+
+    def test_shard_index_must_be_in_range(self):
+        for shard_index in (-1, 3):
+            self.assertRaises(
+                ValueError, parallel_upload_dir_to_s3,
+                "tests/fixtures/example-multi-depth-project", "bucket",
+                "dkf20fj", "3jf9d0sf", shard_index=shard_index,
+                shard_count=3)
+
+
+class DigestsTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.filepath = join(self.temp_dir, "index.html")
+        with open(self.filepath, "wb") as f:
+            f.write(b"0123456789")
+        self.digests = _Digests()
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_file_hashed_once(self):
+        with patch("s3sitedeploy._etag_of_file",
+                   side_effect=_etag_of_file) as mock_etag:
+            self.assertEqual(md5(b"0123456789").hexdigest(),
+                             self.digests.md5(self.filepath))
+            self.digests.md5(self.filepath)
+            self.digests.etag(self.filepath)
+        self.assertEqual(1, mock_etag.call_count)
+
+    def test_multipart_etag_kept_by_part_size(self):
+        self.assertEqual(_etag_of_file(self.filepath, 4),
+                         self.digests.etag(self.filepath, 4))
+        with patch("s3sitedeploy._etag_of_file") as mock_etag:
+            self.digests.md5(self.filepath)
+            self.digests.etag(self.filepath, 4)
+        self.assertFalse(mock_etag.called)
+
+    def test_changed_file_hashed_again(self):
+        self.digests.md5(self.filepath)
+        with open(self.filepath, "wb") as f:
+            f.write(b"changed, and a different size")
+        self.assertEqual(md5(b"changed, and a different size").hexdigest(),
+                         self.digests.md5(self.filepath))
+
+    def test_digest_added_from_elsewhere(self):
+        self.digests.add(self.filepath, "0" * 32)
+        self.assertEqual("0" * 32, self.digests.md5(self.filepath))
+
+    def test_empty_file(self):
+        empty = join(self.temp_dir, "empty.txt")
+        open(empty, "w").close()
+        self.assertEqual(md5().hexdigest(), self.digests.md5(empty))
+
+    @patch("s3sitedeploy._etag_of_file", side_effect=_etag_of_file)
+    def test_gzipped_upload_not_hashed_again(self, mock_etag):
+        manifest = _Manifest(join(self.temp_dir, "manifest.json"))
+        upload = _prepare_upload(self.filepath, "index.html",
+                                 {"gzip_mimetypes": ["text/html"]}, {},
+                                 manifest, digests=self.digests)
+        # Only ever asked for the digest gzipping already attached
+        for args, _ in mock_etag.call_args_list:
+            self.assertTrue(args[0].md5)
+        self.assertEqual(md5(upload.read()).hexdigest(), upload.md5)
+        self.assertEqual(md5(b"0123456789").hexdigest(),
+                         upload.manifest_entry[2])
+
+    def test_upload_carries_md5_for_content_md5(self):
+        self.digests.md5(self.filepath)
+        with patch("s3sitedeploy._etag_of_file",
+                   side_effect=_etag_of_file) as mock_etag, \
+                patch("s3sitedeploy._etag_of_buffer") as mock_buffer_etag:
+            upload = _prepare_upload(self.filepath, "index.html", {},
+                                     digests=self.digests)
+        self.assertNotIn(self.filepath, [
+            args[0] for args, _ in mock_etag.call_args_list])
+        self.assertFalse(mock_buffer_etag.called)
+        self.assertEqual(md5(b"0123456789").hexdigest(), upload.md5)
+
+    def test_upload_sent_from_the_read_it_is_hashed_in(self):
+        with patch("s3sitedeploy.mmap") as mock_mmap:
+            upload = _prepare_upload(self.filepath, "index.html", {},
+                                     digests=self.digests)
+        self.assertFalse(mock_mmap.called)
+        self.assertEqual(b"0123456789", upload.payload.getvalue())
+        self.assertEqual(md5(b"0123456789").hexdigest(), upload.md5)
+        self.assertEqual(upload.md5, self.digests.md5(self.filepath))
+
+    def test_streamed_upload_sent_from_disk(self):
+        upload = _prepare_upload(self.filepath, "index.html", {},
+                                 digests=self.digests, streaming=True)
+        self.assertEqual(self.filepath, upload.payload)
+
+
+class ResolveChangesTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        mkdir(join(self.temp_dir, "css"))
+        for relative_path in ("index.html", "css/a.css", "css/b.css",
+                              "s3sitedeploy.json"):
+            with open(join(self.temp_dir, relative_path), "w") as f:
+                f.write("x")
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_changed_files_uploaded(self):
+        self.assertEqual((set(["index.html"]), set()), _resolve_changes(
+            self.temp_dir, ["index.html"], set(["index.html"])))
+
+    def test_removed_files_deleted(self):
+        self.assertEqual((set(), set(["old.html"])), _resolve_changes(
+            self.temp_dir, ["old.html"], set(["old.html", "index.html"])))
+
+    def test_files_never_deployed_not_deleted(self):
+        self.assertEqual((set(), set()), _resolve_changes(
+            self.temp_dir, [".index.html.swp"], set(["index.html"])))
+
+    def test_directory_uploaded_and_pruned(self):
+        self.assertEqual(
+            (set(["css/a.css", "css/b.css"]), set(["css/gone.css"])),
+            _resolve_changes(self.temp_dir, ["css"],
+                             set(["css/a.css", "css/gone.css", "index.html"])))
+
+    def test_unreadable_directory_not_deleted(self):
+        def scandir_but_css(path):
+            if path.endswith("css/"):
+                raise PermissionError(13, "Permission denied")
+            return scandir(path)
+        with patch("s3sitedeploy.scandir", side_effect=scandir_but_css):
+            to_upload, to_delete = _resolve_changes(
+                self.temp_dir, [""], set(["css/a.css", "old.html"]))
+        self.assertEqual(set(["index.html"]), to_upload)
+        self.assertEqual(set(["old.html"]), to_delete)
+
+    def test_removed_directory_deleted(self):
+        self.assertEqual((set(), set(["js/a.js", "js/b.js"])),
+                         _resolve_changes(
+                             self.temp_dir, ["js"],
+                             set(["js/a.js", "js/b.js", "json.txt"])))
+
+    def test_everything_changed(self):
+        to_upload, to_delete = _resolve_changes(self.temp_dir, [""],
+                                                set(["old.html"]))
+        self.assertEqual(set(["index.html", "css/a.css", "css/b.css"]),
+                         to_upload)
+        self.assertEqual(set(["old.html"]), to_delete)
+
+
+class WatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        with open(join(self.temp_dir, "index.html"), "w") as f:
+            f.write("<html></html>")
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def changes_until(self, watcher, expected):
+        changed = set()
+        for _ in range(50):
+            changed |= watcher.changes(0.1)
+            if expected <= changed:
+                break
+        return changed
+
+    def make_changes(self):
+        with open(join(self.temp_dir, "index.html"), "w") as f:
+            f.write("<html>Changed</html>")
+        mkdir(join(self.temp_dir, "css"))
+        with open(join(self.temp_dir, "css", "site.css"), "w") as f:
+            f.write("body {}")
+
+    def test_polling_watcher(self):
+        watcher = _PollingWatcher(self.temp_dir, 0.01)
+        self.assertEqual(set(), watcher.changes(0))
+        self.make_changes()
+        self.assertEqual(set(["index.html", "css/site.css"]),
+                         self.changes_until(watcher, set(["css/site.css"])))
+        remove(join(self.temp_dir, "index.html"))
+        self.assertEqual(set(["index.html"]),
+                         self.changes_until(watcher, set(["index.html"])))
+
+    def test_inotify_watcher(self):
+        try:
+            watcher = _InotifyWatcher(self.temp_dir)
+        except (OSError, AttributeError):
+            self.skipTest("inotify isn't available")
+        try:
+            self.assertEqual(set(), watcher.changes(0))
+            self.make_changes()
+            changed = self.changes_until(watcher,
+                                         set(["index.html", "css"]))
+            self.assertIn("index.html", changed)
+            self.assertIn("css", changed)
+            with open(join(self.temp_dir, "css", "site.css"), "a") as f:
+                f.write("p {}")
+            self.assertIn("css/site.css", self.changes_until(
+                watcher, set(["css/site.css"])))
+        finally:
+            watcher.close()
+
+
+class NextBatchTestCase(TestCase):
+
+    def watcher(self, *batches):
+        batches = list(batches)
+        watcher = Mock()
+        watcher.changes.side_effect = \
+            lambda timeout: set(batches.pop(0)) if batches else set()
+        return watcher
+
+    def test_changes_gathered_until_they_settle(self):
+        watcher = self.watcher([], ["a"], ["b"], ["a", "c"], [], ["d"])
+        self.assertEqual(set(["a", "b", "c"]),
+                         _next_batch(watcher, Event(), 0.01))
+
+    def test_batch_cut_off_after_max_delay(self):
+        watcher = Mock()
+        watcher.changes.side_effect = lambda timeout: set(["a"])
+        self.assertEqual(set(["a"]), _next_batch(watcher, Event(), 0.01,
+                                                 max_delay=0.05))
+
+    def test_nothing_once_stopped(self):
+        stop = Event()
+        stop.set()
+        self.assertEqual(set(), _next_batch(self.watcher(["a"]), stop))
+
+
+class ArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.site = "tests/fixtures/example-multi-depth-project"
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def tar(self, name="site.tar.gz", mode="w:gz", arcname="."):
+        path = join(self.temp_dir, name)
+        with tarfile.open(path, mode) as archive:
+            archive.add(self.site, arcname)
+        return path
+
+    def zip(self, prefix=""):
+        path = join(self.temp_dir, "site.zip")
+        with zipfile.ZipFile(path, "w") as archive:
+            for relative_path in set(_iter_files_in_dir(self.site)) | \
+                    {"s3sitedeploy.json"}:
+                archive.write(join(self.site, relative_path),
+                              prefix + relative_path)
+        return path
+
+    def assertMatchesSite(self, archive):
+        self.addCleanup(archive.close)
+        self.assertEqual(_get_s3site_config(self.site)["gzip_mimetypes"],
+                         archive.config()["gzip_mimetypes"])
+        files = list(archive.files())
+        self.assertEqual(set(_iter_files_in_dir(self.site)), set(files))
+        for relative_path in files:
+            with open(join(self.site, relative_path), "rb") as f:
+                contents = f.read()
+            handle = archive.open(relative_path)
+            self.assertEqual(contents, handle.read())
+            self.assertEqual(md5(contents).hexdigest(), handle.md5)
+            self.assertEqual(relative_path, handle.path)
+            self.assertEqual(len(contents), handle.stat.st_size)
+
+    def test_gzipped_tar(self):
+        self.assertMatchesSite(_Archive(self.tar()))
+
+    def test_tar(self):
+        self.assertMatchesSite(_Archive(self.tar("site.tar", "w")))
+
+    def test_zip(self):
+        self.assertMatchesSite(_Archive(self.zip()))
+
+    def test_subdirectory(self):
+        self.assertMatchesSite(_Archive(self.zip("public/"), "public/"))
+        self.assertMatchesSite(_Archive(self.tar(arcname="public"),
+                                        "public"))
+
+    def test_unwanted_files_not_kept(self):
+        archive = _Archive(self.tar())
+        self.addCleanup(archive.close)
+        self.assertEqual(["index.html"], list(archive.files(
+            lambda relative_path: relative_path == "index.html")))
+        self.assertEqual(["index.html"], list(archive._members))
+
+    @patch("s3sitedeploy.COMPRESSION_SPOOL_SIZE", 16)
+    def test_large_files_spilled_until_finished(self):
+        archive = _Archive(self.tar(), consumers=2)
+        self.addCleanup(archive.close)
+        list(archive.files())
+        spilled = archive._members["index.html"]["path"]
+        with archive.open("index.html") as handle:
+            with open(join(self.site, "index.html"), "rb") as f:
+                self.assertEqual(f.read(), handle.read())
+        archive.finished(0, "index.html")
+        self.assertTrue(isfile(spilled))
+        archive.finished(1, "index.html")
+        self.assertFalse(isfile(spilled))
+
+    def test_retired_consumer_not_waited_for(self):
+        archive = _Archive(self.tar(), consumers=2)
+        self.addCleanup(archive.close)
+        files = archive.files()
+        archive.consumer(0).finished(next(files))
+        archive.consumer(1).retire()
+        self.assertEqual({}, archive._members)
+        self.assertTrue(list(files))
+        self.assertEqual({0}, set().union(*(
+            member["waiting"] for member in archive._members.values())))
+
+    def test_every_consumer_retired(self):
+        archive = _Archive(self.tar(), consumers=2)
+        self.addCleanup(archive.close)
+        archive.retire(0)
+        archive.retire(1)
+        self.assertTrue(list(archive.files()))
+        self.assertEqual({}, archive._members)
+
+    def test_files_spilled_beyond_memory(self):
+        budget = _MemoryBudget(8)
+        archive = _Archive(self.tar(), memory=budget)
+        self.addCleanup(archive.close)
+        list(archive.files())
+        self.assertTrue(all(member["contents"] is None or
+                            len(member["contents"]) <= 8
+                            for member in archive._members.values()))
+        self.assertTrue(any(member["path"] is not None
+                            for member in archive._members.values()))
+        for relative_path in list(archive._members):
+            with open(join(self.site, relative_path), "rb") as f:
+                self.assertEqual(f.read(),
+                                 archive.open(relative_path).read())
+            archive.finished(0, relative_path)
+        self.assertEqual(0, budget.used)
+
+    def test_not_an_archive(self):
+        self.assertRaises(ValueError, _Archive,
+                          join(self.site, "index.html"))
 
 
 class GetS3siteConfigTestCase(TestCase):
@@ -336,6 +2296,12 @@ class GetS3siteConfigTestCase(TestCase):
             "tests/fixtures/example-multi-depth-project/")
         self.assertEquals(expected, config)
 
+    def test_object_specific_compiled_on_load(self):
+        config = _get_s3site_config(
+            "tests/fixtures/example-multi-depth-project/")
+        self.assertTrue(isinstance(config["object_specific"],
+                                   _DirectiveMatcher))
+
     def test_config_is_validated_against_schema(self):
         self.assertRaises(ValidationError, _get_s3site_config,
                           "tests/fixtures/invalid-s3sitedeploy-json/")